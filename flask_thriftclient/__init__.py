@@ -1,12 +1,44 @@
 # -*- coding:utf-8 -*-
 
-from thrift.transport import TSocket, THttpClient, TTransport, TZlibTransport, TSSLSocket
-from thrift.protocol import TBinaryProtocol, TCompactProtocol, TJSONProtocol
-
-
-from urlparse import urlparse
-from functools import wraps
+from thrift.transport import TTransport
+from thrift.protocol import TBinaryProtocol
+from thrift.protocol.TProtocol import TProtocolException
+try:
+    from thrift.protocol import fastbinary
+except ImportError:
+    fastbinary = None
+
+from flask import _app_ctx_stack as stack
+
+from .balancer import (Endpoint, RoundRobinBalancer, LeastOutstandingBalancer,
+                       PowerOfTwoBalancer, WeightedBalancer)
+from .batch import Batcher
+from .breaker import CircuitBreaker, CircuitOpenError, OutlierDetector
+from .cache import Cache, MemoryBackend
+from .deadline import ThriftTimeout, DeadlineExceeded
+from .futures import ThreadPool
+from .pipeline import Pipeline, run_pipeline
+from .pool import Connection, ConnectionPool
+from .proxy import ClientProxy, FutureClientProxy
+from .retry import RetryPolicy, budget as default_budget
+from .singleflight import SingleFlight, call_key
+from .stream import PageStream
+# the modules of the other transports, protocols and layers are imported
+# once they are configured
+from .transports import (TLazyTransport, TCountingTransport, TClientSocket,
+                         TFastFramedTransport)
+
+from collections import OrderedDict
+from Queue import Queue, Empty
+from urlparse import urlparse, parse_qs
+from functools import wraps, partial
 from contextlib import contextmanager
+import errno
+import os
+import random
+import socket
+import threading
+import time
 
 
 class ThriftClient(object):
@@ -70,6 +102,71 @@ it *MUST* have either no or three "/" before the socket path
 
 * unix:./mysocket #relative path
 
+replay: serve the calls recorded in a capture file, see Record and replay
+
+* replay:///tmp/calls.capture
+
+Load balancing
+==============
+
+THRIFTCLIENT_TRANSPORT may also be a list of urls, each context then connects
+to one of these endpoints, chosen according to *THRIFTCLIENT_BALANCER*:
+
+ThriftClient.ROUND_ROBIN or "ROUND_ROBIN": endpoints are used in turn (default)
+
+ThriftClient.LEAST_OUTSTANDING or "LEAST_OUTSTANDING": use the endpoint with
+the fewest calls waiting for a reply
+
+ThriftClient.POWER_OF_TWO or "POWER_OF_TWO": pick two endpoints at random and
+use the one with the fewest calls waiting for a reply
+
+ThriftClient.WEIGHTED or "WEIGHTED": weighted round robin, the weight of an
+endpoint is given by the *weight* parameter of its url (default 1)
+
+THRIFTCLIENT_BALANCER may also be any object with a *choose(endpoints)* method
+returning one of the endpoints. When pooling is enabled, each endpoint has its
+own connection pool.
+
+When an endpoint can't be connected to, the next context connects to another
+one. Failing endpoints may also be avoided altogether:
+
+THRIFTCLIENT_BREAKER_THRESHOLD: number of consecutive failures (connections
+or calls) opening the circuit of an endpoint, None disables circuit breakers
+(default None). Only successful calls reset the count, a server accepting
+connections but failing their calls still opens its circuit. Endpoints with
+an opened circuit aren't used, and when no endpoint is left
+*CircuitOpenError* is raised immediately instead of waiting for a connection
+timeout.
+
+THRIFTCLIENT_BREAKER_RESET_TIMEOUT: seconds before an opened circuit is half
+opened (default 30)
+
+THRIFTCLIENT_BREAKER_HALF_OPEN_CALLS: connections allowed to probe a half
+opened circuit, a success closes it and a failure opens it again (default 1).
+Only connections actually made probe the circuit, the lazy ones with their
+first call, and probes left unsettled are given up after
+THRIFTCLIENT_BREAKER_RESET_TIMEOUT seconds.
+
+THRIFTCLIENT_OUTLIER_ERRORS: number of consecutive failed calls ejecting an
+endpoint out of the rotation, None disables it (default None)
+
+THRIFTCLIENT_OUTLIER_LATENCY: calls slower than this number of seconds
+count as slow, None disables it (default None)
+
+THRIFTCLIENT_OUTLIER_SLOW_CALLS: number of consecutive slow calls ejecting an
+endpoint (default 3)
+
+THRIFTCLIENT_OUTLIER_EJECTION_TIME: seconds an endpoint stays out of the
+rotation (default 30). If every endpoint is ejected they are all used again.
+
+.. code:: python
+
+app.config["THRIFTCLIENT_TRANSPORT"] = [
+    "tcp://10.0.0.1:9090?weight=2",
+    "tcp://10.0.0.2:9090",
+]
+app.config["THRIFTCLIENT_BALANCER"] = ThriftClient.WEIGHTED
+
 SSL
 ===
 
@@ -122,11 +219,41 @@ ThriftClient.COMPACT or "COMPACT" : use the compact protocol
 ThriftClient.JSON or "JSON" : use the JSON protocol. note that this
 protocol is only available for thrift >= 0.9.1
 
+When thrift is installed with its C extension, the binary protocol (and the
+compact protocol for thrift >= 0.10) is accelerated: generated code encodes
+and decodes structs in C. Decoding also needs a buffered, framed or zlib
+transport. *THRIFTCLIENT_ACCELERATED* controls it:
+
+None: use the accelerated protocol when available (default)
+
+True: use the accelerated protocol, raise a *RuntimeError* when it is not
+available
+
+False: always use the pure python protocol
+
+The *accelerated* attribute of the extension tells which one is used.
+
 Connection
 ==========
 
-By default the application will open then close the transport for each request
-This can be overriden by setting *THRIFTCLIENT_ALWAYS_CONNECT* to False
+Each application context (so each request) gets its own connection, it is
+created the first time *thriftclient.client* (or *transport*, *protocol*) is
+used and released when the context is torn down. Routes which never use the
+client don't connect at all, and threaded or greenlet workers never share a
+socket.
+
+*init_app* checks the configuration and raises on invalid ones, but builds no
+connection, and only the modules of the configured transports, protocol and
+layers are imported, which keeps the startup of short lived processes fast.
+
+By default the connection is opened when it is created and closed at the end
+of the request. This can be overriden by setting *THRIFTCLIENT_ALWAYS_CONNECT*
+to False
+
+Setting *THRIFTCLIENT_LAZY_CONNECT* to True delays the connection further: the
+transport is only opened by the first RPC method call, and only closed at the
+end of the request if it was opened. Code which gets *thriftclient.client*
+without calling it never connects.
 
 when THRIFTCLIENT_ALWAYS_CONNECT is set to False there is 3 ways to handle your
 connections:
@@ -162,6 +289,442 @@ def with_manual_connection():
     thriftclient.transport.close()
     return data
 
+Connection pool
+===============
+
+Setting *THRIFTCLIENT_POOL* to True makes the extension keep opened
+connections in a pool instead of opening and closing the transport for each
+request. Each request (or each connect/autoconnect block) checks out its own
+connection, so threaded and greenlet workers never share a socket, and
+*thriftclient.client* resolves to the connection of the current request.
+
+The pool is configured with:
+
+THRIFTCLIENT_POOL_MIN_SIZE: connections never closed for being idle
+(default 0)
+
+THRIFTCLIENT_POOL_MAX_SIZE: maximum number of connections (default 10)
+
+THRIFTCLIENT_POOL_TIMEOUT: seconds to wait for a connection when the pool is
+exhausted, None waits forever (default 10)
+
+THRIFTCLIENT_POOL_IDLE_TIMEOUT: seconds after which an idle connection is
+closed, None keeps them (default None)
+
+THRIFTCLIENT_POOL_MAX_LIFETIME: seconds after which a connection is recycled,
+None keeps them (default None)
+
+.. code:: python
+
+app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:9090"
+app.config["THRIFTCLIENT_POOL"] = True
+app.config["THRIFTCLIENT_POOL_MAX_SIZE"] = 20
+
+Pooled connections are persistent: they stay opened across requests, and
+before being reused a connection is checked for having been closed by the
+server. Socket transports may also enable TCP keepalive so that dead peers
+are detected while the connection is idle:
+
+THRIFTCLIENT_TCP_KEEPALIVE: enable TCP keepalive (default False)
+
+THRIFTCLIENT_TCP_KEEPALIVE_IDLE, THRIFTCLIENT_TCP_KEEPALIVE_INTERVAL,
+THRIFTCLIENT_TCP_KEEPALIVE_COUNT: keepalive idle time and probes interval in
+seconds, and number of probes (default None, use the system settings)
+
+A server may still close a connection between the check and the call. The
+methods declared as idempotent are then called again, once, on a new
+connection:
+
+.. code:: python
+
+thriftclient.idempotent("getUser", "listUsers")
+
+Timeouts
+========
+
+THRIFTCLIENT_CONNECT_TIMEOUT: seconds to wait for a connection to the server,
+a server which doesn't accept it in time is handled as an unreachable one
+(default None, no timeout)
+
+THRIFTCLIENT_READ_TIMEOUT: seconds to wait for data from the server, a call
+which doesn't get it in time raises *ThriftTimeout* (default None, no
+timeout). Note that http transports have a single timeout, the read timeout
+when it is defined.
+
+The *deadline* context bounds the time spent by all the calls of a block,
+waiting for a pooled connection and connecting included. *DeadlineExceeded*
+(a *ThriftTimeout*) is raised once it is over:
+
+.. code:: python
+
+from flask_thriftclient import DeadlineExceeded
+
+@app.route("/")
+def home():
+    try:
+        with thriftclient.deadline(0.05):
+            return thriftclient.client.mymethod()
+    except DeadlineExceeded:
+        return "too slow", 504
+
+Retries
+=======
+
+*retry* declares how the failed calls of a RPC method are made again: at most
+*attempts* calls in all (default 3), separated by exponential delays starting
+at *backoff* seconds (default 0.05) and capped at *max_backoff* (default 1),
+with full jitter. A call which could not be sent is always retried, one which
+failed after its request may have reached the server only when the method is
+*idempotent*. Calls are retried on the reopened connection of the context,
+never past the current deadline.
+
+Retries are drawn from a budget shared by the whole process, so that they
+can't amplify an outage: every call of a method with a retry policy earns a
+tenth of a retry, up to 10 saved retries. *THRIFTCLIENT_RETRY_BUDGET* may give
+a *RetryBudget(ratio, capacity)* of its own to a client (default None, the
+budget of the process).
+
+Idempotent calls may also be hedged: when no reply came after the *hedge*
+percentile of the latencies of the method (once 20 of them are known), or
+after *hedge_after* seconds, a duplicate call is sent on another connection
+and the first reply wins. Hedged calls run on THRIFTCLIENT_WORKERS threads
+of their own, apart from those of *gather*, with connections of their own,
+checked out of the pool when THRIFTCLIENT_POOL is enabled. Duplicates are
+drawn from the retry budget too. A hedged call made without deadline is given
+one of *THRIFTCLIENT_HEDGE_TIMEOUT* seconds (default 30).
+
+.. code:: python
+
+thriftclient.retry("getUser", attempts=3, idempotent=True, hedge=95)
+thriftclient.retry("updateUser", attempts=2, backoff=0.1)
+
+Concurrent calls
+================
+
+*gather* runs independent calls concurrently, each one on a connection of its
+own, on a pool of *THRIFTCLIENT_WORKERS* threads (default 10). It returns the
+results in order, a call which failed has its exception instead of a result
+and a call still running after *timeout* seconds (or the current deadline)
+has a *DeadlineExceeded*:
+
+.. code:: python
+
+a, b, c = thriftclient.gather([
+    lambda client: client.getA(1),
+    lambda client: client.getB(2),
+    lambda client: client.getC(3),
+], timeout=0.5)
+
+Asynchronous calls
+==================
+
+Python 2 has no asyncio, *AsyncThriftClient* gives views a non blocking
+client instead: its RPC methods return a future right away, the call runs on
+a worker thread with a connection of its own (checked out of the pool when
+THRIFTCLIENT_POOL is enabled) and the current deadline. *submit* does the
+same for any function of the client on a ThriftClient.
+
+.. code:: python
+
+from flask_thriftclient import AsyncThriftClient
+
+thriftclient = AsyncThriftClient(MyService.Client, app)
+
+@app.route("/user/<int:id>")
+def user(id):
+    user = thriftclient.client.getUser(id)
+    items = thriftclient.client.getItems(id)
+    return render(user.result(), items.result(timeout=1))
+
+Pipelined calls
+===============
+
+A pipeline sends several calls on the connection of the context back to back
+before reading their replies, so they cost about one round trip instead of
+one each. *execute* returns the results in order, a call which failed has its
+exception instead of a result. Replies are matched to the calls by seqid,
+servers replying out of order are supported with *ordered=False*. Pipelines
+need a socket transport, framed for non blocking servers.
+
+.. code:: python
+
+pipe = thriftclient.pipeline()
+for id in ids:
+    pipe.getItem(id)
+items = pipe.execute()
+
+Metrics
+=======
+
+Setting *THRIFTCLIENT_METRICS* to a sink enables the measures of the
+extension (default None, nothing is measured):
+
+- the latency, errors and bytes written and read of each RPC call, per method
+- the duration of each connection, and of its TLS handshake
+- the time spent waiting for a connection of the pool
+
+Available sinks, in *flask_thriftclient.metrics*, are:
+
+MetricsRegistry(): keeps the measures in memory, per method, with latency
+histograms. *snapshot()* returns them as a dict.
+
+StatsdSink(timing, increment, prefix="thriftclient"): forwards the measures
+to StatsD style callbacks.
+
+SignalSink(): sends the Flask signals *call_finished*, *connection_opened*
+and *pool_waited* (receiving them needs blinker).
+
+Any subclass of *MetricsSink* may be used as well.
+
+.. code:: python
+
+from flask_thriftclient.metrics import MetricsRegistry
+
+registry = MetricsRegistry()
+app.config["THRIFTCLIENT_METRICS"] = registry
+
+@app.route("/metrics")
+def metrics():
+    return jsonify(registry.snapshot())
+
+Caching
+=======
+
+*cached* keeps the results of a RPC method, keyed by the arguments of the
+calls serialized with the binary protocol. Results are kept for *ttl* seconds
+(None: until evicted) and at most *maxsize* of them in memory, the least
+recently used being evicted first. Concurrent calls with the same arguments
+share a single call, failed calls are not cached.
+
+A shared *backend* may be given instead of the memory one, it has the *get*,
+*set*, *delete* and *clear* methods of *flask_thriftclient.cache.MemoryBackend*
+and serializes the results itself.
+
+.. code:: python
+
+users = thriftclient.cached("getUser", ttl=30, maxsize=10000)
+
+@app.route("/user/<int:id>", methods=["POST"])
+def update_user(id):
+    thriftclient.client.updateUser(id, request.form)
+    users.invalidate(id)
+    return "", 204
+
+Setting *THRIFTCLIENT_SINGLE_FLIGHT* to True coalesces the calls of the
+methods declared as idempotent, without caching their results: threads making
+the same call (same method and serialized arguments) while it is in progress
+wait for it and get its result, or its exception (default False).
+
+Batching
+========
+
+*batched* turns the calls of a point method, taking a single key, into calls
+of a batch method taking a list of keys. The batch method returns the results
+in the order of the keys, or a dict of the results by key (missing keys get
+None). Keys are deduplicated and a batch call gets at most *max_size* keys
+(default 100).
+
+*load* defers the calls of a context: they are made as batch calls, on the
+connection of the context, as soon as one of their results is needed. The
+results never needed by the end of the context are RuntimeErrors.
+
+.. code:: python
+
+thriftclient.batched("getItem", "getItems", max_size=100)
+
+@app.route("/items")
+def items():
+    items = [thriftclient.load("getItem", id) for id in ids]
+    return render([item.result() for item in items])
+
+With a *window*, calls of the point method made through the client by
+concurrent threads within *window* seconds are batched as well, the first
+call waits for the others (or for *max_size* keys):
+
+.. code:: python
+
+thriftclient.batched("getItem", "getItems", window=0.002)
+
+Streaming
+=========
+
+*stream* turns a paginated RPC method, called as method(*args, cursor, limit),
+into an iterable over the items of its pages. *items* and *next_cursor* name
+the attributes (or give the functions) of a page holding its items and the
+cursor of the next page, the last page has no item or no next cursor.
+
+Pages are fetched by a background thread, on a connection of its own, while
+the current page is consumed: a scan runs at the speed of the network rather
+than one round trip per page. At most *read_ahead* pages (default 2) wait to
+be consumed, which bounds the memory of large exports. The calls are bounded
+by *timeout* and by the deadline of the context which created the stream.
+
+The iterable needs no context, so it can feed a Flask streaming response.
+Fetching stops when it is exhausted or closed:
+
+.. code:: python
+
+@app.route("/export")
+def export():
+    users = thriftclient.stream("scanUsers", args=(account,), limit=500,
+                                items="users", next_cursor="next")
+    return Response((serialize(user) + "\\n" for user in users),
+                    mimetype="application/x-ndjson")
+
+Compression
+===========
+
+THRIFTCLIENT_COMPRESSION compresses the messages larger than
+THRIFTCLIENT_COMPRESSION_THRESHOLD bytes (default 1024) with a codec: "zlib",
+"bz2", or "lz4", "zstd" and "snappy" which need the extras of the same name.
+Smaller messages are sent raw, so latency sensitive calls don't pay for the
+compression. THRIFTCLIENT_COMPRESSION_LEVEL sets the level of the codec
+(default: the codec default), any object with compress(data) and
+decompress(data) methods can be given as the codec too.
+
+Each message is sent as a frame flagged as compressed or not, servers need
+the same transport:
+
+.. code:: python
+
+from flask_thriftclient.compression import TCompressedTransportFactory
+
+server = TServer.TThreadedServer(
+    processor, transport, TCompressedTransportFactory("zlib"), protocol)
+
+The compression ratio and the time spent in the codec are measured per
+connection:
+
+.. code:: python
+
+stats = thriftclient.compression
+stats.ratio, stats.compress_time, stats.decompress_time
+
+Services
+========
+
+ThriftServices manages several thrift services from one extension, each
+service with its own interface and options, released by a single teardown:
+
+.. code:: python
+
+from flask_thriftclient import ThriftServices
+
+app.config["THRIFTCLIENT_SERVICES"] = {
+    "users": {"THRIFTCLIENT_TRANSPORT": "tcp://users:9090"},
+    "items": {"THRIFTCLIENT_TRANSPORT": "tcp://items:9090",
+              "THRIFTCLIENT_POOL": True},
+}
+services = ThriftServices(app)
+services.register("users", UserService.Client)
+services.register("items", ItemService.Client)
+
+@app.route("/users/<int:id>")
+def user(id):
+    return render(services.users.getUser(id))
+
+The options of a service are the THRIFTCLIENT_* keys of the application,
+overridden by its entry of THRIFTCLIENT_SERVICES and then by the config given
+to register(). A service only connects the first time it is used in a context.
+services["users"] is the ThriftClient of a service, for its other methods.
+
+Services of a server using TMultiplexedProcessor can share one connection,
+their calls are sent through the TMultiplexedProtocol, under the name given
+as *multiplexed* (the name of the service by default):
+
+.. code:: python
+
+services.shared("backend", {"THRIFTCLIENT_TRANSPORT": "tcp://backend:9090"})
+services.register("users", UserService.Client, shared="backend")
+services.register("items", ItemService.Client, shared="backend",
+                  multiplexed="ItemService")
+
+Prefork servers
+===============
+
+Connections inherited through fork() (gunicorn with preloading for instance)
+are never used by the children: the pools of a child forget the connections
+of its parent on their first use. THRIFTCLIENT_WARM_UP pools connections
+per endpoint as soon as a worker starts, rather than on its first requests,
+after a random delay of at most THRIFTCLIENT_WARM_UP_STAGGER seconds, so that
+restarting every worker doesn't flood the servers with connections. Warming
+up needs THRIFTCLIENT_POOL, it happens in the background:
+
+.. code:: python
+
+# gunicorn.conf.py
+def post_fork(server, worker):
+    thriftclient.warm_up()
+
+Workers which don't call warm_up() warm up on the first use of the extension.
+
+HTTP keep-alive
+===============
+
+THRIFTCLIENT_HTTP_KEEPALIVE sends the calls of http(s) endpoints over
+HTTP/1.1 connections kept alive between calls and requests, at most
+THRIFTCLIENT_HTTP_MAX_IDLE (default 10) idle ones per host. Responses are read
+as they are decoded, and with THRIFTCLIENT_HTTP_GZIP gzip encoded responses
+are accepted. Idle connections closed by their server are not reused, and a
+request whose connection is closed once it was sent is not sent again: the
+server may have processed it, it fails with a TTransportException retried by
+the retry policy of idempotent methods only. THRIFTCLIENT_HTTP_HEADERS adds
+headers to every request, it is a dict or a function returning a dict, called
+for each request. The calls run by worker threads (gather, submit,
+AsyncThriftClient, hedged calls and streams) get the headers computed by
+their caller when they were started, as the workers have no application
+context:
+
+.. code:: python
+
+app.config["THRIFTCLIENT_HTTP_HEADERS"] = lambda: {
+    "X-Request-Id": g.request_id}
+
+TLS
+===
+
+The tcps, unixs and https endpoints of a configuration share one SSL context,
+built from THRIFTCLIENT_SSL_VALIDATE and THRIFTCLIENT_SSL_CA_CERTS once.
+https endpoints check the hostnames of the servers and use the default CA
+certificates when THRIFTCLIENT_SSL_CA_CERTS is None. thriftclient.tls counts
+the handshakes of the SSL context of the current connection, TLS sessions
+aren't resumed: every new connection does a full handshake.
+
+.. code:: python
+
+thriftclient.tls.handshakes
+
+Record and replay
+=================
+
+THRIFTCLIENT_RECORD appends the calls of the extension to a capture file, a
+request and its reply per record, as they are encoded by the protocol. Calls
+failing on the connection aren't recorded, nor pipelined calls. Several
+processes can record to the same file.
+
+A replay endpoint then serves the recorded calls without any server, for load
+tests and offline development. A call gets a reply recorded for the same
+method and arguments, calls recorded several times get their replies in turn,
+and calls which were never recorded fail with a TTransportException. The
+capture file is memory mapped, only its record headers are read when the
+first connection is made. The protocol of the capture is replayed as is,
+THRIFTCLIENT_PROTOCOL must be the recorded one while the transport layers
+(buffered, framed...) are ignored:
+
+.. code:: python
+
+# record
+app.config["THRIFTCLIENT_RECORD"] = "/tmp/calls.capture"
+
+# replay, each call taking 20 to 30ms and 1% of them failing
+app.config["THRIFTCLIENT_TRANSPORT"] = (
+    "replay:///tmp/calls.capture?latency=0.02&jitter=0.01&errors=0.01")
+
+*latency* delays every call by as many seconds, plus a random delay of at most
+*jitter* seconds, and a share *errors* of the calls fail with a
+TTransportException. Calls delayed past THRIFTCLIENT_READ_TIMEOUT or the
+deadline time out as they would against a slow server.
+
 Options
 =======
 
@@ -173,22 +736,94 @@ THRIFTCLIENT_ZLIB: use zlib compressed transport (default False)
 
 THRIFTCLIENT_FRAMED: use framed transport (defualt False)
 
+THRIFTCLIENT_MULTIPLEXED: name of the service on a server using
+TMultiplexedProcessor, the calls are then sent through the
+TMultiplexedProtocol (default None)
+
+THRIFTCLIENT_FAST_FRAMED: use a framed transport reusing its buffers from a
+call to the next, instead of THRIFTCLIENT_FRAMED with which it is wire
+compatible. Frames are read straight into a preallocated buffer and written
+with a single write, which spares copies and allocations on large messages,
+THRIFTCLIENT_BUFFERED is then useless (default False)
+
     """
     BINARY = "BINARY"
     COMPACT = "COMPACT"
     JSON = "JSON"
 
+    ROUND_ROBIN = "ROUND_ROBIN"
+    LEAST_OUTSTANDING = "LEAST_OUTSTANDING"
+    POWER_OF_TWO = "POWER_OF_TWO"
+    WEIGHTED = "WEIGHTED"
+
     def __init__(self, interface, app=None, config=None):
         self.interface = interface
-        self.protocol = None
-        self.transport = None
-        self.client = None
         self.config = config
         self.alwaysConnect = True
+        self.endpoints = []
+        self.balancer = None
+        self.pool = None
+        self._pooled = False
+        self._health_checked = False
+        self._executor = None
+        self._hedger = None
+        self._executor_lock = threading.Lock()
+        self._config = None
+        self._local = threading.local()
+        self._idempotent = set()
+        self._retries = {}
+        self.retry_budget = None
+        self._caches = {}
+        self._batchers = {}
+        self._single_flight = False
+        self._flights = SingleFlight()
+        self.metrics = None
+        self.accelerated = False
+        self._pid = os.getpid()
+        self._warming = None
+        self._http_sessions = None
+        self._tls_contexts = {}
+        self._recorder = None
+        self._captures = {}
         if app is not None:
             self.init_app(app)
 
+    @property
+    def client(self):
+        return self._current_connection().proxy
+
+    @property
+    def protocol(self):
+        return self._current_connection().protocol
+
+    @property
+    def transport(self):
+        return self._current_connection().transport
+
+    @property
+    def tls(self):
+        """
+        TLSContext of the current connection, counting its handshakes, None
+        without TLS
+        """
+        return getattr(self._current_connection().socket, "tls", None)
+
+    @property
+    def compression(self):
+        """
+        CompressionStats of the current connection, None without
+        THRIFTCLIENT_COMPRESSION
+        """
+        return self._current_connection().compression
+
     def init_app(self, app, config=None):
+        self._configure(app, config)
+
+        @app.teardown_appcontext
+        def teardown_appcontext(exception):
+            self._teardown(exception)
+
+    def _configure(self, app, config=None):
         if not config:
             config = self.config
         if not config:
@@ -196,44 +831,105 @@ THRIFTCLIENT_FRAMED: use framed transport (defualt False)
 
         config.setdefault("THRIFTCLIENT_TRANSPORT", "tcp://localhost:9090")
         config.setdefault("THRIFTCLIENT_PROTOCOL", ThriftClient.BINARY)
+        config.setdefault("THRIFTCLIENT_MULTIPLEXED", None)
+        config.setdefault("THRIFTCLIENT_ACCELERATED", None)
+        config.setdefault("THRIFTCLIENT_BALANCER", ThriftClient.ROUND_ROBIN)
+
+        config.setdefault("THRIFTCLIENT_BREAKER_THRESHOLD", None)
+        config.setdefault("THRIFTCLIENT_BREAKER_RESET_TIMEOUT", 30)
+        config.setdefault("THRIFTCLIENT_BREAKER_HALF_OPEN_CALLS", 1)
+
+        config.setdefault("THRIFTCLIENT_OUTLIER_ERRORS", None)
+        config.setdefault("THRIFTCLIENT_OUTLIER_LATENCY", None)
+        config.setdefault("THRIFTCLIENT_OUTLIER_SLOW_CALLS", 3)
+        config.setdefault("THRIFTCLIENT_OUTLIER_EJECTION_TIME", 30)
 
         config.setdefault("THRIFTCLIENT_SSL_VALIDATE", True)
         config.setdefault("THRIFTCLIENT_SSL_CA_CERTS", None)
 
+        config.setdefault("THRIFTCLIENT_HTTP_KEEPALIVE", False)
+        config.setdefault("THRIFTCLIENT_HTTP_MAX_IDLE", 10)
+        config.setdefault("THRIFTCLIENT_HTTP_GZIP", False)
+        config.setdefault("THRIFTCLIENT_HTTP_HEADERS", None)
+
         config.setdefault("THRIFTCLIENT_BUFFERED", False)
         config.setdefault("THRIFTCLIENT_ZLIB", False)
+        config.setdefault("THRIFTCLIENT_FRAMED", False)
+        config.setdefault("THRIFTCLIENT_FAST_FRAMED", False)
+        config.setdefault("THRIFTCLIENT_COMPRESSION", None)
+        config.setdefault("THRIFTCLIENT_COMPRESSION_LEVEL", None)
+        config.setdefault("THRIFTCLIENT_COMPRESSION_THRESHOLD", 1024)
+
+        config.setdefault("THRIFTCLIENT_RECORD", None)
+
+        config.setdefault("THRIFTCLIENT_CONNECT_TIMEOUT", None)
+        config.setdefault("THRIFTCLIENT_READ_TIMEOUT", None)
 
         config.setdefault("THRIFTCLIENT_ALWAYS_CONNECT", True)
 
-        self._set_client(app, config)
+        config.setdefault("THRIFTCLIENT_WORKERS", 10)
+        config.setdefault("THRIFTCLIENT_HEDGE_TIMEOUT", 30)
+        config.setdefault("THRIFTCLIENT_LAZY_CONNECT", False)
 
-        if self.alwaysConnect:
-            @app.before_request
-            def before_request():
-                assert(self.client is not None)
-                assert(self.transport is not None)
-                try:
-                    self.transport.open()
-                except TTransport.TTransportException:
-                    raise RuntimeError("Unable to connect to thrift server")
+        config.setdefault("THRIFTCLIENT_TCP_KEEPALIVE", False)
+        config.setdefault("THRIFTCLIENT_TCP_KEEPALIVE_IDLE", None)
+        config.setdefault("THRIFTCLIENT_TCP_KEEPALIVE_INTERVAL", None)
+        config.setdefault("THRIFTCLIENT_TCP_KEEPALIVE_COUNT", None)
+
+        config.setdefault("THRIFTCLIENT_METRICS", None)
+        config.setdefault("THRIFTCLIENT_SINGLE_FLIGHT", False)
+        config.setdefault("THRIFTCLIENT_RETRY_BUDGET", None)
+
+        config.setdefault("THRIFTCLIENT_POOL", False)
+        config.setdefault("THRIFTCLIENT_POOL_MIN_SIZE", 0)
+        config.setdefault("THRIFTCLIENT_POOL_MAX_SIZE", 10)
+        config.setdefault("THRIFTCLIENT_POOL_TIMEOUT", 10)
+        config.setdefault("THRIFTCLIENT_POOL_IDLE_TIMEOUT", None)
+        config.setdefault("THRIFTCLIENT_POOL_MAX_LIFETIME", None)
+        config.setdefault("THRIFTCLIENT_WARM_UP", 0)
+        config.setdefault("THRIFTCLIENT_WARM_UP_STAGGER", 0)
 
-            @app.teardown_request
-            def after_request(response):
-                self.transport.close()
+        self._set_client(app, config)
+
+    def _teardown(self, exception):
+        ctx = stack.top
+        batches = getattr(ctx, "thriftclient_batches", {}).pop(self, {})
+        for batch in batches.values():
+            batch.drop()
+        conn = getattr(ctx, "thriftclient_connections", {}).pop(self, None)
+        if conn is not None:
+            self._release(conn, exception)
 
     @contextmanager
     def connect(self):
-        assert(self.client is not None)
-        assert(self.transport is not None)
+        assert(self._config is not None)
 
-        try:
-            self.transport.open()
-        except TTransport.TTransportException:
-            raise RuntimeError("Unable to connect to thrift server")
+        bindings = self._bindings()
+        previous = bindings.get(self)
+        # nested connect() calls share the connection of the outer one
+        if previous is not None and previous.isOpen():
+            yield
+            return
 
-        yield
+        if self._pooled or previous is None:
+            conn = self._new_connection(opened=True)
+        else:
+            conn = previous
+            self._open(conn)
+        bindings[self] = conn
 
-        self.transport.close()
+        try:
+            yield
+        except Exception as e:
+            self._release(conn, e)
+            raise
+        else:
+            self._release(conn)
+        finally:
+            if previous is None:
+                bindings.pop(self, None)
+            else:
+                bindings[self] = previous
 
     def autoconnect(self, func):
         """
@@ -249,67 +945,1372 @@ THRIFTCLIENT_FRAMED: use framed transport (defualt False)
                 return func(*args, **kwargs)
         return onCall
 
+    @contextmanager
+    def deadline(self, seconds):
+        """
+        bounds the time spent by the thrift calls of the block, getting their
+        connection included. DeadlineExceeded is raised once it is over.
+        """
+        expires = time.time() + seconds
+        previous = getattr(self._local, "deadline", None)
+        if previous is not None:
+            expires = min(expires, previous)
+        self._local.deadline = expires
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    def _remaining(self):
+        """
+        seconds left before the current deadline, None without deadline
+        """
+        expires = getattr(self._local, "deadline", None)
+        if expires is None:
+            return None
+        remaining = expires - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded("Thrift deadline exceeded")
+        return remaining
+
+    def gather(self, calls, timeout=None):
+        """
+        runs *calls* concurrently, each one is given a client with its own
+        connection: thriftclient.gather([lambda c: c.getA(1), ...])
+
+        returns the results in order, failed calls have their exception
+        instead of a result, calls not done within *timeout* seconds (or the
+        current deadline) have a DeadlineExceeded.
+        """
+        expires = self._expires(timeout)
+        headers = self._caller_headers()
+        executor = self._get_executor()
+        futures = [executor.submit(self._run, call, expires, headers)
+                   for call in calls]
+        results = []
+        for future in futures:
+            remaining = None
+            if expires is not None:
+                remaining = max(expires - time.time(), 0)
+            try:
+                results.append(future.result(remaining))
+            except ThriftTimeout as e:
+                if not future.done():
+                    e = DeadlineExceeded("Thrift deadline exceeded")
+                results.append(e)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def submit(self, call, timeout=None):
+        """
+        runs call(client) in the background, on a connection of its own, and
+        returns a Future of its result. The call is bounded by *timeout* and
+        by the current deadline.
+        """
+        return self._get_executor().submit(self._run, call,
+                                           self._expires(timeout),
+                                           self._caller_headers())
+
+    def _expires(self, timeout):
+        """
+        the time at which a call started now with *timeout* must be done
+        """
+        expires = getattr(self._local, "deadline", None)
+        if timeout is not None:
+            limit = time.time() + timeout
+            if expires is None or limit < expires:
+                expires = limit
+        return expires
+
+    def _run(self, call, expires=None, headers=None):
+        """
+        runs call(client) on a connection of its own, bounded by the deadline
+        *expires*
+        """
+        return self._run_on(lambda conn: call(conn.proxy), expires, headers)
+
+    def _run_on(self, call, expires=None, headers=None):
+        """
+        runs call(conn) on a connection of its own, bounded by the deadline
+        *expires*. The http requests get the *headers* computed by the
+        caller, see _caller_headers().
+        """
+        self._local.deadline = expires
+        self._local.http_headers = headers
+        try:
+            conn = self._new_connection(opened=True)
+            try:
+                result = call(conn)
+            except Exception as e:
+                self._release(conn, e)
+                raise
+            self._release(conn)
+            return result
+        finally:
+            self._local.deadline = None
+            self._local.http_headers = None
+
+    def _caller_headers(self):
+        """
+        the http headers of the calls given to a worker thread, computed by
+        the caller as THRIFTCLIENT_HTTP_HEADERS functions may need its
+        application context
+        """
+        if not callable(self._config["THRIFTCLIENT_HTTP_HEADERS"]):
+            return None
+        return self._http_headers()
+
+    def _http_headers(self):
+        """the headers of a http request of the current thread"""
+        headers = getattr(self._local, "http_headers", None)
+        if headers is None:
+            headers = self._config["THRIFTCLIENT_HTTP_HEADERS"]()
+        return headers
+
+    def _get_executor(self):
+        # threads are started on first use, never in the parent of a fork
+        self._check_fork()
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPool(
+                    self._config["THRIFTCLIENT_WORKERS"])
+            return self._executor
+
+    def _get_hedger(self):
+        """
+        the threads of the hedged calls, apart from the workers: a worker
+        waiting for its hedged call must not wait for itself
+        """
+        self._check_fork()
+        with self._executor_lock:
+            if self._hedger is None:
+                self._hedger = ThreadPool(
+                    self._config["THRIFTCLIENT_WORKERS"])
+            return self._hedger
+
+    def warm_up(self):
+        """
+        opens THRIFTCLIENT_WARM_UP connections per endpoint in the pools, in
+        the background after a random delay of at most
+        THRIFTCLIENT_WARM_UP_STAGGER seconds. Returns the warming thread,
+        None when there is nothing to warm up.
+
+        children of a fork warm up on their own once they use the extension,
+        calling warm_up() right after the fork (gunicorn post_fork hook)
+        opens the connections before the first request instead.
+        """
+        if self._check_fork():
+            return self._warming
+        return self._start_warm_up()
+
+    def _check_fork(self):
+        """
+        forgets what the parent process left to a child of fork(): its
+        connections, locks and threads, then warms up. Returns True in a new
+        process.
+        """
+        pid = os.getpid()
+        if pid == self._pid:
+            return False
+        self._pid = pid
+        self._forget_parent()
+        self._start_warm_up()
+        return True
+
+    def _forget_parent(self):
+        # the pools reset themselves on their first use
+        self._local = threading.local()
+        self._executor = None
+        self._hedger = None
+        self._executor_lock = threading.Lock()
+        self._flights = SingleFlight()
+        for cache in self._caches.values():
+            cache.forget_parent()
+        for batcher in self._batchers.values():
+            batcher.forget_parent()
+
+    def _start_warm_up(self):
+        self._warming = None
+        count = self._config["THRIFTCLIENT_WARM_UP"]
+        if not count:
+            return None
+        delay = random.uniform(0, self._config["THRIFTCLIENT_WARM_UP_STAGGER"])
+        self._warming = threading.Thread(target=self._warm_up,
+                                         args=(count, delay))
+        self._warming.daemon = True
+        self._warming.start()
+        return self._warming
+
+    def _warm_up(self, count, delay):
+        # spread the connections of workers started together
+        time.sleep(delay)
+        for endpoint in self.endpoints:
+            try:
+                endpoint.pool.fill(count)
+            except TTransport.TTransportException:
+                # best effort, connections are made on demand anyway
+                endpoint.failure()
+
+    def idempotent(self, *methods):
+        """
+        marks methods as safe to be called twice: when such a call fails
+        because the server dropped the connection, the connection is reopened
+        and the call retried once. With THRIFTCLIENT_SINGLE_FLIGHT, concurrent
+        calls with the same arguments share a single call.
+
+        retry() retries other failures too, with backoff and hedging.
+        """
+        self._idempotent.update(methods)
+
+    def retry(self, method, attempts=3, idempotent=False, backoff=0.05,
+              max_backoff=1, jitter=True, hedge=None, hedge_after=None):
+        """
+        retries the calls of the RPC method *method* which failed: at most
+        *attempts* calls in all, separated by exponential delays starting at
+        *backoff* seconds, capped at *max_backoff*, with full *jitter*.
+        Retries are drawn from the retry budget of the process.
+
+        calls which could not be sent are always retried, others only when
+        the method is *idempotent*, it is then declared as with idempotent().
+        With *hedge* (a latency percentile of the method) or *hedge_after*
+        (seconds), a duplicate call is sent on another connection when no
+        reply came in time, the first reply wins.
+
+        returns the RetryPolicy
+        """
+        self._check_method(method)
+        policy = self._retries[method] = RetryPolicy(
+            attempts, idempotent, backoff, max_backoff, jitter, hedge,
+            hedge_after)
+        if idempotent:
+            self._idempotent.add(method)
+        return policy
+
+    def pipeline(self, ordered=True):
+        """
+        returns a Pipeline queuing calls of the current connection, they are
+        sent back to back by its execute() method:
+
+        pipe = thriftclient.pipeline()
+        for id in ids:
+            pipe.getItem(id)
+        items = pipe.execute()
+
+        servers replying out of order are supported when *ordered* is False
+        """
+        return Pipeline(self, ordered)
+
+    def _pipeline(self, calls, ordered):
+        conn = self._current_connection()
+        # every request of THttpClient waits for its reply
+        if urlparse(conn.endpoint.url).scheme in ("http", "https"):
+            raise RuntimeError("pipelined calls are not available over http")
+        names = set(name for name, args, kwargs in calls)
+        return self._guard(conn, "pipeline", partial(
+            self._invoke, conn, names,
+            lambda: run_pipeline(conn.client, calls, ordered)))
+
+    def cached(self, method, ttl=None, maxsize=1024, backend=None):
+        """
+        caches the results of the RPC method *method* for *ttl* seconds
+        (None: until evicted), keyed by the arguments of the calls. At most
+        *maxsize* results are kept in memory, unless a shared *backend* is
+        given (see MemoryBackend).
+
+        returns the Cache, its invalidate() and clear() methods drop results
+        """
+        self._check_method(method)
+        if backend is None:
+            backend = MemoryBackend(maxsize)
+        cache = self._caches[method] = Cache(self.interface, method, ttl,
+                                             backend)
+        return cache
+
+    def batched(self, method, batch_method, max_size=100, window=None):
+        """
+        batches the calls of the RPC method *method*, taking a single key,
+        into calls of *batch_method*, taking a list of keys and returning the
+        results in the same order or as a dict by key. Keys are deduplicated
+        and at most *max_size* of them are given to a batch call.
+
+        load(method, key) defers the calls of a context until a result is
+        needed. With a *window*, the calls of *method* made by concurrent
+        threads within *window* seconds are batched too.
+        """
+        self._check_method(method)
+        self._check_method(batch_method)
+        batcher = self._batchers[method] = Batcher(batch_method, max_size,
+                                                   window)
+        return batcher
+
+    def load(self, method, key):
+        """
+        returns a Future of the result of method(key), the keys loaded by
+        the context are given to a single batch call once a result is
+        needed:
+
+        items = [thriftclient.load("getItem", id) for id in ids]
+        items = [item.result() for item in items]
+        """
+        batcher = self._batchers.get(method)
+        if batcher is None:
+            raise RuntimeError(
+                "{method} of {interface} is not batched, see batched()"
+                .format(method=method, interface=self.interface))
+        # the batch runs on the connection of the context when it runs
+        return batcher.load(key, partial(self._dispatch_batch, batcher),
+                            self._batches())
+
+    def stream(self, method, args=(), cursor=None, limit=100, items="items",
+               next_cursor="cursor", read_ahead=2, timeout=None):
+        """
+        returns an iterable over the items of the pages of the paginated RPC
+        method *method*, called as method(*args, cursor, limit) from
+        *cursor* on. *items* and *next_cursor* are the attributes (or
+        functions) giving the items of a page and the cursor of the next
+        one, the last page has no item or no next cursor.
+
+        pages are fetched on a connection of its own by a background thread
+        while the current one is consumed, at most *read_ahead* of them
+        waiting. Calls are bounded by *timeout* and by the current deadline.
+        The iterable needs no context, it can be given to a Flask Response.
+        """
+        self._check_method(method)
+        args = tuple(args)
+        expires = self._expires(timeout)
+        headers = self._caller_headers()
+        return PageStream(
+            lambda client, cursor: getattr(client, method)(
+                *(args + (cursor, limit))),
+            lambda produce: self._run(produce, expires, headers),
+            cursor, items, next_cursor, read_ahead)
+
+    def _check_method(self, name):
+        """raises RuntimeError when *name* is not a RPC method"""
+        if not callable(getattr(self.interface, name, None)):
+            raise RuntimeError(
+                "{method} is not a RPC method of {interface}".format(
+                    method=name, interface=self.interface))
+
+    def _dispatch_batch(self, batcher, keys, conn=None):
+        """
+        calls the batch method of *batcher* with *keys* on the connection,
+        the one of the current context by default
+        """
+        if conn is None:
+            conn = self._current_connection()
+        return self._call(conn, batcher.method, (keys,), {})
+
+    def _call(self, conn, name, args, kwargs):
+        """
+        calls the RPC method *name* of the connection client
+        """
+        policy = self._retries.get(name)
+        if policy is None:
+            call = partial(self._attempt, conn, name, args, kwargs)
+        else:
+            call = partial(self._retried, conn, name, args, kwargs, policy)
+
+        batcher = self._batchers.get(name)
+        if (batcher is not None and batcher.window is not None and
+                len(args) == 1 and not kwargs):
+            return self._coalesced(batcher.call, args[0],
+                                   partial(self._dispatch_batch, batcher,
+                                           conn=conn))
+
+        cache = self._caches.get(name)
+        if cache is not None:
+            return self._coalesced(cache.call, args, kwargs, call)
+        if self._single_flight and name in self._idempotent:
+            key = call_key(self.interface, name, args, kwargs)
+            return self._coalesced(self._flights.do, key, call)
+        return call()
+
+    def _attempt(self, conn, name, args, kwargs):
+        """calls the RPC method *name* once on the connection"""
+        return self._guard(conn, name, partial(
+            self._invoke, conn, [name],
+            lambda: getattr(conn.client, name)(*args, **kwargs)))
+
+    def _retried(self, conn, name, args, kwargs, policy):
+        """
+        calls the RPC method *name* as told by its retry *policy*, failed
+        calls are made again on the reopened connection
+        """
+        budget = self.retry_budget
+        budget.deposit()
+        attempt = 1
+        broken = False
+        while True:
+            try:
+                if broken:
+                    self._reopen(conn)
+                    broken = False
+                after = policy.hedge_delay()
+                if after is not None:
+                    return self._hedged(name, args, kwargs, policy, after)
+                broken = True
+                start = time.time()
+                result = self._attempt(conn, name, args, kwargs)
+                policy.observe(time.time() - start)
+                return result
+            except Exception as e:
+                if attempt >= policy.attempts or not policy.retryable(e):
+                    raise
+                delay = policy.delay(attempt)
+                remaining = self._remaining()
+                if remaining is not None and delay >= remaining:
+                    raise
+                if not budget.withdraw():
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    def _reopen(self, conn):
+        """
+        reopens the connection of a failed call, which may still hold part
+        of a reply
+        """
+        conn.close()
+        try:
+            conn.open()
+        except TTransport.TTransportException:
+            conn.endpoint.failure()
+            conn.close()
+            raise
+        conn.broken = False
+
+    def _break(self, conn):
+        """
+        closes the connection of a call which failed midway, whatever the
+        caller does with the exception: it can't be reused as is
+        """
+        conn.broken = True
+        conn.close()
+
+    def _hedged(self, name, args, kwargs, policy, after):
+        """
+        calls the RPC method *name* on a connection of its own, and once
+        more on another one when no reply came within *after* seconds. The
+        first reply wins, the other call is left to finish in the
+        background. Without deadline, the hedged call is bounded by
+        THRIFTCLIENT_HEDGE_TIMEOUT.
+        """
+        expires = self._expires(None)
+        if expires is None:
+            expires = time.time() + self._config["THRIFTCLIENT_HEDGE_TIMEOUT"]
+        executor = self._get_hedger()
+        call = partial(self._run_on, partial(self._timed_attempt, name, args,
+                                             kwargs, policy), expires,
+                       self._caller_headers())
+        replies = Queue()
+        executor.submit(call).add_done_callback(replies.put)
+        pending = 1
+        after = min(after, max(expires - time.time(), 0))
+        try:
+            future = replies.get(True, after)
+        except Empty:
+            future = None
+            # a duplicate sent once the deadline is over would be useless
+            if time.time() < expires and self.retry_budget.withdraw():
+                executor.submit(call).add_done_callback(replies.put)
+                pending += 1
+        while True:
+            if future is None:
+                try:
+                    future = replies.get(True,
+                                         max(expires - time.time(), 0))
+                except Empty:
+                    raise DeadlineExceeded("Thrift deadline exceeded")
+            pending -= 1
+            # a failed call loses to a pending one
+            if pending == 0 or future.exception() is None:
+                return future.result()
+            future = None
+
+    def _timed_attempt(self, name, args, kwargs, policy, conn):
+        start = time.time()
+        result = self._attempt(conn, name, args, kwargs)
+        policy.observe(time.time() - start)
+        return result
+
+    def _coalesced(self, do, *args):
+        """
+        do(*args, timeout) may wait for the same call made by another
+        thread, the wait is bounded by the current deadline
+        """
+        try:
+            return do(*(args + (self._remaining(),)))
+        except ThriftTimeout:
+            # DeadlineExceeded if the wait was cut by the deadline
+            self._remaining()
+            raise
+
+    def _guard(self, conn, name, invoke):
+        """
+        runs invoke() on the connection, bounded by the current deadline and
+        accounted for in the health of the endpoint and in the metrics of
+        *name*
+        """
+        endpoint = conn.endpoint
+        if endpoint.breaker is not None and endpoint.breaker.isOpen():
+            raise CircuitOpenError("Circuit open for thrift server {url}"
+                                   .format(url=endpoint.url))
+
+        remaining = self._remaining()
+        if conn.broken:
+            # the late reply of a failed call must not be read by this one
+            self._reopen(conn)
+        conn.socket.limit(remaining)
+
+        endpoint.begin()
+        if conn.counter is not None:
+            conn.counter.reset()
+        error = None
+        start = time.time()
+        try:
+            result = invoke()
+        except socket.timeout:
+            endpoint.failure()
+            self._break(conn)
+            # socket timeouts are rounded to the millisecond, they may expire
+            # slightly early
+            elapsed = time.time() - start
+            if remaining is not None and elapsed >= remaining - 0.001:
+                error = DeadlineExceeded("Thrift deadline exceeded")
+            else:
+                error = ThriftTimeout(
+                    "Thrift server {url} timed out".format(url=endpoint.url))
+            raise error
+        except (TTransport.TTransportException, socket.error) as e:
+            endpoint.failure()
+            self._break(conn)
+            error = e
+            raise
+        except TProtocolException as e:
+            self._break(conn)
+            error = e
+            raise
+        except Exception as e:
+            error = e
+            raise
+        else:
+            endpoint.success(time.time() - start)
+            return result
+        finally:
+            endpoint.end()
+            if conn.recording is not None:
+                # replies of failed calls are cut or missing
+                if isinstance(error, (TTransport.TTransportException,
+                                      TProtocolException,
+                                      socket.error, ThriftTimeout)):
+                    conn.recording.discard()
+                else:
+                    conn.recording.save()
+            if self.metrics is not None:
+                self._measure(conn, name, time.time() - start, error)
+            if remaining is not None:
+                conn.socket.limit(None)
+
+    def _measure(self, conn, name, latency, error):
+        sent = received = None
+        if conn.counter is not None:
+            sent = conn.counter.bytes_written
+            received = conn.counter.bytes_read
+        self.metrics.call(name, conn.endpoint.url, latency, error, sent,
+                          received)
+
+    def _invoke(self, conn, names, invoke):
+        """
+        runs invoke(), once more on a reopened connection when the server had
+        closed it and the RPC methods *names* are all idempotent
+        """
+        try:
+            return invoke()
+        except (TTransport.TTransportException, socket.error) as e:
+            if not self._idempotent.issuperset(names) or not _is_stale(e):
+                raise
+
+        # the connection looked alive but the server had closed it
+        conn.close()
+        self._open(conn)
+        return invoke()
+
+    def _bindings(self):
+        """
+        connections in use, per application context (or per thread when used
+        outside of any context)
+        """
+        ctx = stack.top
+        if ctx is not None:
+            if not hasattr(ctx, "thriftclient_connections"):
+                ctx.thriftclient_connections = {}
+            return ctx.thriftclient_connections
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _batches(self):
+        """
+        batches of load() waiting to run, by batcher, per application context
+        (or per thread when used outside of any context)
+        """
+        ctx = stack.top
+        if ctx is not None:
+            if not hasattr(ctx, "thriftclient_batches"):
+                ctx.thriftclient_batches = {}
+            return ctx.thriftclient_batches.setdefault(self, {})
+        if not hasattr(self._local, "batches"):
+            self._local.batches = {}
+        return self._local.batches
+
+    def _current_connection(self):
+        """
+        returns the connection bound to the current context, creates it on
+        first use
+        """
+        assert(self._config is not None)
+        self._check_fork()
+
+        bindings = self._bindings()
+        conn = bindings.get(self)
+        if conn is not None:
+            return conn
+
+        # nothing would release the connection outside of a context, it is
+        # left to connect() or to the caller to open it
+        opened = self.alwaysConnect and stack.top is not None
+        conn = bindings[self] = self._new_connection(opened)
+        return conn
+
+    def _new_connection(self, opened):
+        """
+        returns a connection to one of the endpoints, pooled connections are
+        always opened
+        """
+        self._check_fork()
+        tried = []
+        while True:
+            # the probe of a half opened circuit is the connection, or the
+            # call opening it
+            endpoint = self._choose_endpoint(tried, reserve=opened)
+            if not opened:
+                return self._create_connection(self._config, endpoint)
+
+            remaining = self._remaining()
+            try:
+                if endpoint.pool is not None:
+                    timeout = endpoint.pool.timeout
+                    if remaining is not None and (timeout is None or
+                                                  remaining < timeout):
+                        timeout = remaining
+                    conn = endpoint.pool.checkout(timeout)
+                else:
+                    conn = self._create_connection(self._config, endpoint)
+                    conn.open()
+            except ThriftTimeout:
+                # DeadlineExceeded if the pool wait was cut by the deadline
+                self._remaining()
+                raise
+            except TTransport.TTransportException:
+                endpoint.failure()
+                self._remaining()
+                # nothing was sent yet, another endpoint may be tried
+                tried.append(endpoint)
+                if len(tried) == len(self.endpoints):
+                    raise RuntimeError("Unable to connect to thrift server")
+                continue
+            # lazy connections are told apart by their first call
+            if conn.socket.isOpen():
+                endpoint.connected()
+            return conn
+
+    def _choose_endpoint(self, tried, reserve=True):
+        """
+        chooses the endpoint of a new connection, endpoints which failed in
+        *tried* are skipped. A probe of half opened circuits is reserved
+        unless *reserve* is False.
+        """
+        if len(self.endpoints) == 1 and not self._health_checked:
+            return self.endpoints[0]
+
+        endpoints = [endpoint for endpoint in self.endpoints
+                     if endpoint not in tried]
+        # ejection is ignored when every endpoint is an outlier, the breakers
+        # are not
+        healthy = [endpoint for endpoint in endpoints
+                   if not endpoint.ejected()]
+        endpoints = healthy or endpoints
+        while True:
+            endpoints = [endpoint for endpoint in endpoints
+                         if endpoint.available()]
+            if not endpoints:
+                raise CircuitOpenError("No thrift server available")
+            endpoint = self.balancer.choose(endpoints)
+            if not reserve or endpoint.acquire():
+                return endpoint
+            # another thread took the last probe of a half opened circuit
+            endpoints.remove(endpoint)
+
+    def _open(self, conn):
+        endpoint = conn.endpoint
+        if not endpoint.acquire():
+            raise CircuitOpenError("Circuit open for thrift server {url}"
+                                   .format(url=endpoint.url))
+        try:
+            conn.open()
+        except TTransport.TTransportException:
+            endpoint.failure()
+            conn.close()
+            raise RuntimeError("Unable to connect to thrift server")
+        if conn.socket.isOpen():
+            endpoint.connected()
+
+    def _release(self, conn, exception=None):
+        if conn.pool is None:
+            conn.close()
+            return
+
+        # a connection which failed in the middle of a call may still hold
+        # part of a reply, it can't be reused, even when the failure was
+        # caught by the view
+        broken = conn.broken or isinstance(exception, (
+            TTransport.TTransportException, TProtocolException, socket.error,
+            ThriftTimeout))
+        conn.pool.checkin(conn, discard=broken)
+
     def _set_client(self, app, config):
-        # configure thrift thransport
-        if config["THRIFTCLIENT_TRANSPORT"] is None:
+        # configure thrift endpoints
+        urls = config["THRIFTCLIENT_TRANSPORT"]
+        if urls is None:
             raise RuntimeError("THRIFTCLIENT_TRANSPORT MUST be specified")
-        uri = urlparse(config["THRIFTCLIENT_TRANSPORT"])
+        if not isinstance(urls, (list, tuple)):
+            urls = [urls]
+        if not urls:
+            raise RuntimeError("THRIFTCLIENT_TRANSPORT MUST be specified")
+        self.endpoints = [Endpoint.from_url(url) for url in urls]
+
+        self.metrics = config["THRIFTCLIENT_METRICS"]
+
+        # TLS contexts and sessions, shared by the endpoints
+        self._tls_contexts = {}
+
+        # kept alive HTTP connections, shared by the endpoints
+        self._http_sessions = None
+        if config["THRIFTCLIENT_HTTP_KEEPALIVE"] == True:
+            from .http import HttpSessionPool
+            self._http_sessions = HttpSessionPool(
+                config["THRIFTCLIENT_HTTP_MAX_IDLE"])
+
+        # captures replayed by the endpoints, and the one recorded
+        self._captures = {}
+        self._recorder = None
+
+        # configure accelerated protocols
+        accelerated = config["THRIFTCLIENT_ACCELERATED"]
+        available = (
+            _accelerated_protocol(config["THRIFTCLIENT_PROTOCOL"]) is not None)
+        if accelerated == True and not available:
+            raise RuntimeError(
+                "THRIFTCLIENT_ACCELERATED: no accelerated {protocol} protocol "
+                "available".format(protocol=config["THRIFTCLIENT_PROTOCOL"]))
+        self.accelerated = available and accelerated != False
+
+        # fail fast on invalid configurations, connections are only built
+        # once they are used
+        self._validate(config)
+        self._config = config
+
+        if config["THRIFTCLIENT_RECORD"] is not None:
+            from .replay import Recorder
+            self._recorder = Recorder(config["THRIFTCLIENT_RECORD"])
+
+        self._pooled = config["THRIFTCLIENT_POOL"] == True
+        if self._pooled:
+            for endpoint in self.endpoints:
+                endpoint.pool = ConnectionPool(
+                    partial(self._create_connection, config, endpoint),
+                    min_size=config["THRIFTCLIENT_POOL_MIN_SIZE"],
+                    max_size=config["THRIFTCLIENT_POOL_MAX_SIZE"],
+                    timeout=config["THRIFTCLIENT_POOL_TIMEOUT"],
+                    idle_timeout=config["THRIFTCLIENT_POOL_IDLE_TIMEOUT"],
+                    max_lifetime=config["THRIFTCLIENT_POOL_MAX_LIFETIME"],
+                )
+                if self.metrics is not None:
+                    endpoint.pool.on_wait = partial(self.metrics.pool_wait,
+                                                    endpoint.url)
+            if len(self.endpoints) == 1:
+                self.pool = self.endpoints[0].pool
+        elif config["THRIFTCLIENT_WARM_UP"]:
+            raise RuntimeError("THRIFTCLIENT_WARM_UP needs THRIFTCLIENT_POOL")
+
+        # configure endpoints health tracking
+        for endpoint in self.endpoints:
+            if config["THRIFTCLIENT_BREAKER_THRESHOLD"] is not None:
+                endpoint.breaker = CircuitBreaker(
+                    threshold=config["THRIFTCLIENT_BREAKER_THRESHOLD"],
+                    reset_timeout=config["THRIFTCLIENT_BREAKER_RESET_TIMEOUT"],
+                    half_open_calls=config[
+                        "THRIFTCLIENT_BREAKER_HALF_OPEN_CALLS"],
+                )
+            if (config["THRIFTCLIENT_OUTLIER_ERRORS"] is not None or
+                    config["THRIFTCLIENT_OUTLIER_LATENCY"] is not None):
+                endpoint.outlier = OutlierDetector(
+                    consecutive_errors=config["THRIFTCLIENT_OUTLIER_ERRORS"],
+                    latency=config["THRIFTCLIENT_OUTLIER_LATENCY"],
+                    consecutive_slow=config["THRIFTCLIENT_OUTLIER_SLOW_CALLS"],
+                    ejection_time=config["THRIFTCLIENT_OUTLIER_EJECTION_TIME"],
+                )
+        self._health_checked = (
+            config["THRIFTCLIENT_BREAKER_THRESHOLD"] is not None)
+
+        # configure load balancing
+        balancer = config["THRIFTCLIENT_BALANCER"]
+        if balancer == ThriftClient.ROUND_ROBIN:
+            self.balancer = RoundRobinBalancer()
+        elif balancer == ThriftClient.LEAST_OUTSTANDING:
+            self.balancer = LeastOutstandingBalancer()
+        elif balancer == ThriftClient.POWER_OF_TWO:
+            self.balancer = PowerOfTwoBalancer()
+        elif balancer == ThriftClient.WEIGHTED:
+            self.balancer = WeightedBalancer()
+        elif hasattr(balancer, "choose"):
+            self.balancer = balancer
+        else:
+            raise RuntimeError(
+                "invalid configuration for THRIFTCLIENT_BALANCER: {balancer}"
+                .format(balancer=balancer)
+            )
+
+        # configure auto connection
+        self.alwaysConnect = config["THRIFTCLIENT_ALWAYS_CONNECT"]
+
+        self._single_flight = config["THRIFTCLIENT_SINGLE_FLIGHT"] == True
+
+        # unless told otherwise, every client of the process draws its
+        # retries from the same budget
+        budget = config["THRIFTCLIENT_RETRY_BUDGET"]
+        if budget is not None and not hasattr(budget, "withdraw"):
+            raise RuntimeError(
+                "invalid configuration for THRIFTCLIENT_RETRY_BUDGET: "
+                "{budget}".format(budget=budget))
+        self.retry_budget = budget if budget is not None else default_budget
+
+    def _validate(self, config):
+        """
+        checks what building the connections of *config* would check,
+        without building them
+        """
+        schemes = set(_parse_url(endpoint.url).scheme
+                      for endpoint in self.endpoints)
+
+        if _protocol_class(config["THRIFTCLIENT_PROTOCOL"]) is None:
+            raise RuntimeError(
+                "invalid configuration for THRIFTCLIENT_PROTOCOL: {protocol}"
+                .format(protocol=config["THRIFTCLIENT_PROTOCOL"])
+            )
+
+        if (config["THRIFTCLIENT_TCP_KEEPALIVE"] == True and
+                not schemes.issubset(_SOCKET_SCHEMES)):
+            raise RuntimeError(
+                "THRIFTCLIENT_TCP_KEEPALIVE is only available for socket "
+                "transports")
+
+        # as TSSLSocket does
+        if schemes & set(["tcps", "unixs"]):
+            ca_certs = config["THRIFTCLIENT_SSL_CA_CERTS"]
+            if config["THRIFTCLIENT_SSL_VALIDATE"] and (
+                    ca_certs is None or not os.access(ca_certs, os.R_OK)):
+                raise IOError(
+                    "Certificate Authority ca_certs file \"{ca_certs}\" is "
+                    "not readable, cannot validate SSL certificates."
+                    .format(ca_certs=ca_certs))
+            self._tls_context(config)
+        if "https" in schemes:
+            self._tls_context(config, https=True)
+
+        if "replay" in schemes:
+            if config["THRIFTCLIENT_RECORD"] is not None:
+                raise RuntimeError(
+                    "THRIFTCLIENT_RECORD can't record replayed calls")
+            for endpoint in self.endpoints:
+                uri = _parse_url(endpoint.url)
+                if uri.scheme == "replay":
+                    _replay_options(uri)
+                    if not os.access(uri.path, os.R_OK):
+                        raise IOError(
+                            "capture file \"{path}\" is not readable"
+                            .format(path=uri.path))
+
+        if (config["THRIFTCLIENT_FAST_FRAMED"] == True and
+                config["THRIFTCLIENT_FRAMED"] == True):
+            raise RuntimeError(
+                "THRIFTCLIENT_FAST_FRAMED replaces THRIFTCLIENT_FRAMED, only "
+                "one of them can be enabled")
+        if config["THRIFTCLIENT_COMPRESSION"] is not None:
+            if config["THRIFTCLIENT_ZLIB"] == True:
+                raise RuntimeError(
+                    "THRIFTCLIENT_COMPRESSION replaces THRIFTCLIENT_ZLIB, "
+                    "only one of them can be enabled")
+            from .compression import get_codec
+            get_codec(config["THRIFTCLIENT_COMPRESSION"],
+                      config["THRIFTCLIENT_COMPRESSION_LEVEL"])
+
+    def _tls_context(self, config, https=False):
+        """
+        the TLSContext of the tls sockets, or of https, built once per
+        configuration
+        """
+        context = self._tls_contexts.get(https)
+        if context is None:
+            from .tls import TLSContext
+            validate = config["THRIFTCLIENT_SSL_VALIDATE"] == True
+            context = self._tls_contexts[https] = TLSContext(
+                validate=validate,
+                ca_certs=config["THRIFTCLIENT_SSL_CA_CERTS"],
+                check_hostname=https and validate)
+        return context
+
+    def _capture(self, path):
+        """the Capture of the file *path*, mapped once per configuration"""
+        capture = self._captures.get(path)
+        if capture is None:
+            from .replay import Capture
+            capture = self._captures[path] = Capture(path)
+        return capture
+
+    def _create_connection(self, config, endpoint):
+        # configure thrift thransport
+        uri = _parse_url(endpoint.url)
         if uri.scheme == "tcp":
             port = uri.port or 9090
-            self.transport = TSocket.TSocket(uri.hostname, port)
+            transport = TClientSocket(uri.hostname, port)
         elif uri.scheme == "tcps":
+            from .tls import TClientSSLSocket
             port = uri.port or 9090
-            self.transport = TSSLSocket.TSSLSocket(
+            transport = TClientSSLSocket(
                 host=uri.hostname,
                 port=port,
                 validate=config["THRIFTCLIENT_SSL_VALIDATE"],
                 ca_certs=config["THRIFTCLIENT_SSL_CA_CERTS"],
             )
+            transport.tls = self._tls_context(config)
         elif uri.scheme in ["http", "https"]:
-            self.transport = THttpClient.THttpClient(
-                config["THRIFTCLIENT_TRANSPORT"])
+            from .http import TClientHttp, TClientHttpSession
+            headers = config["THRIFTCLIENT_HTTP_HEADERS"]
+            if callable(headers):
+                # workers use the headers computed by their caller
+                headers = self._http_headers
+            if config["THRIFTCLIENT_HTTP_KEEPALIVE"] == True:
+                transport = TClientHttpSession(
+                    endpoint.url, self._http_sessions,
+                    request_headers=headers,
+                    gzip=config["THRIFTCLIENT_HTTP_GZIP"] == True)
+            else:
+                transport = TClientHttp(endpoint.url)
+                transport.request_headers = headers
+            if uri.scheme == "https":
+                transport.tls = self._tls_context(config, https=True)
         elif uri.scheme == "unix":
-            if uri.hostname is not None:
-                raise RuntimeError(
-                    "unix socket MUST starts with either unix:/ or unix:///")
-            self.transport = TSocket.TSocket(unix_socket=uri.path)
-        elif uri.scheme == "unixs":
-            if uri.hostname is not None:
-                raise RuntimeError(
-                    "unixs socket MUST starts with either unixs:/ or unixs:///")
-            self.transport = TSSLSocket.TSSLSocket(
+            transport = TClientSocket(unix_socket=uri.path)
+        elif uri.scheme == "replay":
+            from .replay import TReplayTransport
+            transport = TReplayTransport(
+                self._capture(uri.path),
+                _protocol_class(config["THRIFTCLIENT_PROTOCOL"]),
+                **_replay_options(uri))
+        else:
+            from .tls import TClientSSLSocket
+            transport = TClientSSLSocket(
                 validate=config["THRIFTCLIENT_SSL_VALIDATE"],
                 ca_certs=config["THRIFTCLIENT_SSL_CA_CERTS"],
                 unix_socket=uri.path)
-        else:
-            raise RuntimeError(
-                "invalid configuration for THRIFTCLIENT_TRANSPORT: {transport}"
-                .format(transport=config["THRIFTCLIENT_TRANSPORT"])
+            transport.tls = self._tls_context(config)
+
+        transport.setTimeouts(config["THRIFTCLIENT_CONNECT_TIMEOUT"],
+                              config["THRIFTCLIENT_READ_TIMEOUT"])
+        # connections made under a deadline are bounded by it
+        transport.limit(self._remaining())
+
+        if config["THRIFTCLIENT_TCP_KEEPALIVE"] == True:
+            transport.keepalive = (
+                config["THRIFTCLIENT_TCP_KEEPALIVE_IDLE"],
+                config["THRIFTCLIENT_TCP_KEEPALIVE_INTERVAL"],
+                config["THRIFTCLIENT_TCP_KEEPALIVE_COUNT"],
             )
-
-        # configure additionnal protocol layers
-        if config["THRIFTCLIENT_BUFFERED"] == True:
-            self.transport = TTransport.TBufferedTransport(self.transport)
-        if config["THRIFTCLIENT_ZLIB"] == True:
-            self.transport = TZlibTransport.TZlibTransport(self.transport)
-        if config["THRIFTCLIENT_FRAMED"] == True:
-            self.transport = TTransport.TFramedTransport(self.transport)
+        socket_transport = transport
+
+        # count the bytes of each call and time the connections
+        counter = None
+        if config["THRIFTCLIENT_METRICS"] is not None:
+            if hasattr(transport, "on_connect"):
+                transport.on_connect = partial(
+                    config["THRIFTCLIENT_METRICS"].connect, endpoint.url)
+            transport = counter = TCountingTransport(transport)
+
+        # delay the connection until the first call
+        if config["THRIFTCLIENT_LAZY_CONNECT"] == True:
+            transport = TLazyTransport(transport)
+
+        # configure additionnal protocol layers, checked by _validate().
+        # Captures hold the messages of the protocol, replayed calls don't go
+        # through the layers.
+        replayed = uri.scheme == "replay"
+        if config["THRIFTCLIENT_BUFFERED"] == True and not replayed:
+            transport = TTransport.TBufferedTransport(transport)
+        if config["THRIFTCLIENT_ZLIB"] == True and not replayed:
+            from thrift.transport import TZlibTransport
+            transport = TZlibTransport.TZlibTransport(transport)
+        compression = None
+        if config["THRIFTCLIENT_COMPRESSION"] is not None and not replayed:
+            from .compression import TCompressedTransport, get_codec
+            transport = TCompressedTransport(
+                transport,
+                get_codec(config["THRIFTCLIENT_COMPRESSION"],
+                          config["THRIFTCLIENT_COMPRESSION_LEVEL"]),
+                config["THRIFTCLIENT_COMPRESSION_THRESHOLD"])
+            compression = transport.stats
+        if config["THRIFTCLIENT_FRAMED"] == True and not replayed:
+            transport = TTransport.TFramedTransport(transport)
+        if config["THRIFTCLIENT_FAST_FRAMED"] == True and not replayed:
+            transport = TFastFramedTransport(transport)
+
+        # record the messages of the calls
+        recording = None
+        if self._recorder is not None:
+            from .replay import TRecordingTransport
+            transport = recording = TRecordingTransport(
+                transport, self._recorder,
+                _protocol_class(config["THRIFTCLIENT_PROTOCOL"]))
 
         # configure thrift protocol
-        if config["THRIFTCLIENT_PROTOCOL"] == ThriftClient.BINARY:
-            self.protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
-        elif config["THRIFTCLIENT_PROTOCOL"] == ThriftClient.COMPACT:
-            self.protocol = TCompactProtocol.TCompactProtocol(self.transport)
-        elif config["THRIFTCLIENT_PROTOCOL"] == ThriftClient.JSON:
-            self.protocol = TJSONProtocol.TJSONProtocol(self.transport)
+        if self.accelerated:
+            protocol = _accelerated_protocol(
+                config["THRIFTCLIENT_PROTOCOL"])(transport)
         else:
-            raise RuntimeError(
-                "invalid configuration for THRIFTCLIENT_PROTOCOL: {protocol}"
-                .format(protocol=config["THRIFTCLIENT_PROTOCOL"])
-            )
+            protocol = _protocol_class(
+                config["THRIFTCLIENT_PROTOCOL"])(transport)
 
         # create the client from the interface
-        self.client = self.interface(self.protocol)
+        client = _make_client(self.interface, protocol,
+                              config["THRIFTCLIENT_MULTIPLEXED"])
+        conn = Connection(transport, protocol, client,
+                          socket=socket_transport, endpoint=endpoint,
+                          counter=counter, compression=compression,
+                          recording=recording)
+        conn.proxy = ClientProxy(self, conn)
+        return conn
 
-        # configure auto connection
-        self.alwaysConnect = config["THRIFTCLIENT_ALWAYS_CONNECT"]
+
+class AsyncThriftClient(ThriftClient):
+    """
+    ThriftClient whose RPC methods don't block: they return a Future and run
+    on a worker thread, each call on a connection of its own (checked out of
+    the pool when THRIFTCLIENT_POOL is enabled).
+
+    .. code:: python
+
+        user = thriftclient.client.getUser(1)
+        items = thriftclient.client.getItems(2)
+        return render(user.result(), items.result(timeout=1))
+    """
+
+    def __init__(self, interface, app=None, config=None):
+        self._futures = FutureClientProxy(self)
+        ThriftClient.__init__(self, interface, app, config)
+
+    @property
+    def client(self):
+        return self._futures
+
+
+class ThriftServices(object):
+    """
+    registry of the named thrift services of an application, each one with
+    its own interface and options, managed by a single extension:
+
+    .. code:: python
+
+        services = ThriftServices(app)
+        services.register("users", UserService.Client)
+        services.register("items", ItemService.Client,
+                          {"THRIFTCLIENT_TRANSPORT": "tcp://items:9090"})
+
+        user = services.users.getUser(1)
+
+    the options of a service are the THRIFTCLIENT_* keys of the application
+    config, overridden by its entry of THRIFTCLIENT_SERVICES, then by the
+    *config* given to register(). Services connect the first time they are
+    used in a context, and are released by a single teardown.
+
+    services registered with *shared* send their calls through the
+    TMultiplexedProtocol over a connection declared by shared(), they need a
+    server using TMultiplexedProcessor.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._services = OrderedDict()
+        self._shared = OrderedDict()
+        self._registrations = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault("THRIFTCLIENT_SERVICES", {})
+        for registration in self._registrations:
+            registration()
+
+        @app.teardown_appcontext
+        def teardown_appcontext(exception):
+            for client in self._connections():
+                client._teardown(exception)
+
+    def shared(self, name, config=None):
+        """
+        declares the connection *name*, shared by the services registered
+        with it
+        """
+        if name in self._shared:
+            raise RuntimeError(
+                "shared connection {name} is already declared".format(
+                    name=name))
+        self._shared[name] = ThriftClient(_no_client)
+        self._register(partial(self._configure, self._shared[name], name,
+                               config))
+
+    def register(self, name, interface, config=None, shared=None,
+                 multiplexed=None):
+        """
+        registers the service *name* of *interface*, with *shared* it uses
+        the connection of that name, as the service *multiplexed* (defaults
+        to *name*) of the server
+        """
+        if name in self._services or hasattr(ThriftServices, name):
+            raise RuntimeError(
+                "invalid service name: {name}".format(name=name))
+        if shared is None:
+            client = ThriftClient(interface)
+            self._register(partial(self._configure, client, name, config))
+        elif config is not None:
+            raise RuntimeError(
+                "services of a shared connection have its options")
+        elif shared not in self._shared:
+            raise RuntimeError(
+                "unknown shared connection: {shared}".format(shared=shared))
+        else:
+            client = _SharedThriftClient(interface, self._shared[shared],
+                                         multiplexed or name)
+            self._register(client._attach)
+        self._services[name] = client
+        return client
+
+    def __getitem__(self, name):
+        """the ThriftClient of the service *name*"""
+        return self._services[name]
+
+    def __getattr__(self, name):
+        services = self.__dict__.get("_services", {})
+        if name not in services:
+            raise AttributeError(name)
+        return services[name].client
+
+    def _register(self, registration):
+        self._registrations.append(registration)
+        if self.app is not None:
+            registration()
+
+    def _configure(self, client, name, config):
+        options = dict((key, value) for key, value in self.app.config.items()
+                       if key.startswith("THRIFTCLIENT_") and
+                       key != "THRIFTCLIENT_SERVICES")
+        options.update(self.app.config["THRIFTCLIENT_SERVICES"].get(name, {}))
+        options.update(config or {})
+        client._configure(self.app, options)
+
+    def _connections(self):
+        """the clients owning connections"""
+        for client in self._services.values():
+            if not isinstance(client, _SharedThriftClient):
+                yield client
+        for client in self._shared.values():
+            yield client
+
+
+class _SharedThriftClient(ThriftClient):
+    """
+    ThriftClient of a service using the connections of the ThriftClient
+    *owner* through the TMultiplexedProtocol, as the service *service*
+    """
+
+    def __init__(self, interface, owner, service):
+        ThriftClient.__init__(self, interface)
+        self._owner = owner
+        self.service = service
+
+    def _attach(self):
+        owner = self._owner
+        self.endpoints = owner.endpoints
+        self.balancer = owner.balancer
+        self.pool = owner.pool
+        self.metrics = owner.metrics
+        self.accelerated = owner.accelerated
+        self.alwaysConnect = owner.alwaysConnect
+        self._pooled = owner._pooled
+        self._health_checked = owner._health_checked
+        self._single_flight = owner._single_flight
+        self.retry_budget = owner.retry_budget
+        # the deadlines and the connections used outside of a context too
+        self._local = owner._local
+        self._config = owner._config
+
+    def connect(self):
+        return self._owner.connect()
+
+    def _forget_parent(self):
+        ThriftClient._forget_parent(self)
+        self._owner._check_fork()
+        self._local = self._owner._local
+
+    def _start_warm_up(self):
+        # the owner warms the shared connections up
+        self._warming = None
+        return None
+
+    def _current_connection(self):
+        return self._view(self._owner._current_connection())
+
+    def _new_connection(self, opened):
+        return self._view(self._owner._new_connection(opened))
+
+    def _release(self, conn, exception=None):
+        self._owner._release(conn.shared, exception)
+
+    def _break(self, conn):
+        # the owner's connection and every view of it share the transport
+        shared = conn.shared
+        ThriftClient._break(self, shared)
+        for view in shared.views.values():
+            view.broken = True
+
+    def _reopen(self, conn):
+        ThriftClient._reopen(self, conn)
+        shared = conn.shared
+        shared.broken = False
+        for view in shared.views.values():
+            view.broken = False
+
+    def _view(self, conn):
+        """the connection of the service on *conn*, of the owner"""
+        view = conn.views.get(self)
+        if view is None:
+            client = _make_client(self.interface, conn.protocol, self.service)
+            view = conn.views[self] = Connection(
+                conn.transport, conn.protocol, client, socket=conn.socket,
+                endpoint=conn.endpoint, counter=conn.counter,
+                compression=conn.compression, recording=conn.recording)
+            view.shared = conn
+            view.proxy = ClientProxy(self, view)
+        return view
+
+
+def _no_client(protocol):
+    """interface of the owners of shared connections"""
+    return None
+
+
+def _make_client(interface, protocol, service=None):
+    """
+    the client of *interface* on *protocol*, calling the service *service*
+    of a multiplexed server if given
+    """
+    if service is None:
+        return interface(protocol)
+    from thrift.protocol import TMultiplexedProtocol
+    return interface(protocol,
+                     TMultiplexedProtocol.TMultiplexedProtocol(protocol,
+                                                               service))
+
+
+def _accelerated_protocol(protocol):
+    """
+    the C accelerated class of *protocol*, None when it is not available
+    """
+    if fastbinary is None:
+        return None
+    if protocol == ThriftClient.BINARY:
+        return TBinaryProtocol.TBinaryProtocolAccelerated
+    if protocol == ThriftClient.COMPACT:
+        from thrift.protocol import TCompactProtocol
+        # thrift >= 0.10
+        return getattr(TCompactProtocol, "TCompactProtocolAccelerated", None)
+    return None
+
+
+def _protocol_class(protocol):
+    """the class of *protocol*, None when it is unknown"""
+    if protocol == ThriftClient.BINARY:
+        return TBinaryProtocol.TBinaryProtocol
+    if protocol == ThriftClient.COMPACT:
+        from thrift.protocol import TCompactProtocol
+        return TCompactProtocol.TCompactProtocol
+    if protocol == ThriftClient.JSON:
+        from thrift.protocol import TJSONProtocol
+        return TJSONProtocol.TJSONProtocol
+    return None
+
+
+_SOCKET_SCHEMES = ("tcp", "tcps", "unix", "unixs")
+_PATH_SCHEMES = ("unix", "unixs", "replay")
+
+
+def _parse_url(url):
+    """the parsed url of an endpoint, RuntimeError when it is invalid"""
+    uri = urlparse(url)
+    if uri.scheme not in _SOCKET_SCHEMES + ("http", "https", "replay"):
+        raise RuntimeError(
+            "invalid configuration for THRIFTCLIENT_TRANSPORT: {transport}"
+            .format(transport=url)
+        )
+    if uri.scheme in _PATH_SCHEMES and uri.hostname is not None:
+        raise RuntimeError(
+            "{scheme} socket MUST starts with either {scheme}:/ or "
+            "{scheme}:///".format(scheme=uri.scheme))
+    return uri
+
+
+def _replay_options(uri):
+    """
+    the latency, jitter and errors options of the replay url *uri*,
+    RuntimeError when they are invalid
+    """
+    options = {}
+    for key, values in parse_qs(uri.query, keep_blank_values=True).items():
+        if key not in ("latency", "jitter", "errors"):
+            raise RuntimeError(
+                "unknown replay option {key} in {path}".format(
+                    key=key, path=uri.path))
+        try:
+            value = float(values[-1])
+        except ValueError:
+            value = -1
+        if value < 0 or (key == "errors" and value > 1):
+            raise RuntimeError(
+                "invalid replay option {key}: {value}".format(
+                    key=key, value=values[-1]))
+        options[key] = value
+    return options
+
+
+def _is_stale(exception):
+    """
+    True when a call failed because the server had closed the connection
+    """
+    if isinstance(exception, TTransport.TTransportException):
+        return exception.type in (TTransport.TTransportException.NOT_OPEN,
+                                  TTransport.TTransportException.END_OF_FILE)
+    # socket.timeout has no errno, a slow server isn't a stale connection
+    return exception.errno in (errno.EPIPE, errno.ECONNRESET,
+                               errno.ECONNABORTED)
@@ -0,0 +1,155 @@
+# -*- coding:utf-8 -*-
+
+import re
+import random
+import threading
+
+from urlparse import urlparse, urlunparse, parse_qs
+
+
+_WEIGHT_PARAMETER = re.compile(r"(^|[&;])weight=[^&;]*")
+
+
+class Endpoint(object):
+    """
+    a thrift server the extension connects to
+
+    *outstanding* counts the calls currently waiting for a reply from this
+    server, the optional *breaker* (CircuitBreaker) and *outlier*
+    (OutlierDetector) track its health
+    """
+
+    def __init__(self, url, weight=1):
+        if weight <= 0:
+            raise RuntimeError(
+                "invalid weight for thrift endpoint {url}: {weight}"
+                .format(url=url, weight=weight))
+        self.url = url
+        self.weight = weight
+        self.pool = None
+        self.breaker = None
+        self.outlier = None
+        self.outstanding = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url):
+        """
+        builds an endpoint from an url, its weight is given by the optional
+        *weight* query parameter (tcp://10.0.0.1:9090?weight=3)
+        """
+        uri = urlparse(url)
+        weights = parse_qs(uri.query).get("weight")
+        if not weights:
+            return cls(url)
+        try:
+            weight = int(weights[-1])
+        except ValueError:
+            raise RuntimeError(
+                "invalid weight for thrift endpoint {url}: {weight}"
+                .format(url=url, weight=weights[-1]))
+        query = _WEIGHT_PARAMETER.sub("", uri.query).lstrip("&;")
+        return cls(urlunparse(uri._replace(query=query)), weight)
+
+    def ejected(self):
+        return self.outlier is not None and self.outlier.ejected()
+
+    def available(self):
+        return self.breaker is None or self.breaker.available()
+
+    def acquire(self):
+        return self.breaker is None or self.breaker.acquire()
+
+    def connected(self):
+        """
+        a connection was made, which tells nothing of the calls: only a
+        probe of the breaker is settled
+        """
+        if self.breaker is not None:
+            self.breaker.connected()
+
+    def success(self, latency=None):
+        if self.breaker is not None:
+            self.breaker.success()
+        if self.outlier is not None:
+            self.outlier.success(latency)
+
+    def failure(self):
+        if self.breaker is not None:
+            self.breaker.failure()
+        if self.outlier is not None:
+            self.outlier.failure()
+
+    def begin(self):
+        with self._lock:
+            self.outstanding += 1
+
+    def end(self):
+        with self._lock:
+            self.outstanding -= 1
+
+    def __repr__(self):
+        return "<Endpoint {url}>".format(url=self.url)
+
+
+class RoundRobinBalancer(object):
+    """picks endpoints in turn"""
+
+    def __init__(self):
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self, endpoints):
+        with self._lock:
+            index = self._next % len(endpoints)
+            self._next = index + 1
+        return endpoints[index]
+
+
+class LeastOutstandingBalancer(object):
+    """picks the endpoint with the fewest calls waiting for a reply"""
+
+    def choose(self, endpoints):
+        least = min(endpoint.outstanding for endpoint in endpoints)
+        # break ties randomly, or every idle worker would pick the first one
+        return random.choice([endpoint for endpoint in endpoints
+                              if endpoint.outstanding == least])
+
+
+class PowerOfTwoBalancer(object):
+    """
+    picks two endpoints at random and keeps the one with the fewest calls
+    waiting for a reply
+    """
+
+    def choose(self, endpoints):
+        if len(endpoints) == 1:
+            return endpoints[0]
+        first, second = random.sample(endpoints, 2)
+        if second.outstanding < first.outstanding:
+            return second
+        return first
+
+
+class WeightedBalancer(object):
+    """
+    smooth weighted round robin: an endpoint of weight 3 is picked three
+    times as often as an endpoint of weight 1, and picks are interleaved
+    """
+
+    def __init__(self):
+        self._current = {}
+        self._lock = threading.Lock()
+
+    def choose(self, endpoints):
+        total = 0
+        best = None
+        with self._lock:
+            for endpoint in endpoints:
+                current = self._current.get(endpoint, 0) + endpoint.weight
+                self._current[endpoint] = current
+                total += endpoint.weight
+                if best is None or current > self._current[best]:
+                    best = endpoint
+            self._current[best] -= total
+        return best
@@ -0,0 +1,151 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import threading
+from collections import OrderedDict
+
+from .futures import Future
+
+
+class Batcher(object):
+    """
+    turns calls of a point RPC method, taking a single key, into calls of the
+    batch method *method*, taking a list of keys. The batch method returns
+    either the results in the order of the keys, or a dict of the results by
+    key (missing keys get None).
+
+    keys are deduplicated and a batch call gets at most *max_size* keys.
+    load() defers the calls of a context until a result is needed, call()
+    waits *window* seconds for the calls of other threads.
+    """
+
+    def __init__(self, method, max_size=100, window=None):
+        if max_size < 1:
+            raise RuntimeError("batch max size MUST be at least 1")
+        self.method = method
+        self.max_size = max_size
+        self.window = window
+        self._collecting = None
+        self._lock = threading.Lock()
+
+    def load(self, key, dispatch, pending):
+        """
+        returns a future of the result of *key*, the keys loaded by a
+        context are given to dispatch(keys) once one of their results is
+        needed. *pending* holds the batches of the context, by batcher.
+        """
+        batch = pending.get(self)
+        if batch is None or batch.started:
+            batch = pending[self] = Batch(dispatch, self.max_size, lazy=True)
+        return batch.add(key)
+
+    def forget_parent(self):
+        """forgets the batch the parent of a fork was collecting"""
+        self._collecting = None
+        self._lock = threading.Lock()
+
+    def call(self, key, dispatch, timeout=None):
+        """
+        returns the result of *key*. The first caller waits *window* seconds
+        for the keys of other threads, or until *max_size* of them are
+        collected, then gives them to dispatch(keys). Others wait at most
+        *timeout* seconds for the result.
+        """
+        with self._lock:
+            batch = self._collecting
+            leader = batch is None
+            if leader:
+                batch = self._collecting = Batch(dispatch, self.max_size)
+            future = batch.add(key)
+            full = len(batch) >= self.max_size
+            if full:
+                self._collecting = None
+
+        if leader:
+            if not full:
+                batch.full.wait(self.window)
+                with self._lock:
+                    if self._collecting is batch:
+                        self._collecting = None
+            batch.run()
+        elif full:
+            batch.full.set()
+        return future.result(timeout)
+
+
+class Batch(object):
+    """keys collected for a batch call, and the futures of their results"""
+
+    def __init__(self, dispatch, max_size, lazy=False):
+        self.dispatch = dispatch
+        self.max_size = max_size
+        self.lazy = lazy
+        self.started = False
+        self.full = threading.Event()
+        self._futures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._futures)
+
+    def add(self, key):
+        future = self._futures.get(key)
+        if future is None:
+            future = self._futures[key] = (
+                _Load(self) if self.lazy else Future())
+        return future
+
+    def drop(self):
+        """fails the futures of a batch which never ran"""
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+        try:
+            raise RuntimeError("batch dropped at the end of its context")
+        except RuntimeError:
+            exc_info = sys.exc_info()
+        for future in self._futures.values():
+            future.set_exc_info(exc_info)
+
+    def run(self):
+        """dispatches the keys, once"""
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+
+        keys = list(self._futures)
+        for start in range(0, len(keys), self.max_size):
+            chunk = keys[start:start + self.max_size]
+            try:
+                results = self.dispatch(chunk)
+                if isinstance(results, dict):
+                    results = [results.get(key) for key in chunk]
+                elif len(results) != len(chunk):
+                    raise RuntimeError(
+                        "batch call returned {count} results for {keys} keys"
+                        .format(count=len(results), keys=len(chunk)))
+            except:
+                exc_info = sys.exc_info()
+                for key in chunk:
+                    self._futures[key].set_exc_info(exc_info)
+                continue
+            for key, result in zip(chunk, results):
+                self._futures[key].set_result(result)
+
+
+class _Load(Future):
+    """future running its batch when its result is needed"""
+
+    def __init__(self, batch):
+        Future.__init__(self)
+        self._batch = batch
+
+    def result(self, timeout=None):
+        self._batch.run()
+        return Future.result(self, timeout)
+
+    def exception(self, timeout=None):
+        self._batch.run()
+        return Future.exception(self, timeout)
@@ -0,0 +1,148 @@
+# -*- coding:utf-8 -*-
+
+import time
+import threading
+
+
+class CircuitOpenError(RuntimeError):
+    """raised instead of calling an endpoint whose circuit is open"""
+
+
+class CircuitBreaker(object):
+    """
+    stops using an endpoint after *threshold* consecutive failures
+
+    once opened, the circuit stays so for *reset_timeout* seconds, then it is
+    half opened: *half_open_calls* connections may probe the endpoint, the
+    circuit is closed again by a success and reopened by a failure. Probes
+    neither succeeding nor failing within *reset_timeout* seconds are given
+    up, so that others can be made.
+    """
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(self, threshold=5, reset_timeout=30, half_open_calls=1):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probes = 0
+        self._probed_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def isOpen(self):
+        """True while calls must fail immediately"""
+        return self.state == CircuitBreaker.OPEN
+
+    def available(self):
+        """True when a connection may be made, without reserving it"""
+        with self._lock:
+            state = self._current_state()
+            if state == CircuitBreaker.HALF_OPEN:
+                return self._probes < self.half_open_calls
+            return state == CircuitBreaker.CLOSED
+
+    def acquire(self):
+        """
+        reserves a connection, it is a probe when the circuit is half opened
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CircuitBreaker.HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    return False
+                self._probes += 1
+                self._probed_at = time.time()
+                return True
+            return state == CircuitBreaker.CLOSED
+
+    def connected(self):
+        """
+        a connection was made: it settles a probe of the half opened
+        circuit, without forgetting the failures of the calls
+        """
+        with self._lock:
+            if self._current_state() == CircuitBreaker.HALF_OPEN:
+                self._state = CircuitBreaker.CLOSED
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            if self._current_state() == CircuitBreaker.HALF_OPEN:
+                self._state = CircuitBreaker.CLOSED
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            state = self._current_state()
+            if (state == CircuitBreaker.HALF_OPEN or
+                    self._failures >= self.threshold):
+                self._state = CircuitBreaker.OPEN
+                self._opened_at = time.time()
+                self._probes = 0
+
+    def _current_state(self):
+        now = time.time()
+        if (self._state == CircuitBreaker.OPEN and
+                now - self._opened_at >= self.reset_timeout):
+            self._state = CircuitBreaker.HALF_OPEN
+            self._probes = 0
+        elif (self._state == CircuitBreaker.HALF_OPEN and self._probes and
+                now - self._probed_at >= self.reset_timeout):
+            # the probes were never settled
+            self._probes = 0
+        return self._state
+
+
+class OutlierDetector(object):
+    """
+    takes an endpoint out of rotation for *ejection_time* seconds after
+    *consecutive_errors* failed calls, or after *consecutive_slow* calls
+    slower than *latency* seconds
+    """
+
+    def __init__(self, consecutive_errors=None, latency=None,
+                 consecutive_slow=3, ejection_time=30):
+        self.consecutive_errors = consecutive_errors
+        self.latency = latency
+        self.consecutive_slow = consecutive_slow
+        self.ejection_time = ejection_time
+        self._errors = 0
+        self._slow = 0
+        self._ejected_until = 0
+        self._lock = threading.Lock()
+
+    def ejected(self):
+        return time.time() < self._ejected_until
+
+    def success(self, latency=None):
+        with self._lock:
+            self._errors = 0
+            if (self.latency is not None and latency is not None and
+                    latency > self.latency):
+                self._slow += 1
+            else:
+                self._slow = 0
+            self._check()
+
+    def failure(self):
+        with self._lock:
+            self._errors += 1
+            self._check()
+
+    def _check(self):
+        if ((self.consecutive_errors is not None and
+             self._errors >= self.consecutive_errors) or
+                (self.latency is not None and
+                 self._slow >= self.consecutive_slow)):
+            self._ejected_until = time.time() + self.ejection_time
+            self._errors = 0
+            self._slow = 0
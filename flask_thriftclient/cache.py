@@ -0,0 +1,111 @@
+# -*- coding:utf-8 -*-
+
+import time
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from .singleflight import SingleFlight, args_struct, call_key
+
+
+class MemoryBackend(object):
+    """
+    in process cache backend keeping at most *maxsize* entries, the least
+    recently used entry is evicted first
+
+    shared backends (memcached, redis...) implement the same get, set,
+    delete and clear methods, they are given string keys and have to
+    serialize the entries themselves.
+    """
+
+    def __init__(self, maxsize=1024):
+        if maxsize < 1:
+            raise RuntimeError("cache max size MUST be at least 1")
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """returns the entry of *key*, None if there is none"""
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires is not None and expires <= time.time():
+                return None
+            # most recently used entries are at the end
+            self._entries[key] = item
+            return entry
+
+    def set(self, key, entry, ttl=None):
+        """stores *entry* for *ttl* seconds, None: until evicted"""
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, entry)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class Cache(object):
+    """
+    results of the RPC method *method* of *interface*, kept in *backend* for
+    *ttl* seconds and keyed by the serialized arguments of the calls
+
+    concurrent calls with the same arguments share the call made by the
+    first one, failed calls are not cached.
+    """
+
+    def __init__(self, interface, method, ttl=None, backend=None):
+        # fail fast on clients without argument structs
+        args_struct(interface, method)
+        self.interface = interface
+        self.method = method
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._flights = SingleFlight()
+
+    def key(self, args, kwargs):
+        return call_key(self.interface, self.method, args, kwargs)
+
+    def call(self, args, kwargs, call, timeout=None):
+        """
+        returns the cached result of the call with *args* and *kwargs*, or
+        the result of call() which is then cached. Waiting for the same call
+        made by another thread is bounded by *timeout*.
+        """
+        key = self.key(args, kwargs)
+        # the result is wrapped, so that None results are cached too
+        entry = self.backend.get(key)
+        if entry is not None:
+            return entry[0]
+        return self._flights.do(key, partial(self._call, key, call), timeout)
+
+    def _call(self, key, call):
+        result = call()
+        self.backend.set(key, (result,), self.ttl)
+        return result
+
+    def invalidate(self, *args, **kwargs):
+        """drops the result of the call with *args* and *kwargs*"""
+        self.backend.delete(self.key(args, kwargs))
+
+    def clear(self):
+        """drops every result of the backend"""
+        self.backend.clear()
+
+    def forget_parent(self):
+        """forgets the calls the parent of a fork had in flight"""
+        self._flights = SingleFlight()
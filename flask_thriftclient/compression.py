@@ -0,0 +1,258 @@
+# -*- coding:utf-8 -*-
+
+import bz2
+import zlib
+from struct import pack, unpack
+from cStringIO import StringIO
+from timeit import default_timer
+
+from thrift.transport import TTransport
+
+
+class ZlibCodec(object):
+    name = "zlib"
+
+    def __init__(self, level=None):
+        self.level = 6 if level is None else level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class Bz2Codec(object):
+    name = "bz2"
+
+    def __init__(self, level=None):
+        self.level = 9 if level is None else level
+
+    def compress(self, data):
+        return bz2.compress(data, self.level)
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+
+class Lz4Codec(object):
+    """needs the lz4 package"""
+    name = "lz4"
+
+    def __init__(self, level=None):
+        import lz4.frame
+        self._lz4 = lz4.frame
+        self.level = 0 if level is None else level
+
+    def compress(self, data):
+        return self._lz4.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return self._lz4.decompress(data)
+
+
+class ZstdCodec(object):
+    """needs the zstandard package"""
+    name = "zstd"
+
+    def __init__(self, level=None):
+        import zstandard
+        self.level = 3 if level is None else level
+        self._compressor = zstandard.ZstdCompressor(level=self.level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+class SnappyCodec(object):
+    """needs the python-snappy package, snappy has no level"""
+    name = "snappy"
+
+    def __init__(self, level=None):
+        import snappy
+        self._snappy = snappy
+        self.level = None
+
+    def compress(self, data):
+        return self._snappy.compress(data)
+
+    def decompress(self, data):
+        return self._snappy.decompress(data)
+
+
+CODECS = {
+    ZlibCodec.name: ZlibCodec,
+    Bz2Codec.name: Bz2Codec,
+    Lz4Codec.name: Lz4Codec,
+    ZstdCodec.name: ZstdCodec,
+    SnappyCodec.name: SnappyCodec,
+}
+
+
+def get_codec(codec, level=None):
+    """
+    returns the codec named *codec* at *level*, objects with compress(data)
+    and decompress(data) methods are returned as is
+    """
+    if hasattr(codec, "compress") and hasattr(codec, "decompress"):
+        return codec
+    if codec not in CODECS:
+        raise RuntimeError(
+            "invalid configuration for THRIFTCLIENT_COMPRESSION: {codec}"
+            .format(codec=codec))
+    try:
+        return CODECS[codec](level)
+    except ImportError as e:
+        raise RuntimeError(
+            "THRIFTCLIENT_COMPRESSION: {codec} is not available, {error}"
+            .format(codec=codec, error=e))
+
+
+class CompressionStats(object):
+    """
+    measures of the compression of a connection: frames sent and received,
+    how many of them were compressed, their size before and after
+    compression, and the seconds spent in the codec
+    """
+
+    def __init__(self):
+        self.frames_sent = 0
+        self.frames_compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0
+        self.frames_received = 0
+        self.frames_decompressed = 0
+        self.bytes_received = 0
+        self.bytes_decompressed = 0
+        self.decompress_time = 0
+
+    @property
+    def ratio(self):
+        """size of the frames sent on the wire over their original size"""
+        if self.bytes_in == 0:
+            return None
+        return float(self.bytes_out) / self.bytes_in
+
+    def snapshot(self):
+        return {
+            "frames_sent": self.frames_sent,
+            "frames_compressed": self.frames_compressed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "compress_time": self.compress_time,
+            "frames_received": self.frames_received,
+            "frames_decompressed": self.frames_decompressed,
+            "bytes_received": self.bytes_received,
+            "bytes_decompressed": self.bytes_decompressed,
+            "decompress_time": self.decompress_time,
+            "ratio": self.ratio,
+        }
+
+
+class TCompressedTransport(TTransport.TTransportBase,
+                           TTransport.CReadableTransport):
+    """
+    wraps a transport and sends each flushed message as a frame compressed
+    by *codec*, messages shorter than *threshold* bytes are sent raw. A
+    frame is its size and a flag telling whether it is compressed, followed
+    by the payload.
+
+    servers need the same transport, see TCompressedTransportFactory.
+    """
+
+    def __init__(self, trans, codec=None, threshold=1024, stats=None):
+        self.__trans = trans
+        self.codec = codec if codec is not None else ZlibCodec()
+        self.threshold = threshold
+        self.stats = stats if stats is not None else CompressionStats()
+        self.__rbuf = StringIO()
+        self.__wbuf = StringIO()
+
+    def isOpen(self):
+        return self.__trans.isOpen()
+
+    def open(self):
+        return self.__trans.open()
+
+    def close(self):
+        return self.__trans.close()
+
+    def read(self, sz):
+        ret = self.__rbuf.read(sz)
+        if len(ret) != 0:
+            return ret
+
+        self.readFrame()
+        return self.__rbuf.read(sz)
+
+    def readFrame(self):
+        sz, compressed = unpack("!iB", self.__trans.readAll(5))
+        payload = self.__trans.readAll(sz)
+        stats = self.stats
+        stats.frames_received += 1
+        stats.bytes_received += sz + 5
+        if compressed == 1:
+            start = default_timer()
+            payload = self.codec.decompress(payload)
+            stats.decompress_time += default_timer() - start
+            stats.frames_decompressed += 1
+        elif compressed != 0:
+            raise TTransport.TTransportException(
+                message="unknown compression flag {flag}".format(
+                    flag=compressed))
+        stats.bytes_decompressed += len(payload)
+        self.__rbuf = StringIO(payload)
+
+    def write(self, buf):
+        self.__wbuf.write(buf)
+
+    def flush(self):
+        payload = self.__wbuf.getvalue()
+        # reset wbuf before write/flush to preserve state on underlying
+        # failure
+        self.__wbuf = StringIO()
+        stats = self.stats
+        stats.frames_sent += 1
+        stats.bytes_in += len(payload)
+        compressed = 0
+        if len(payload) >= self.threshold:
+            start = default_timer()
+            data = self.codec.compress(payload)
+            stats.compress_time += default_timer() - start
+            # incompressible payloads are sent raw
+            if len(data) < len(payload):
+                payload = data
+                compressed = 1
+                stats.frames_compressed += 1
+        stats.bytes_out += len(payload) + 5
+        self.__trans.write(pack("!iB", len(payload), compressed) + payload)
+        self.__trans.flush()
+
+    # Implement the CReadableTransport interface.
+    @property
+    def cstringio_buf(self):
+        return self.__rbuf
+
+    def cstringio_refill(self, prefix, reqlen):
+        # fastbinary only asks for a refill once the buffer is empty
+        while len(prefix) < reqlen:
+            self.readFrame()
+            prefix += self.__rbuf.getvalue()
+        self.__rbuf = StringIO(prefix)
+        return self.__rbuf
+
+
+class TCompressedTransportFactory:
+    """transport factory of the servers of TCompressedTransport clients"""
+
+    def __init__(self, codec="zlib", level=None, threshold=1024):
+        self.codec = get_codec(codec, level)
+        self.threshold = threshold
+
+    def getTransport(self, trans):
+        return TCompressedTransport(trans, self.codec, self.threshold)
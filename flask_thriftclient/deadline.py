@@ -0,0 +1,9 @@
+# -*- coding:utf-8 -*-
+
+
+class ThriftTimeout(RuntimeError):
+    """raised when a thrift server or the connection pool is too slow"""
+
+
+class DeadlineExceeded(ThriftTimeout):
+    """raised when the deadline given to ThriftClient.deadline() is exceeded"""
@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import threading
+from Queue import Queue
+
+from .deadline import ThriftTimeout
+
+
+class Future(object):
+    """
+    result of a function running in a ThreadPool
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        waits at most *timeout* seconds (None: forever) for the result,
+        raises the exception of the function if it failed
+        """
+        if not self._done.wait(timeout):
+            raise ThriftTimeout("Timed out waiting for a thrift call")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise ThriftTimeout("Timed out waiting for a thrift call")
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """calls *callback* with the future once it is done"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class ThreadPool(object):
+    """
+    runs functions on at most *max_workers* daemon threads, started on
+    demand
+    """
+
+    def __init__(self, max_workers=10):
+        if max_workers < 1:
+            raise RuntimeError("thread pool max workers MUST be at least 1")
+        self.max_workers = max_workers
+        self._queue = Queue()
+        self._threads = []
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._idle == 0 and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            else:
+                self._idle -= 1
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except:
+                future.set_exc_info(sys.exc_info())
+            # drop the references before waiting for the next job
+            future = fn = args = kwargs = None
+            with self._lock:
+                self._idle += 1
@@ -0,0 +1,370 @@
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import time
+import zlib
+import errno
+import socket
+import urllib
+import httplib
+import urlparse
+import threading
+from cStringIO import StringIO
+
+from thrift.transport import TTransport, THttpClient
+
+from .pool import is_alive
+from .transports import _Timeouts
+
+
+class TClientHttp(_Timeouts, THttpClient.THttpClient):
+    """
+    THttpClient with the timeouts of the extension, as THttpClient has a
+    single timeout the read timeout is used, or the connect timeout if there
+    is none. The timeout is the one of the connection, THttpClient sets it
+    as the default timeout of the process for each request.
+
+    *request_headers* is None, a dict of headers added to every request or
+    a callable returning such a dict, called for each request. https
+    connections use the context of *tls*, a TLSContext, when given, and
+    count their handshakes in it.
+    """
+    request_headers = None
+    tls = None
+    _timeout = None
+
+    def open(self):
+        if self.scheme == "http":
+            http = httplib.HTTP(self.host, self.port)
+        elif self.tls is not None:
+            http = _HTTPS(self.host, self.port, context=self.tls.context)
+            # httplib connects when the request is sent
+            http._conn.tls = self.tls
+        else:
+            http = httplib.HTTPS(self.host, self.port)
+        http._conn.timeout = self._timeout
+        self._THttpClient__http = http
+
+    def flush(self):
+        if self.isOpen():
+            self.close()
+        self.open()
+        http = self._THttpClient__http
+        data = self._THttpClient__wbuf.getvalue()
+        self._THttpClient__wbuf = StringIO()
+
+        headers = {}
+        if self.request_headers is not None:
+            headers = _request_headers(self.request_headers)
+        http.putrequest("POST", self.path)
+        http.putheader("Host", self.host)
+        http.putheader("Content-Type", "application/x-thrift")
+        http.putheader("Content-Length", str(len(data)))
+        if "User-Agent" not in headers:
+            user_agent = "Python/THttpClient"
+            script = os.path.basename(sys.argv[0])
+            if script:
+                user_agent += " ({script})".format(script=urllib.quote(script))
+            http.putheader("User-Agent", user_agent)
+        for name, value in headers.items():
+            http.putheader(name, value)
+        http.endheaders()
+        http.send(data)
+        self.code, self.message, self.headers = http.getreply()
+
+    def _apply_timeouts(self):
+        self._timeout = _http_timeout(self)
+        http = self._THttpClient__http
+        if http is not None:
+            http._conn.timeout = self._timeout
+            if http._conn.sock is not None:
+                http._conn.sock.settimeout(self._timeout)
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """HTTPSConnection counting its handshakes in *tls*"""
+    tls = None
+
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        if self.tls is not None:
+            self.tls.handshaked()
+
+
+class _HTTPS(httplib.HTTPS):
+    _connection_class = _HTTPSConnection
+
+
+class HttpSessionPool(object):
+    """
+    idle HTTP/1.1 connections kept alive for reuse, at most *max_idle* per
+    (scheme, host, port). A pool inherited through fork() forgets the
+    connections of the parent process.
+    """
+
+    def __init__(self, max_idle=10):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self, key):
+        """
+        returns an idle connection to *key*, None if there is none. The
+        connections closed by their server meanwhile are dropped.
+        """
+        self._check_fork()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return None
+                conn = idle.pop()
+            if is_alive(conn.sock):
+                return conn
+            conn.close()
+
+    def put(self, key, conn):
+        """keeps *conn* for reuse, closes it when there are enough"""
+        self._check_fork()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        """closes every idle connection"""
+        self._check_fork()
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _check_fork(self):
+        pid = os.getpid()
+        if pid == self._pid:
+            return
+        idle, self._idle = self._idle, {}
+        self._lock = threading.Lock()
+        self._pid = pid
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class TClientHttpSession(_Timeouts, TTransport.TTransportBase):
+    """
+    HTTP transport sending each call as a POST over a HTTP/1.1 connection
+    kept alive in *sessions*, a HttpSessionPool, for the next calls
+
+    the request headers and body are sent at once, the response body is
+    read as the protocol decodes it and its connection goes back to
+    *sessions* once it is entirely read. With *gzip*, gzip encoded responses
+    are accepted. *request_headers* and *tls* are as for TClientHttp,
+    *on_connect* is None or called with the duration of each new connection.
+    """
+    on_connect = None
+    tls = None
+
+    def __init__(self, uri, sessions, request_headers=None, gzip=False):
+        parsed = urlparse.urlparse(uri)
+        if parsed.scheme not in ("http", "https"):
+            raise RuntimeError(
+                "invalid HTTP url: {uri}".format(uri=uri))
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port or (httplib.HTTP_PORT if self.scheme == "http"
+                                    else httplib.HTTPS_PORT)
+        self.path = parsed.path or "/"
+        if parsed.query:
+            self.path += "?" + parsed.query
+        self.key = (self.scheme, self.host, self.port)
+        self.sessions = sessions
+        self.request_headers = request_headers
+        self.gzip = gzip
+        self._timeout = None
+        self.__opened = False
+        self.__wbuf = StringIO()
+        self.__http = None
+        self.__response = None
+        self.__decompressor = None
+        self.__rbuf = StringIO()
+
+    def isOpen(self):
+        return self.__opened
+
+    def open(self):
+        # connections are taken from the sessions by each request
+        self.__opened = True
+
+    def close(self):
+        self.__opened = False
+        self.__drop()
+
+    def read(self, sz):
+        # decompressed data left
+        buf = self.__rbuf.read(sz)
+        if buf:
+            return buf
+        if self.__response is None:
+            raise TTransport.TTransportException(
+                type=TTransport.TTransportException.END_OF_FILE,
+                message="No HTTP response to read")
+        if self.__decompressor is None:
+            buf = self.__response.read(sz)
+        else:
+            while not buf and not self.__response.isclosed():
+                data = self.__decompressor.decompress(
+                    self.__response.read(16384))
+                if self.__response.isclosed():
+                    data += self.__decompressor.flush()
+                self.__rbuf = StringIO(data)
+                buf = self.__rbuf.read(sz)
+        if self.__response.isclosed():
+            self.__release()
+        return buf
+
+    def write(self, buf):
+        self.__wbuf.write(buf)
+
+    def flush(self):
+        data = self.__wbuf.getvalue()
+        self.__wbuf = StringIO()
+        # the response of the previous call was not read entirely
+        self.__drop()
+
+        headers = {
+            "Host": self.host,
+            "Content-Type": "application/x-thrift",
+            "Content-Length": str(len(data)),
+            "User-Agent": "Python/TClientHttpSession",
+        }
+        if self.gzip:
+            headers["Accept-Encoding"] = "gzip"
+        if self.request_headers is not None:
+            headers.update(_request_headers(self.request_headers))
+
+        http = self.sessions.get(self.key)
+        if http is None:
+            http = self.__connect()
+        elif self.__request(http, data, headers):
+            return
+        else:
+            # the server closed the kept alive connection before the request
+            # was sent
+            http = self.__connect()
+        self.__request(http, data, headers, retry=False)
+
+    def __connect(self):
+        if self.scheme == "http":
+            http = httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self._timeout)
+        else:
+            context = None if self.tls is None else self.tls.context
+            http = httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=self._timeout,
+                                           context=context)
+        start = time.time()
+        try:
+            http.connect()
+        except socket.error as e:
+            http.close()
+            raise TTransport.TTransportException(
+                type=TTransport.TTransportException.NOT_OPEN,
+                message="Could not connect to {host}:{port}: {error}".format(
+                    host=self.host, port=self.port, error=e))
+        if self.on_connect is not None:
+            self.on_connect(time.time() - start)
+        if self.tls is not None and self.scheme == "https":
+            self.tls.handshaked()
+        return http
+
+    def __request(self, http, data, headers, retry=True):
+        """
+        sends the request on *http*, returns False when a reused connection
+        was closed by the server before the request was sent and *retry* is
+        set. Once sent, the request may have been processed: it is not sent
+        again, that is left to the retry policy of the method.
+        """
+        http.sock.settimeout(self._timeout)
+        try:
+            http.putrequest("POST", self.path, skip_host=True,
+                            skip_accept_encoding=True)
+            for name, value in headers.items():
+                http.putheader(name, value)
+            # the body is sent along with the headers, avoiding a small
+            # write delayed by Nagle's algorithm
+            http.endheaders(data)
+        except socket.error as e:
+            http.close()
+            if retry and _is_reset(e):
+                return False
+            raise
+        try:
+            response = http.getresponse()
+        except (httplib.BadStatusLine, socket.error) as e:
+            http.close()
+            if isinstance(e, httplib.BadStatusLine) or _is_reset(e):
+                raise TTransport.TTransportException(
+                    type=TTransport.TTransportException.END_OF_FILE,
+                    message="HTTP connection closed without response")
+            raise
+
+        self.__http = http
+        self.__response = response
+        if response.status != 200:
+            response.read()
+            self.__release()
+            raise TTransport.TTransportException(
+                message="HTTP {status} {reason}".format(
+                    status=response.status, reason=response.reason))
+        self.__decompressor = None
+        self.__rbuf = StringIO()
+        if response.getheader("Content-Encoding") == "gzip":
+            self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return True
+
+    def __release(self):
+        """gives the connection of an entirely read response back"""
+        http, response = self.__http, self.__response
+        self.__http = self.__response = None
+        if response.will_close:
+            http.close()
+        else:
+            self.sessions.put(self.key, http)
+
+    def __drop(self):
+        """closes the connection of a response which was not read"""
+        if self.__http is not None:
+            self.__http.close()
+        self.__http = self.__response = None
+
+    def _apply_timeouts(self):
+        self._timeout = _http_timeout(self)
+        if self.__http is not None and self.__http.sock is not None:
+            self.__http.sock.settimeout(self._timeout)
+
+
+def _http_timeout(trans):
+    """
+    HTTP transports have a single timeout: the read timeout, or the connect
+    timeout if there is none
+    """
+    timeout = trans.read_timeout
+    if timeout is None:
+        timeout = trans.connect_timeout
+    return trans._bounded(timeout)
+
+
+def _request_headers(headers):
+    if callable(headers):
+        return headers()
+    return headers
+
+
+def _is_reset(error):
+    return getattr(error, "errno", None) in (errno.ECONNRESET, errno.EPIPE)
@@ -0,0 +1,216 @@
+# -*- coding:utf-8 -*-
+
+import bisect
+import threading
+
+from flask import current_app, has_app_context
+from flask.signals import Namespace
+
+
+_signals = Namespace()
+
+#: sent after each RPC call with method, endpoint, latency, error, sent and
+#: received
+call_finished = _signals.signal("thriftclient-call-finished")
+#: sent once a connection is made with endpoint, duration and handshake
+connection_opened = _signals.signal("thriftclient-connection-opened")
+#: sent after each pool checkout with endpoint and duration
+pool_waited = _signals.signal("thriftclient-pool-waited")
+
+
+class MetricsSink(object):
+    """
+    receives the measures of the extension, set THRIFTCLIENT_METRICS to an
+    instance to enable them. This base class ignores every measure,
+    subclasses override the ones they record.
+
+    durations are given in seconds, *endpoint* is the url of the server
+    """
+
+    def call(self, method, endpoint, latency, error=None, sent=None,
+             received=None):
+        """
+        a RPC call is over, *error* is the exception it raised if any, *sent*
+        and *received* are the bytes it wrote and read below the buffered,
+        zlib and framed layers
+        """
+
+    def connect(self, endpoint, duration, handshake=None):
+        """
+        a connection was made in *duration* seconds, *handshake* is the TLS
+        handshake part of it (None without TLS)
+        """
+
+    def pool_wait(self, endpoint, duration):
+        """a connection was checked out of the pool after *duration*"""
+
+
+class Histogram(object):
+    """
+    counts values in buckets, *buckets* are the sorted upper bounds of all
+    buckets but the last one which has no bound
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+               2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """
+        upper bound of the bucket holding the *percent* percentile, None when
+        it is in the last bucket or the histogram is empty
+        """
+        if self.count == 0:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class MethodMetrics(object):
+    """measures of the calls of a RPC method"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.sent = 0
+        self.received = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "sent": self.sent,
+            "received": self.received,
+            "latency": self.latency.snapshot(),
+        }
+
+
+class MetricsRegistry(MetricsSink):
+    """
+    keeps the measures in memory, per RPC method, snapshot() returns them as
+    a dict which can be serialized to JSON
+    """
+
+    def __init__(self):
+        self.methods = {}
+        self.connects = Histogram()
+        self.handshakes = Histogram()
+        self.pool_waits = Histogram()
+        self._lock = threading.Lock()
+
+    def call(self, method, endpoint, latency, error=None, sent=None,
+             received=None):
+        with self._lock:
+            metrics = self.methods.get(method)
+            if metrics is None:
+                metrics = self.methods[method] = MethodMetrics()
+            metrics.calls += 1
+            metrics.latency.observe(latency)
+            if error is not None:
+                metrics.errors += 1
+            metrics.sent += sent or 0
+            metrics.received += received or 0
+
+    def connect(self, endpoint, duration, handshake=None):
+        with self._lock:
+            self.connects.observe(duration)
+            if handshake is not None:
+                self.handshakes.observe(handshake)
+
+    def pool_wait(self, endpoint, duration):
+        with self._lock:
+            self.pool_waits.observe(duration)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "methods": dict((method, metrics.snapshot())
+                                for method, metrics in self.methods.items()),
+                "connects": self.connects.snapshot(),
+                "handshakes": self.handshakes.snapshot(),
+                "pool_waits": self.pool_waits.snapshot(),
+            }
+
+
+class StatsdSink(MetricsSink):
+    """
+    forwards the measures to StatsD style callbacks: *timing(name, ms)* and
+    *increment(name, value)*, names are prefixed by *prefix*
+
+    sink = StatsdSink(statsd.timing, statsd.incr)
+    """
+
+    def __init__(self, timing, increment, prefix="thriftclient"):
+        self.timing = timing
+        self.increment = increment
+        self.prefix = prefix
+
+    def call(self, method, endpoint, latency, error=None, sent=None,
+             received=None):
+        name = "{prefix}.call.{method}".format(prefix=self.prefix,
+                                               method=method)
+        self.timing(name, latency * 1000.0)
+        if error is not None:
+            self.increment(name + ".errors", 1)
+        if sent is not None:
+            self.increment(name + ".sent", sent)
+        if received is not None:
+            self.increment(name + ".received", received)
+
+    def connect(self, endpoint, duration, handshake=None):
+        self.timing(self.prefix + ".connect", duration * 1000.0)
+        if handshake is not None:
+            self.timing(self.prefix + ".handshake", handshake * 1000.0)
+
+    def pool_wait(self, endpoint, duration):
+        self.timing(self.prefix + ".pool_wait", duration * 1000.0)
+
+
+class SignalSink(MetricsSink):
+    """
+    sends the measures as the Flask signals call_finished,
+    connection_opened and pool_waited, the sender is the current
+    application (None outside of a context). Receiving them needs blinker.
+    """
+
+    def call(self, method, endpoint, latency, error=None, sent=None,
+             received=None):
+        call_finished.send(_sender(), method=method, endpoint=endpoint,
+                           latency=latency, error=error, sent=sent,
+                           received=received)
+
+    def connect(self, endpoint, duration, handshake=None):
+        connection_opened.send(_sender(), endpoint=endpoint,
+                               duration=duration, handshake=handshake)
+
+    def pool_wait(self, endpoint, duration):
+        pool_waited.send(_sender(), endpoint=endpoint, duration=duration)
+
+
+def _sender():
+    if has_app_context():
+        return current_app._get_current_object()
+    return None
@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+
+from thrift.Thrift import TException
+from thrift.transport.TTransport import TTransportException
+from thrift.protocol.TProtocol import TProtocolException
+
+
+class Pipeline(object):
+    """
+    queues RPC calls of the current connection, execute() sends them back to
+    back and then reads their replies, matched by seqid
+
+    replies are expected in the order of the calls unless *ordered* is
+    False, servers answering out of order are then supported too.
+    """
+
+    def __init__(self, thriftclient, ordered=True):
+        self._thriftclient = thriftclient
+        self.ordered = ordered
+        self._calls = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __getattr__(self, name):
+        attr = getattr(self._thriftclient.interface, name)
+        if (name.startswith("_") or name.startswith("send_") or
+                name.startswith("recv_") or not callable(attr)):
+            raise AttributeError(
+                "{name} is not a RPC method of {interface}".format(
+                    name=name, interface=self._thriftclient.interface))
+
+        calls = self._calls
+
+        def call(*args, **kwargs):
+            calls.append((name, args, kwargs))
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        setattr(self, name, call)
+        return call
+
+    def execute(self):
+        """
+        runs the queued calls and returns their results in order, calls which
+        failed have their exception instead of a result
+        """
+        calls, self._calls = self._calls, []
+        if not calls:
+            return []
+        return self._thriftclient._pipeline(calls, self.ordered)
+
+
+def run_pipeline(client, calls, ordered=True):
+    """
+    sends *calls*, (name, args, kwargs) tuples, with the generated *client*
+    then reads their replies
+
+    errors of the connection are raised, as well as TProtocolException for
+    replies which don't match a call, the exceptions of the calls themselves
+    are returned in place of their result
+    """
+    results = [None] * len(calls)
+    pending = []
+    for seqid, (name, args, kwargs) in enumerate(calls):
+        # generated clients always send 0, replies could not be told apart
+        client._seqid = seqid
+        getattr(client, "send_" + name)(*args, **kwargs)
+        # oneway methods have no reply
+        if hasattr(client, "recv_" + name):
+            pending.append(seqid)
+    client._seqid = 0
+
+    iprot = client._iprot
+    expected = set(pending)
+    for seqid in pending:
+        header = iprot.readMessageBegin()
+        fname, mtype, rseqid = header
+        if rseqid not in expected or (ordered and rseqid != seqid):
+            raise TProtocolException(
+                TProtocolException.INVALID_DATA,
+                "{name} failed: out of sequence response".format(name=fname))
+        expected.remove(rseqid)
+        name = calls[rseqid][0]
+        if fname != name:
+            raise TProtocolException(
+                TProtocolException.INVALID_DATA,
+                "{name} failed: reply of {fname}".format(
+                    name=name, fname=fname))
+
+        # the generated recv_ reads the message header again, it is given the
+        # one already read. The protocol itself is kept so that accelerated
+        # protocols are still recognized.
+        iprot.readMessageBegin = lambda: header
+        try:
+            results[rseqid] = getattr(client, "recv_" + name)()
+        except (TTransportException, TProtocolException):
+            raise
+        except TException as e:
+            results[rseqid] = e
+        finally:
+            del iprot.readMessageBegin
+    return results
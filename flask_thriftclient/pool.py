@@ -0,0 +1,306 @@
+# -*- coding:utf-8 -*-
+
+import os
+import ssl
+import time
+import select
+import socket
+import threading
+from collections import deque
+
+from .deadline import ThriftTimeout
+
+
+class Connection(object):
+    """
+    a transport/protocol/client stack, as built by ThriftClient for one
+    thrift endpoint
+
+    *socket* is the endpoint transport below the additionnal layers (buffered,
+    framed...), *counter* the TCountingTransport wrapping it when metrics
+    are enabled, *compression* the CompressionStats of its compressed
+    transport if any, *recording* the TRecordingTransport saving its calls
+    when THRIFTCLIENT_RECORD is set
+
+    a connection is *broken* once a call failed in the middle of its request
+    or reply, it is closed then as the rest of the reply may still come
+    """
+
+    def __init__(self, transport, protocol, client, socket=None,
+                 endpoint=None, counter=None, compression=None,
+                 recording=None):
+        self.transport = transport
+        self.protocol = protocol
+        self.client = client
+        self.socket = socket
+        self.endpoint = endpoint
+        self.counter = counter
+        self.compression = compression
+        self.recording = recording
+        self.broken = False
+        # connections of the services sharing this one, by ThriftClient
+        self.views = {}
+        # the pool owning the connection, if any
+        self.pool = None
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    def isOpen(self):
+        return self.transport.isOpen()
+
+    def isAlive(self):
+        """
+        cheap check of an opened connection before reusing it: an idle
+        connection has nothing to read, a readable socket means the server
+        closed it (or sent garbage)
+        """
+        if not self.transport.isOpen():
+            return False
+        handle = getattr(self.socket, "handle", None)
+        if handle is None:
+            # http transport, or lazy transport not connected yet
+            return True
+        return is_alive(handle)
+
+    def open(self):
+        if not self.transport.isOpen():
+            self.transport.open()
+
+    def close(self):
+        try:
+            self.transport.close()
+        except Exception:
+            # the connection is being thrown away, there is nothing
+            # useful to do with a failing close
+            pass
+
+
+def is_alive(handle):
+    """
+    True when the idle socket *handle* has nothing to read. TLS sockets may
+    be readable without application data, TLS 1.3 servers send their
+    session tickets after the handshake: they are alive unless their server
+    closed them (or sent garbage).
+    """
+    if isinstance(handle, ssl.SSLSocket) and handle.pending():
+        return False
+    try:
+        readable, _, _ = select.select([handle], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+    if not readable:
+        return True
+    if not isinstance(handle, ssl.SSLSocket):
+        return False
+    timeout = handle.gettimeout()
+    handle.settimeout(0)
+    try:
+        handle.recv(1)
+    except ssl.SSLWantReadError:
+        # TLS records without application data
+        return True
+    except (ssl.SSLError, socket.error):
+        return False
+    finally:
+        handle.settimeout(timeout)
+    return False
+
+
+class ConnectionPool(object):
+    """
+    bounded pool of opened connections
+
+    connections are built by *factory* and opened the first time they are
+    checked out, then they stay opened until they are evicted:
+
+    - *min_size* connections are never evicted for being idle
+    - no more than *max_size* connections exist at any time, checkout
+      blocks for at most *timeout* seconds (None: forever) waiting for a
+      connection to be returned
+    - connections idle for more than *idle_timeout* seconds are closed
+    - connections older than *max_lifetime* seconds are recycled
+
+    *on_wait*, if given, is called with the seconds each checkout waited for
+    a connection, connecting excluded
+
+    a pool inherited through fork() forgets the connections and the locks
+    of the parent process on its first use in the child.
+    """
+
+    def __init__(self, factory, min_size=0, max_size=10, timeout=None,
+                 idle_timeout=None, max_lifetime=None, on_wait=None):
+        if max_size < 1:
+            raise RuntimeError("connection pool max size MUST be at least 1")
+        if min_size > max_size:
+            raise RuntimeError(
+                "connection pool min size MUST not exceed its max size")
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.on_wait = on_wait
+
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+    @property
+    def size(self):
+        """number of connections owned by the pool, idle or checked out"""
+        return self._size
+
+    @property
+    def idle(self):
+        """number of connections waiting to be checked out"""
+        return len(self._idle)
+
+    def checkout(self, timeout=None):
+        """
+        returns an opened connection, waits for one to be returned when the
+        pool is exhausted.
+        """
+        self._check_fork()
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+
+        with self._cond:
+            while True:
+                self._evict()
+                if self._idle:
+                    # LIFO: the most recently used connection is the least
+                    # likely to have been dropped by the server
+                    conn = self._idle.pop()
+                    if (self._expired(conn, time.time()) or
+                            not conn.isAlive()):
+                        self._discard(conn)
+                        continue
+                    conn.last_used = time.time()
+                    self._waited(start)
+                    return conn
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._waited(start)
+                        raise ThriftTimeout(
+                            "Unable to check out a thrift connection: "
+                            "pool exhausted")
+                    self._cond.wait(remaining)
+        self._waited(start)
+
+        # connecting is slow, don't hold the lock meanwhile
+        try:
+            return self._connect()
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def checkin(self, conn, discard=False):
+        """
+        gives a connection back to the pool, *discard* closes it instead of
+        keeping it for reuse
+        """
+        self._check_fork()
+        if conn.pid != self._pid:
+            # opened by the parent process, not counted in this pool
+            conn.close()
+            return
+        with self._cond:
+            now = time.time()
+            if discard or not conn.isOpen() or self._expired(conn, now):
+                self._discard(conn)
+            else:
+                conn.last_used = now
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def fill(self, size=None):
+        """
+        opens connections until the pool holds *size* of them, *min_size* by
+        default, at most *max_size*
+        """
+        self._check_fork()
+        if size is None:
+            size = self.min_size
+        size = min(size, self.max_size)
+        while True:
+            with self._cond:
+                if self._size >= size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except:
+                with self._cond:
+                    self._size -= 1
+                raise
+            self.checkin(conn)
+
+    def clear(self):
+        """closes every idle connection"""
+        self._check_fork()
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.popleft())
+            self._cond.notify_all()
+
+    def _check_fork(self):
+        """
+        resets the pool in the child of a fork: the connections of the parent
+        are closed, which only closes the file descriptors of the child, and
+        its lock, which may have been held by another thread, replaced
+        """
+        pid = os.getpid()
+        if pid == self._pid:
+            return
+        idle, self._idle = self._idle, deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._pid = pid
+        for conn in idle:
+            conn.close()
+
+    def _connect(self):
+        conn = self.factory()
+        conn.pool = self
+        # the process which opened it, children don't own its socket
+        conn.pid = self._pid
+        try:
+            conn.open()
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def _waited(self, start):
+        if self.on_wait is not None:
+            self.on_wait(time.time() - start)
+
+    def _expired(self, conn, now):
+        return (self.max_lifetime is not None and
+                now - conn.created_at > self.max_lifetime)
+
+    def _evict(self):
+        if self.idle_timeout is None:
+            return
+        now = time.time()
+        # the left end holds the connections idle for the longest time
+        while self._idle and self._size > self.min_size:
+            if now - self._idle[0].last_used <= self.idle_timeout:
+                break
+            self._discard(self._idle.popleft())
+
+    def _discard(self, conn):
+        self._size -= 1
+        conn.close()
@@ -0,0 +1,56 @@
+# -*- coding:utf-8 -*-
+
+
+class ClientProxy(object):
+    """
+    stands for the generated client of a connection: RPC methods calls are
+    routed through the extension, everything else is read from the client
+    """
+
+    def __init__(self, thriftclient, conn):
+        self._thriftclient = thriftclient
+        self._conn = conn
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn.client, name)
+        if (name.startswith("_") or name.startswith("send_") or
+                name.startswith("recv_") or not callable(attr)):
+            return attr
+
+        thriftclient, conn = self._thriftclient, self._conn
+
+        def call(*args, **kwargs):
+            return thriftclient._call(conn, name, args, kwargs)
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        # next lookups won't go through __getattr__
+        setattr(self, name, call)
+        return call
+
+
+class FutureClientProxy(object):
+    """
+    stands for the generated client of an AsyncThriftClient: RPC methods are
+    submitted to the extension and return a Future
+    """
+
+    def __init__(self, thriftclient):
+        self._thriftclient = thriftclient
+
+    def __getattr__(self, name):
+        attr = getattr(self._thriftclient.interface, name)
+        if (name.startswith("_") or name.startswith("send_") or
+                name.startswith("recv_") or not callable(attr)):
+            raise AttributeError(
+                "{name} is not a RPC method of {interface}".format(
+                    name=name, interface=self._thriftclient.interface))
+
+        thriftclient = self._thriftclient
+
+        def call(*args, **kwargs):
+            return thriftclient.submit(
+                lambda client: getattr(client, name)(*args, **kwargs))
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        setattr(self, name, call)
+        return call
@@ -0,0 +1,264 @@
+# -*- coding:utf-8 -*-
+
+import os
+import mmap
+import time
+import random
+import socket
+import hashlib
+import threading
+from struct import Struct
+from cStringIO import StringIO
+
+from thrift.transport import TTransport
+
+from .transports import _Timeouts
+
+
+# a record of a capture file: its size (after this field), the key of the
+# call, the size of the request, then the request and the reply
+_RECORD = Struct("!I20sI")
+
+
+def message(protocol, data):
+    """
+    returns (name, type, seqid, body) of the message *data* encoded with the
+    protocol class *protocol*, *body* being the bytes after its header
+    """
+    name, mtype, seqid = protocol(
+        TTransport.TMemoryBuffer(data)).readMessageBegin()
+    header = _header(protocol, name, mtype, seqid)
+    if not data.startswith(header):
+        raise TTransport.TTransportException(
+            message="unsupported encoding of the {name} message".format(
+                name=name))
+    return name, mtype, seqid, data[len(header):]
+
+
+def record_key(name, body):
+    """the key of a call of the RPC method *name* with the request *body*"""
+    return hashlib.sha1(name + "\0" + body).digest()
+
+
+def _header(protocol, name, mtype, seqid):
+    buf = TTransport.TMemoryBuffer()
+    protocol(buf).writeMessageBegin(name, mtype, seqid)
+    return buf.getvalue()
+
+
+class Recorder(object):
+    """
+    appends calls to the capture file *path*. Each record is written at once
+    to a file opened for appending, so that the threads and processes
+    recording to the same file don't interleave their records.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0644)
+
+    def record(self, key, request, reply):
+        os.write(self._fd, _RECORD.pack(
+            _RECORD.size - 4 + len(request) + len(reply), key,
+            len(request)) + request + reply)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class Capture(object):
+    """
+    the replies recorded in the capture file *path*. The file is memory
+    mapped and only its record headers are read when it is opened, replies
+    are read when they are served.
+
+    calls recorded several times get their replies in turn, a record cut by
+    a crash while recording is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fd:
+            size = os.fstat(fd.fileno()).st_size
+            # empty files can't be mapped
+            self._map = (mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                         if size else "")
+        self._replies = {}
+        self._turns = {}
+        self._lock = threading.Lock()
+
+        offset = 0
+        while offset + _RECORD.size <= size:
+            length, key, request_size = _RECORD.unpack_from(self._map, offset)
+            end = offset + 4 + length
+            if end > size:
+                break
+            self._replies.setdefault(key, []).append(
+                (offset + _RECORD.size + request_size, end))
+            offset = end
+
+    def __len__(self):
+        return sum(len(replies) for replies in self._replies.values())
+
+    def reply(self, key):
+        """the next reply recorded for *key*, None if there is none"""
+        replies = self._replies.get(key)
+        if replies is None:
+            return None
+        with self._lock:
+            turn = self._turns.get(key, 0)
+            self._turns[key] = turn + 1
+        start, end = replies[turn % len(replies)]
+        return self._map[start:end]
+
+
+class TRecordingTransport(TTransport.TTransportBase):
+    """
+    wraps the transport of a connection, below the protocol *protocol*, and
+    keeps the bytes of the current call: save() gives them to *recorder*
+    once the call is over, discard() drops the ones of a failed call.
+    Pipelined calls, whose replies can't be told apart, aren't recorded.
+    """
+
+    def __init__(self, trans, recorder, protocol):
+        self.__trans = trans
+        self.recorder = recorder
+        self.protocol = protocol
+        self.__request = StringIO()
+        self.__reply = StringIO()
+        self.__flushes = 0
+
+    def isOpen(self):
+        return self.__trans.isOpen()
+
+    def open(self):
+        return self.__trans.open()
+
+    def close(self):
+        self.discard()
+        return self.__trans.close()
+
+    def read(self, sz):
+        data = self.__trans.read(sz)
+        self.__reply.write(data)
+        return data
+
+    def write(self, buf):
+        self.__request.write(buf)
+        self.__trans.write(buf)
+
+    def flush(self):
+        self.__flushes += 1
+        self.__trans.flush()
+
+    def save(self):
+        request = self.__request.getvalue()
+        reply = self.__reply.getvalue()
+        single = self.__flushes == 1
+        self.discard()
+        if single and request:
+            name, mtype, seqid, body = message(self.protocol, request)
+            self.recorder.record(record_key(name, body), request, reply)
+
+    def discard(self):
+        self.__request = StringIO()
+        self.__reply = StringIO()
+        self.__flushes = 0
+
+
+class TReplayTransport(_Timeouts, TTransport.TTransportBase,
+                       TTransport.CReadableTransport):
+    """
+    transport serving the replies of *capture* instead of a server, the
+    messages are encoded with the protocol class *protocol*. A request gets
+    a reply recorded for the same method and arguments, with the seqid of
+    the request, after the replies not read yet so that pipelined calls are
+    replayed too.
+
+    each call is delayed by *latency* seconds plus a random *jitter*, calls
+    delayed past the read timeout raise socket.timeout, and a share
+    *errors* of the calls fail with a TTransportException.
+    """
+
+    def __init__(self, capture, protocol, latency=0, jitter=0, errors=0):
+        self.capture = capture
+        self.protocol = protocol
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.__opened = False
+        self.__wbuf = StringIO()
+        self.__rbuf = StringIO()
+
+    def isOpen(self):
+        return self.__opened
+
+    def open(self):
+        self.__opened = True
+
+    def close(self):
+        self.__opened = False
+        self.__rbuf = StringIO()
+
+    def read(self, sz):
+        data = self.__rbuf.read(sz)
+        if not data and sz > 0:
+            raise TTransport.TTransportException(
+                type=TTransport.TTransportException.END_OF_FILE,
+                message="No replayed reply to read")
+        return data
+
+    def write(self, buf):
+        self.__wbuf.write(buf)
+
+    def flush(self):
+        request = self.__wbuf.getvalue()
+        self.__wbuf = StringIO()
+        if not self.__opened:
+            raise TTransport.TTransportException(
+                type=TTransport.TTransportException.NOT_OPEN,
+                message="Transport not open")
+        name, mtype, seqid, body = message(self.protocol, request)
+        reply = self.capture.reply(record_key(name, body))
+        if reply is None:
+            raise TTransport.TTransportException(
+                message="No recorded reply to {name} in {path}".format(
+                    name=name, path=self.capture.path))
+
+        self.__delay()
+        if self.errors and random.random() < self.errors:
+            raise TTransport.TTransportException(
+                message="Replay error injected in {name}".format(name=name))
+
+        # one way calls have no reply
+        if reply:
+            rname, rtype, rseqid, rbody = message(self.protocol, reply)
+            reply = _header(self.protocol, rname, rtype, seqid) + rbody
+        self.__rbuf = StringIO(self.__rbuf.read() + reply)
+
+    def __delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        timeout = self._bounded(self.read_timeout)
+        if timeout is not None and delay >= timeout:
+            time.sleep(timeout)
+            raise socket.timeout("timed out")
+        if delay:
+            time.sleep(delay)
+
+    def _apply_timeouts(self):
+        # the timeouts are read by each call
+        pass
+
+    # Implement the CReadableTransport interface.
+    @property
+    def cstringio_buf(self):
+        return self.__rbuf
+
+    def cstringio_refill(self, partialread, reqlen):
+        # the whole reply is in the buffer
+        raise TTransport.TTransportException(
+            type=TTransport.TTransportException.END_OF_FILE,
+            message="No replayed reply to read")
@@ -0,0 +1,148 @@
+# -*- coding:utf-8 -*-
+
+import random
+import socket
+import threading
+
+from thrift.transport import TTransport
+
+from .breaker import CircuitOpenError
+from .deadline import ThriftTimeout, DeadlineExceeded
+from .metrics import Histogram
+
+
+#: latency buckets of the hedging percentiles, 25% apart from 1ms to ~10s
+HEDGE_BUCKETS = tuple(0.001 * 1.25 ** i for i in range(42))
+
+
+class RetryPolicy(object):
+    """
+    how the calls of a RPC method are retried after a failure: at most
+    *attempts* calls in all, separated by a random delay (full jitter) of at
+    most backoff * 2 ** (retry - 1) seconds, capped at *max_backoff*.
+    Without *jitter* the delays are the caps themselves.
+
+    calls which failed after their request may have reached the server are
+    only retried for *idempotent* methods, calls which could not be sent are
+    always retried.
+
+    idempotent calls are hedged when *hedge* (a latency percentile, e.g. 95)
+    or *hedge_after* (seconds) is given: a duplicate call is sent on another
+    connection when no reply came in time, the first reply wins. Percentiles
+    are only used once *min_samples* latencies are known.
+    """
+
+    def __init__(self, attempts=3, idempotent=False, backoff=0.05,
+                 max_backoff=1, jitter=True, hedge=None, hedge_after=None,
+                 min_samples=20):
+        if attempts < 1:
+            raise RuntimeError("retry attempts MUST be at least 1")
+        if backoff < 0 or max_backoff < 0:
+            raise RuntimeError("retry backoff MUST NOT be negative")
+        if (hedge is not None or hedge_after is not None) and not idempotent:
+            raise RuntimeError("only idempotent methods can be hedged")
+        if hedge is not None and not 0 < hedge < 100:
+            raise RuntimeError("hedge percentile MUST be between 0 and 100")
+        if hedge_after is not None and hedge_after < 0:
+            raise RuntimeError("hedge delay MUST NOT be negative")
+        self.attempts = attempts
+        self.idempotent = idempotent
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self.latency = Histogram(HEDGE_BUCKETS)
+        self._lock = threading.Lock()
+
+    def delay(self, retry):
+        """seconds to wait before the *retry*-th retry"""
+        delay = min(self.max_backoff, self.backoff * 2 ** (retry - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def retryable(self, exception):
+        """True when a call which raised *exception* may be made again"""
+        if isinstance(exception, (DeadlineExceeded, CircuitOpenError)):
+            return False
+        if (isinstance(exception, TTransport.TTransportException) and
+                exception.type == TTransport.TTransportException.NOT_OPEN):
+            # the request was not sent
+            return True
+        if not self.idempotent:
+            return False
+        return isinstance(exception, (TTransport.TTransportException,
+                                      socket.error, ThriftTimeout))
+
+    def observe(self, latency):
+        """records the latency of a successful call"""
+        with self._lock:
+            self.latency.observe(latency)
+
+    def hedge_delay(self):
+        """
+        seconds after which a duplicate call is sent, None when the call is
+        not hedged
+        """
+        if self.hedge_after is not None:
+            return self.hedge_after
+        if self.hedge is None:
+            return None
+        with self._lock:
+            if self.latency.count < self.min_samples:
+                return None
+            return self.latency.percentile(self.hedge)
+
+
+class RetryBudget(object):
+    """
+    bounds the retries and hedged calls to a share of the calls, so that
+    they can't amplify an outage: every call deposits *ratio* token, every
+    retry withdraws one and is refused when there is none left. At most
+    *capacity* tokens are kept, the budget starts full.
+
+    a budget is shared by every ThriftClient of the process, unless
+    THRIFTCLIENT_RETRY_BUDGET gives one of their own.
+    """
+
+    def __init__(self, ratio=0.1, capacity=10):
+        if ratio < 0 or capacity < 1:
+            raise RuntimeError(
+                "retry budget ratio MUST NOT be negative and capacity MUST "
+                "be at least 1")
+        self.ratio = ratio
+        self.capacity = capacity
+        self.balance = float(capacity)
+        self.retries = 0
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.capacity, self.balance + self.ratio)
+
+    def withdraw(self):
+        """True when a retry is allowed"""
+        with self._lock:
+            if self.balance < 1:
+                self.refused += 1
+                return False
+            self.balance -= 1
+            self.retries += 1
+            return True
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "ratio": self.ratio,
+                "capacity": self.capacity,
+                "balance": self.balance,
+                "retries": self.retries,
+                "refused": self.refused,
+            }
+
+
+#: budget of the process
+budget = RetryBudget()
@@ -0,0 +1,77 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import hashlib
+import threading
+
+from thrift.transport import TTransport
+from thrift.protocol import TBinaryProtocol
+
+from .futures import Future
+
+
+def args_struct(interface, method):
+    """
+    returns the generated argument struct of the RPC method *method*, it is
+    defined next to the client *interface*
+    """
+    module = sys.modules.get(interface.__module__)
+    struct = getattr(module, method + "_args", None)
+    if struct is None:
+        raise RuntimeError(
+            "no argument struct {method}_args next to {interface}".format(
+                method=method, interface=interface))
+    return struct
+
+
+def serialize_args(struct, args, kwargs):
+    """the arguments of a call, serialized with the binary protocol"""
+    buf = TTransport.TMemoryBuffer()
+    struct(*args, **kwargs).write(TBinaryProtocol.TBinaryProtocol(buf))
+    return buf.getvalue()
+
+
+def call_key(interface, method, args, kwargs):
+    """
+    a string identifying the call of *method* with *args* and *kwargs*
+    """
+    struct = args_struct(interface, method)
+    digest = hashlib.sha1(serialize_args(struct, args, kwargs)).hexdigest()
+    return "thriftclient:{module}.{method}:{digest}".format(
+        module=interface.__module__, method=method, digest=digest)
+
+
+class SingleFlight(object):
+    """
+    runs a single call per key at a time: threads calling do() with the key
+    of a call in progress wait for it and get its result, or its exception
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, call, timeout=None):
+        """
+        returns call(), or the result of the call of *key* made by another
+        thread, waiting at most *timeout* seconds for it
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+        if not leader:
+            return flight.result(timeout)
+
+        try:
+            result = call()
+        except:
+            flight.set_exc_info(sys.exc_info())
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
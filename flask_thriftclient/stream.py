@@ -0,0 +1,89 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import threading
+from operator import attrgetter
+from Queue import Queue, Empty
+
+
+class PageStream(object):
+    """
+    iterates over the items of the pages returned by fetch(client, cursor),
+    starting at *cursor*. *items* and *next_cursor* are the attribute names
+    (or functions) giving the items of a page and the cursor of the next
+    one, the last page has no item or no next cursor.
+
+    pages are fetched by a background thread given to run(produce), which
+    calls produce(client), while the current page is consumed. At most
+    *read_ahead* pages wait to be consumed.
+
+    a stream is iterated once, close() stops the background thread, it is
+    called once the iteration is over or interrupted.
+    """
+
+    def __init__(self, fetch, run, cursor=None, items="items",
+                 next_cursor="cursor", read_ahead=2):
+        if read_ahead < 1:
+            raise RuntimeError("stream read ahead MUST be at least 1")
+        self.fetch = fetch
+        self.cursor = cursor
+        self.items = items if callable(items) else attrgetter(items)
+        self.next_cursor = (next_cursor if callable(next_cursor) else
+                            attrgetter(next_cursor))
+        self.read_ahead = read_ahead
+        self._run = run
+        self._pages = Queue(read_ahead)
+        self._stopped = False
+        self._thread = None
+
+    def __iter__(self):
+        if self._thread is not None:
+            raise RuntimeError("a stream can only be iterated once")
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._consume()
+
+    def close(self):
+        """stops fetching pages"""
+        self._stopped = True
+        # unblocks the producer, which checks _stopped before its next put
+        while True:
+            try:
+                self._pages.get_nowait()
+            except Empty:
+                return
+
+    def _consume(self):
+        try:
+            while True:
+                items, exc_info = self._pages.get()
+                if items is None:
+                    if exc_info is not None:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    return
+                for item in items:
+                    yield item
+        finally:
+            self.close()
+
+    def _produce(self):
+        try:
+            self._run(self._fetch_pages)
+        except:
+            exc_info = sys.exc_info()
+        else:
+            exc_info = None
+        if not self._stopped:
+            self._pages.put((None, exc_info))
+
+    def _fetch_pages(self, client):
+        cursor = self.cursor
+        while not self._stopped:
+            page = self.fetch(client, cursor)
+            items = self.items(page)
+            cursor = self.next_cursor(page)
+            if items:
+                self._pages.put((items, None))
+            if not items or cursor is None:
+                return
@@ -0,0 +1,110 @@
+# -*- coding:utf-8 -*-
+
+import ssl
+import time
+import socket
+import threading
+
+from thrift.transport import TTransport, TSSLSocket
+
+from .transports import (_Timeouts, _apply_socket_timeouts, _configure_socket,
+                         _socket_read_into)
+
+
+class TLSContext(object):
+    """
+    SSLContext shared by the TLS connections of a configuration, so that the
+    CA file is loaded once, counting their *handshakes*
+
+    *check_hostname* is for https, TSSLSocket checks the hostnames itself.
+    """
+
+    def __init__(self, validate=True, ca_certs=None, certfile=None,
+                 keyfile=None, ciphers=None, check_hostname=False):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= (getattr(ssl, "OP_NO_SSLv2", 0) |
+                            getattr(ssl, "OP_NO_SSLv3", 0))
+        if validate:
+            context.verify_mode = ssl.CERT_REQUIRED
+            if ca_certs is None:
+                context.load_default_certs()
+            else:
+                context.load_verify_locations(ca_certs)
+            context.check_hostname = check_hostname
+        else:
+            context.verify_mode = ssl.CERT_NONE
+        if certfile is not None:
+            context.load_cert_chain(certfile, keyfile)
+        if ciphers is not None:
+            context.set_ciphers(ciphers)
+        self.context = context
+        self.handshakes = 0
+        self._lock = threading.Lock()
+
+    def handshaked(self):
+        """counts a handshake"""
+        with self._lock:
+            self.handshakes += 1
+
+
+class TClientSSLSocket(_Timeouts, TSSLSocket.TSSLSocket):
+    """
+    SSL version of TClientSocket, *on_connect* is also given the duration of
+    the handshake. Connections use the context of *tls*, a TLSContext, when
+    given, and count their handshakes in it.
+    """
+    keepalive = None
+    on_connect = None
+    tls = None
+
+    def open(self):
+        # same as TSSLSocket.open, but the handshake is done apart from the
+        # connection so that it can be timed
+        self._timeout = self._bounded(self.connect_timeout)
+        start = time.time()
+        try:
+            res0 = self._resolveAddr()
+            for res in res0:
+                plain_sock = socket.socket(res[0], res[1])
+                if self.tls is not None:
+                    self.handle = self.tls.context.wrap_socket(
+                        plain_sock, do_handshake_on_connect=False)
+                else:
+                    self.handle = ssl.wrap_socket(
+                        plain_sock, ssl_version=self.SSL_VERSION,
+                        do_handshake_on_connect=False, ca_certs=self.ca_certs,
+                        keyfile=self.keyfile, certfile=self.certfile,
+                        cert_reqs=self.cert_reqs, ciphers=self.ciphers)
+                self.handle.settimeout(self._timeout)
+                try:
+                    self.handle.connect(res[4])
+                except socket.error:
+                    if res is not res0[-1]:
+                        continue
+                    raise
+                break
+            connected = time.time()
+            self.handle.do_handshake()
+        except socket.error as e:
+            if self._unix_socket:
+                message = ("Could not connect to secure socket {path}: "
+                           "{error}".format(path=self._unix_socket, error=e))
+            else:
+                message = ("Could not connect to {host}:{port}: {error}"
+                           .format(host=self.host, port=self.port, error=e))
+            raise TTransport.TTransportException(
+                type=TTransport.TTransportException.NOT_OPEN, message=message)
+        handshaked = time.time()
+        if self.tls is not None:
+            self.tls.handshaked()
+        if self.validate:
+            self._validate_cert()
+        _configure_socket(self)
+        if self.on_connect is not None:
+            self.on_connect(handshaked - start, handshaked - connected)
+
+    def readInto(self, view, sz):
+        return _socket_read_into(self, view, sz)
+
+    def _apply_timeouts(self):
+        _apply_socket_timeouts(self)
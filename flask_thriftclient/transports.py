@@ -0,0 +1,316 @@
+# -*- coding:utf-8 -*-
+
+import time
+import socket
+from struct import pack_into, unpack_from
+from cStringIO import StringIO
+
+from thrift.transport import TTransport, TSocket
+
+
+def set_keepalive(handle, idle=None, interval=None, count=None):
+    """
+    enables TCP keepalive on a socket, *idle*, *interval* and *count* are
+    left to the system defaults when None or not supported by the platform
+    """
+    handle.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", idle),
+                          ("TCP_KEEPINTVL", interval),
+                          ("TCP_KEEPCNT", count)):
+        if value is not None and hasattr(socket, option):
+            handle.setsockopt(socket.IPPROTO_TCP, getattr(socket, option),
+                              value)
+
+
+class _Timeouts:
+    """
+    connect and read timeouts of the client transports, in seconds
+
+    limit() bounds them for the duration of a call
+    """
+    connect_timeout = None
+    read_timeout = None
+    _limit = None
+
+    def setTimeouts(self, connect=None, read=None):
+        self.connect_timeout = connect
+        self.read_timeout = read
+        self._apply_timeouts()
+
+    def limit(self, seconds):
+        """bounds the timeouts to *seconds*, None removes the bound"""
+        if seconds is None and self._limit is None:
+            return
+        self._limit = seconds
+        self._apply_timeouts()
+
+    def _bounded(self, timeout):
+        if self._limit is None:
+            return timeout
+        if timeout is None:
+            return self._limit
+        return min(timeout, self._limit)
+
+
+class TClientSocket(_Timeouts, TSocket.TSocket):
+    """
+    TSocket configuring the socket options of the extension once connected
+
+    *keepalive* is either None or a (idle, interval, count) tuple given to
+    set_keepalive, *on_connect* is None or called with the duration of each
+    connection
+    """
+    keepalive = None
+    on_connect = None
+
+    def open(self):
+        self._timeout = self._bounded(self.connect_timeout)
+        start = time.time()
+        TSocket.TSocket.open(self)
+        _configure_socket(self)
+        if self.on_connect is not None:
+            self.on_connect(time.time() - start)
+
+    def readInto(self, view, sz):
+        return _socket_read_into(self, view, sz)
+
+    def _apply_timeouts(self):
+        _apply_socket_timeouts(self)
+
+
+def _apply_socket_timeouts(trans):
+    if trans.handle is None:
+        trans._timeout = trans._bounded(trans.connect_timeout)
+    else:
+        trans.handle.settimeout(trans._bounded(trans.read_timeout))
+
+
+def _socket_read_into(trans, view, sz):
+    read = trans.handle.recv_into(view, sz)
+    if read == 0:
+        raise TTransport.TTransportException(
+            type=TTransport.TTransportException.END_OF_FILE,
+            message="TSocket read 0 bytes")
+    return read
+
+
+def _configure_socket(trans):
+    trans.handle.settimeout(trans._bounded(trans.read_timeout))
+    # TCP options don't make sense for unix sockets
+    if trans._unix_socket is not None:
+        return
+    # unbuffered protocols write a message in many small pieces, Nagle's
+    # algorithm would hold them back until the server acknowledged the
+    # previous ones, delaying the calls of kept connections by ~40ms
+    trans.handle.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if trans.keepalive is not None:
+        set_keepalive(trans.handle, *trans.keepalive)
+
+
+class TLazyTransport(TTransport.TTransportBase):
+    """
+    wraps a transport and delays its opening until the first byte is
+    written or read, so a connection is only made when a RPC method is
+    actually called.
+
+    open() only marks the transport as opened, close() closes the wrapped
+    transport if it was really opened.
+    """
+
+    def __init__(self, trans):
+        self.__trans = trans
+        self.__opened = False
+
+    @property
+    def connected(self):
+        """True when the wrapped transport has really been opened"""
+        return self.__trans.isOpen()
+
+    def isOpen(self):
+        return self.__opened or self.__trans.isOpen()
+
+    def open(self):
+        self.__opened = True
+
+    def close(self):
+        self.__opened = False
+        if self.__trans.isOpen():
+            self.__trans.close()
+
+    def read(self, sz):
+        self.__connect()
+        return self.__trans.read(sz)
+
+    def readInto(self, view, sz):
+        self.__connect()
+        return read_into(self.__trans, view, sz)
+
+    def write(self, buf):
+        self.__connect()
+        self.__trans.write(buf)
+
+    def flush(self):
+        self.__connect()
+        self.__trans.flush()
+
+    def __connect(self):
+        if not self.__trans.isOpen():
+            self.__opened = True
+            try:
+                self.__trans.open()
+            except TTransport.TTransportException:
+                self.__trans.close()
+                raise
+
+
+class TCountingTransport(TTransport.TTransportBase):
+    """
+    wraps a transport and counts the bytes written to it and read from it
+    """
+
+    def __init__(self, trans):
+        self.__trans = trans
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def reset(self):
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def isOpen(self):
+        return self.__trans.isOpen()
+
+    def open(self):
+        self.__trans.open()
+
+    def close(self):
+        self.__trans.close()
+
+    def read(self, sz):
+        buf = self.__trans.read(sz)
+        self.bytes_read += len(buf)
+        return buf
+
+    def readInto(self, view, sz):
+        read = read_into(self.__trans, view, sz)
+        self.bytes_read += read
+        return read
+
+    def write(self, buf):
+        self.__trans.write(buf)
+        self.bytes_written += len(buf)
+
+    def flush(self):
+        self.__trans.flush()
+
+
+def read_into(trans, view, sz):
+    """
+    reads at most *sz* bytes of *trans* into the memoryview *view*, returns
+    how many were read. Transports with a readInto method fill the view
+    directly, others are read and copied.
+    """
+    if hasattr(trans, "readInto"):
+        return trans.readInto(view, sz)
+    buf = trans.read(sz)
+    if not buf:
+        raise TTransport.TTransportException(
+            type=TTransport.TTransportException.END_OF_FILE,
+            message="No more data to read")
+    view[:len(buf)] = buf
+    return len(buf)
+
+
+class TFastFramedTransport(TTransport.TTransportBase,
+                           TTransport.CReadableTransport):
+    """
+    framed transport, wire compatible with TFramedTransport, which reuses its
+    buffers from a call to the next.
+
+    writes are copied into a growable bytearray whose first 4 bytes are kept
+    for the frame size, a frame is then written with a single write of the
+    header and the payload. Frames are read with recv_into into a second
+    bytearray, sized from the header, instead of being concatenated from
+    chunks.
+
+    buffers grown above *max_retained* bytes by a large message are released
+    once it is sent or read.
+    """
+    INITIAL_SIZE = 4096
+
+    def __init__(self, trans, max_retained=1024 * 1024):
+        self.__trans = trans
+        self.max_retained = max_retained
+        self.__wbuf = bytearray(self.INITIAL_SIZE)
+        self.__wlen = 4
+        self.__rbuf = StringIO()
+        self.__frame = bytearray(self.INITIAL_SIZE)
+
+    def isOpen(self):
+        return self.__trans.isOpen()
+
+    def open(self):
+        return self.__trans.open()
+
+    def close(self):
+        return self.__trans.close()
+
+    def read(self, sz):
+        ret = self.__rbuf.read(sz)
+        if len(ret) != 0:
+            return ret
+
+        self.readFrame()
+        return self.__rbuf.read(sz)
+
+    def readFrame(self):
+        view = memoryview(self.__frame)
+        self.__fill(view, 4)
+        sz, = unpack_from("!i", self.__frame)
+        if sz > len(self.__frame):
+            self.__frame = bytearray(sz)
+            view = memoryview(self.__frame)
+        self.__fill(view, sz)
+        # cStringIO needs a string, this is the only copy of the frame
+        self.__rbuf = StringIO(view[:sz].tobytes())
+        if len(self.__frame) > self.max_retained:
+            self.__frame = bytearray(self.INITIAL_SIZE)
+
+    def __fill(self, view, sz):
+        read = 0
+        while read < sz:
+            read += read_into(self.__trans, view[read:sz], sz - read)
+
+    def write(self, buf):
+        end = self.__wlen + len(buf)
+        if end > len(self.__wbuf):
+            self.__wbuf.extend(bytearray(max(end, 2 * len(self.__wbuf)) -
+                                         len(self.__wbuf)))
+        self.__wbuf[self.__wlen:end] = buf
+        self.__wlen = end
+
+    def flush(self):
+        wlen = self.__wlen
+        pack_into("!i", self.__wbuf, 0, wlen - 4)
+        # reset the length before write/flush to preserve state on underlying
+        # failure, the bytes are kept until the next write
+        self.__wlen = 4
+        # python 2 sockets have no sendmsg, the header and the payload are
+        # sent at once from the same buffer instead
+        self.__trans.write(buffer(self.__wbuf, 0, wlen))
+        if len(self.__wbuf) > self.max_retained:
+            self.__wbuf = bytearray(self.INITIAL_SIZE)
+        self.__trans.flush()
+
+    # Implement the CReadableTransport interface.
+    @property
+    def cstringio_buf(self):
+        return self.__rbuf
+
+    def cstringio_refill(self, prefix, reqlen):
+        # fastbinary only asks for a refill once the buffer is empty
+        while len(prefix) < reqlen:
+            self.readFrame()
+            prefix += self.__rbuf.getvalue()
+        self.__rbuf = StringIO(prefix)
+        return self.__rbuf
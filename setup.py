@@ -36,6 +36,11 @@ setup(
         'Flask>=0.10',
         'thrift>=0.9.3'
     ],
+    extras_require={
+        'lz4': ['lz4'],
+        'zstd': ['zstandard'],
+        'snappy': ['python-snappy'],
+    },
     test_suite='tests.thriftclient',
     classifiers=[
         'Development Status :: 4 - Beta',
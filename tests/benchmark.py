@@ -0,0 +1,392 @@
+# -*- coding:utf-8 -*-
+"""
+benchmarks the calls made through the extension against thrift servers
+started in process, for every protocol, transport layers and transport
+scheme, with and without connection reuse
+
+python -m tests.benchmark --requests 1000 --output results.json
+
+each result gives the throughput (calls per second) and the p50 and p99
+latencies (seconds) of one configuration, as JSON
+"""
+
+from thrift.Thrift import TType, TMessageType, TApplicationException
+from thrift.transport import TSocket, TTransport, TZlibTransport
+from thrift.protocol import TBinaryProtocol, TCompactProtocol, TJSONProtocol
+from thrift.server import TServer, THttpServer
+
+from flask import Flask
+from flask_thriftclient import ThriftClient
+
+from timeit import default_timer
+import BaseHTTPServer
+import argparse
+import itertools
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+
+PROTOCOLS = {
+    ThriftClient.BINARY: TBinaryProtocol.TBinaryProtocolFactory,
+    ThriftClient.COMPACT: TCompactProtocol.TCompactProtocolFactory,
+    ThriftClient.JSON: TJSONProtocol.TJSONProtocolFactory,
+}
+
+SCHEMES = ("tcp", "unix", "http")
+
+
+def _write_value(oprot, name, fid, value):
+    oprot.writeStructBegin(name)
+    if value is not None:
+        oprot.writeFieldBegin("value", TType.STRING, fid)
+        oprot.writeString(value)
+        oprot.writeFieldEnd()
+    oprot.writeFieldStop()
+    oprot.writeStructEnd()
+
+
+def _read_value(iprot):
+    value = None
+    iprot.readStructBegin()
+    while True:
+        fname, ftype, fid = iprot.readFieldBegin()
+        if ftype == TType.STOP:
+            break
+        if ftype == TType.STRING:
+            value = iprot.readString()
+        else:
+            iprot.skip(ftype)
+        iprot.readFieldEnd()
+    iprot.readStructEnd()
+    return value
+
+
+class Client:
+    """
+    hand written equivalent of the generated client of:
+
+    service Echo {
+        string echo(1: string value)
+    }
+    """
+
+    def __init__(self, iprot, oprot=None):
+        self._iprot = self._oprot = iprot
+        if oprot is not None:
+            self._oprot = oprot
+        self._seqid = 0
+
+    def echo(self, value):
+        self.send_echo(value)
+        return self.recv_echo()
+
+    def send_echo(self, value):
+        self._oprot.writeMessageBegin("echo", TMessageType.CALL, self._seqid)
+        _write_value(self._oprot, "echo_args", 1, value)
+        self._oprot.writeMessageEnd()
+        self._oprot.trans.flush()
+
+    def recv_echo(self):
+        iprot = self._iprot
+        (fname, mtype, rseqid) = iprot.readMessageBegin()
+        if mtype == TMessageType.EXCEPTION:
+            x = TApplicationException()
+            x.read(iprot)
+            iprot.readMessageEnd()
+            raise x
+        value = _read_value(iprot)
+        iprot.readMessageEnd()
+        if value is not None:
+            return value
+        raise TApplicationException(TApplicationException.MISSING_RESULT,
+                                    "echo failed: unknown result")
+
+
+class Processor:
+    """processor of the Echo service"""
+
+    def process(self, iprot, oprot):
+        try:
+            (name, mtype, seqid) = iprot.readMessageBegin()
+        except socket.error:
+            # clients closing their connection with unread bytes reset it
+            raise TTransport.TTransportException(
+                TTransport.TTransportException.END_OF_FILE)
+        value = _read_value(iprot)
+        iprot.readMessageEnd()
+        oprot.writeMessageBegin(name, TMessageType.REPLY, seqid)
+        _write_value(oprot, "echo_result", 0, value)
+        oprot.writeMessageEnd()
+        oprot.trans.flush()
+        return True
+
+
+class LayersFactory:
+    """
+    transport factory mirroring the layers added by the extension
+    """
+
+    def __init__(self, buffered=False, zlib=False, framed=False,
+                 fast_framed=False):
+        self.buffered = buffered
+        self.zlib = zlib
+        self.framed = framed
+        self.fast_framed = fast_framed
+
+    def getTransport(self, trans):
+        # servers buffer their transport, as TBufferedTransportFactory does
+        # by default, whether the client does or not: an unbuffered server
+        # would delay its own replies
+        trans = TTransport.TBufferedTransport(trans)
+        if self.zlib:
+            trans = TZlibTransport.TZlibTransport(trans)
+        # the fast framed transport of the client is wire compatible
+        if self.framed or self.fast_framed:
+            trans = TTransport.TFramedTransport(trans)
+        return trans
+
+
+class ThreadedServer(TServer.TThreadedServer):
+    """TThreadedServer which can be stopped"""
+
+    def serve(self):
+        self.serverTransport.listen()
+        while True:
+            try:
+                client = self.serverTransport.accept()
+            except socket.error:
+                # stopped
+                return
+            thread = threading.Thread(target=self.handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        handle = self.serverTransport.handle
+        try:
+            # wakes up accept()
+            handle.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        handle.close()
+
+
+class QuietHTTPServer(BaseHTTPServer.HTTPServer):
+    """HTTPServer which doesn't log every request"""
+
+    def __init__(self, address, handler):
+        class QuietHandler(handler):
+            def log_message(self, *args):
+                pass
+        BaseHTTPServer.HTTPServer.__init__(self, address, QuietHandler)
+
+
+def start_server(scheme, protocol, layers, directory):
+    """
+    starts a server of the Echo service in a daemon thread, returns its url
+    and a function stopping it
+    """
+    protocol_factory = PROTOCOLS[protocol]()
+    if scheme == "http":
+        server = THttpServer.THttpServer(Processor(), ("127.0.0.1", 0),
+                                         protocol_factory,
+                                         server_class=QuietHTTPServer)
+        url = "http://127.0.0.1:{port}/".format(
+            port=server.httpd.server_address[1])
+        address = server.httpd.server_address
+
+        def stop():
+            server.httpd.shutdown()
+            server.httpd.server_close()
+    elif scheme == "tcp":
+        port = _unused_port()
+        transport = TSocket.TServerSocket(host="127.0.0.1", port=port)
+        server = ThreadedServer(Processor(), transport, layers,
+                                protocol_factory)
+        url = "tcp://127.0.0.1:{port}".format(port=port)
+        address = ("127.0.0.1", port)
+        stop = server.stop
+    else:
+        path = os.path.join(directory, str(len(os.listdir(directory))))
+        transport = TSocket.TServerSocket(unix_socket=path)
+        server = ThreadedServer(Processor(), transport, layers,
+                                protocol_factory)
+        url = "unix://{path}".format(path=path)
+        address = path
+        stop = server.stop
+
+    thread = threading.Thread(target=server.serve)
+    thread.daemon = True
+    thread.start()
+    _wait_listening(address)
+    return url, stop
+
+
+def _unused_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_listening(address, timeout=5):
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    expires = time.time() + timeout
+    while True:
+        sock = socket.socket(family)
+        try:
+            sock.connect(address)
+            return
+        except socket.error:
+            if time.time() > expires:
+                raise
+            time.sleep(0.01)
+        finally:
+            sock.close()
+
+
+def percentile(latencies, percent):
+    """*latencies* MUST be sorted"""
+    index = int(round(percent / 100.0 * (len(latencies) - 1)))
+    return latencies[index]
+
+
+def measure(url, protocol, layers, reuse, requests, payload):
+    """
+    calls echo *requests* times, each call in an application context of its
+    own as in a view
+    """
+    app = Flask(__name__)
+    app.config["THRIFTCLIENT_TRANSPORT"] = url
+    app.config["THRIFTCLIENT_PROTOCOL"] = protocol
+    app.config["THRIFTCLIENT_BUFFERED"] = layers.buffered
+    app.config["THRIFTCLIENT_ZLIB"] = layers.zlib
+    app.config["THRIFTCLIENT_FRAMED"] = layers.framed
+    app.config["THRIFTCLIENT_FAST_FRAMED"] = layers.fast_framed
+    app.config["THRIFTCLIENT_POOL"] = reuse
+    thriftclient = ThriftClient(Client, app)
+
+    # the first calls pay for imports and the first connection
+    for i in range(min(requests, 10)):
+        with app.app_context():
+            thriftclient.client.echo(payload)
+
+    latencies = []
+    start = default_timer()
+    for i in range(requests):
+        begin = default_timer()
+        with app.app_context():
+            thriftclient.client.echo(payload)
+        latencies.append(default_timer() - begin)
+    elapsed = default_timer() - start
+
+    if thriftclient.pool is not None:
+        thriftclient.pool.clear()
+    latencies.sort()
+    return {
+        "requests": requests,
+        "seconds": elapsed,
+        "throughput": requests / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def configurations(schemes=SCHEMES, protocols=None):
+    """
+    yields (scheme, protocol, layers, reuse), http has no transport layers as
+    THttpServer reads the protocol right from the request body
+    """
+    if protocols is None:
+        protocols = sorted(PROTOCOLS)
+    for scheme in schemes:
+        options = [(False, False, False, False)]
+        if scheme != "http":
+            options = [
+                (buffered, zlib, framing == "framed", framing == "fast")
+                for buffered, zlib, framing in itertools.product(
+                    (False, True), (False, True), (None, "framed", "fast"))]
+        for protocol in protocols:
+            for buffered, zlib, framed, fast_framed in options:
+                for reuse in (False, True):
+                    yield (scheme, protocol,
+                           LayersFactory(buffered, zlib, framed, fast_framed),
+                           reuse)
+
+
+def run(schemes=SCHEMES, protocols=None, requests=1000, payload_size=100):
+    """
+    benchmarks every configuration, returns a list of results
+    """
+    payload = "x" * payload_size
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for scheme, protocol, layers, reuse in configurations(schemes,
+                                                              protocols):
+            url, stop = start_server(scheme, protocol, layers, directory)
+            result = {
+                "transport": scheme,
+                "protocol": protocol,
+                "buffered": layers.buffered,
+                "zlib": layers.zlib,
+                "framed": layers.framed,
+                "fast_framed": layers.fast_framed,
+                "reuse": reuse,
+                "payload": payload_size,
+            }
+            try:
+                result.update(measure(url, protocol, layers, reuse, requests,
+                                      payload))
+            finally:
+                stop()
+            results.append(result)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="benchmarks Flask-ThriftClient configurations")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="calls per configuration (default 1000)")
+    parser.add_argument("--payload", type=int, default=100,
+                        help="size of the echoed string (default 100)")
+    parser.add_argument("--transport", action="append", choices=SCHEMES,
+                        help="transport scheme to benchmark, repeatable "
+                             "(default all)")
+    parser.add_argument("--protocol", action="append",
+                        choices=sorted(PROTOCOLS),
+                        help="protocol to benchmark, repeatable "
+                             "(default all)")
+    parser.add_argument("--output", help="file to write the results to "
+                                         "(default stdout)")
+    args = parser.parse_args(argv)
+
+    results = run(schemes=args.transport or SCHEMES,
+                  protocols=args.protocol,
+                  requests=args.requests,
+                  payload_size=args.payload)
+    report = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
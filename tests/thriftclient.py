@@ -4,11 +4,49 @@ from thrift.transport import *
 from thrift.transport import TSSLSocket
 from thrift.protocol import *
 from thrift.protocol import TCompactProtocol
+from thrift.Thrift import TType, TMessageType, TApplicationException
+try:
+    from thrift.protocol import fastbinary
+except ImportError:
+    fastbinary = None
 
+import os
+import shutil
+import httplib
+import ssl
+import sys
+import zlib
+import time
+import socket
+import subprocess
+import tempfile
+import SocketServer
+import BaseHTTPServer
+import threading
 import unittest
+from urlparse import urlparse
 
-from flask import Flask
-from flask_thriftclient import ThriftClient
+from flask import Flask, Response, g
+from flask_thriftclient import ThriftClient, AsyncThriftClient, ThriftServices
+from flask_thriftclient.pool import ConnectionPool
+from flask_thriftclient.deadline import ThriftTimeout, DeadlineExceeded
+from flask_thriftclient.cache import MemoryBackend
+from flask_thriftclient.compression import (Bz2Codec, TCompressedTransport,
+                                            TCompressedTransportFactory)
+from flask_thriftclient.futures import ThreadPool
+from flask_thriftclient.http import HttpSessionPool
+from flask_thriftclient.retry import RetryPolicy, RetryBudget
+from flask_thriftclient.replay import Capture, Recorder
+from flask_thriftclient.transports import TFastFramedTransport
+from flask_thriftclient.metrics import (Histogram, MetricsRegistry,
+                                        StatsdSink, SignalSink)
+from flask_thriftclient.breaker import (CircuitBreaker, CircuitOpenError,
+                                        OutlierDetector)
+from flask_thriftclient.balancer import (Endpoint, RoundRobinBalancer,
+                                         LeastOutstandingBalancer,
+                                         PowerOfTwoBalancer, WeightedBalancer)
+
+from tests import benchmark
 
 
 class StubClient:
@@ -17,6 +55,392 @@ class StubClient:
         pass
 
 
+class CountingClient:
+    """client counting its instances in *instances*"""
+    instances = 0
+
+    def __init__(self, protocol):
+        CountingClient.instances += 1
+
+
+class FlakyClient:
+    """
+    client whose calls fail once as if the server had closed the connection
+    """
+
+    def __init__(self, protocol):
+        self.calls = 0
+
+    def ping(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise TTransport.TTransportException(
+                TTransport.TTransportException.END_OF_FILE)
+        return "pong"
+
+
+class SleepingClient:
+
+    def __init__(self, protocol):
+        pass
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def fail(self):
+        raise ValueError("failed")
+
+
+class ReadingClient:
+    """
+    client sending a byte and waiting for the reply
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def ping(self):
+        self.protocol.trans.write("p")
+        self.protocol.trans.flush()
+        return self.protocol.trans.read(1)
+
+
+class LookupClient:
+    """
+    client counting its calls in *calls*, shared by every instance
+    """
+    calls = []
+
+    def __init__(self, protocol):
+        pass
+
+    def get(self, key):
+        LookupClient.calls.append(key)
+        time.sleep(0.05)
+        if key == "fail":
+            raise ValueError("failed")
+        return key.upper()
+
+    def getMany(self, keys):
+        LookupClient.calls.append(keys)
+        if "fail" in keys:
+            raise ValueError("failed")
+        return [key.upper() for key in keys]
+
+    def getMap(self, keys):
+        LookupClient.calls.append(keys)
+        return dict((key, key.upper()) for key in keys if key != "missing")
+
+
+class get_args:
+    """argument struct of LookupClient.get, as generated"""
+
+    def __init__(self, key=None):
+        self.key = key
+
+    def write(self, oprot):
+        oprot.writeStructBegin("get_args")
+        if self.key is not None:
+            oprot.writeFieldBegin("key", TType.STRING, 1)
+            oprot.writeString(self.key)
+            oprot.writeFieldEnd()
+        oprot.writeFieldStop()
+        oprot.writeStructEnd()
+
+
+class UnreliableClient:
+    """
+    client whose calls sleep the seconds of *delays* in turn, then fail
+    *failures* times with *error*, shared by every instance
+    """
+    calls = 0
+    failures = 0
+    error = TTransport.TTransportException.TIMED_OUT
+    delays = []
+
+    def __init__(self, protocol):
+        pass
+
+    @classmethod
+    def reset(cls, failures=0, error=TTransport.TTransportException.TIMED_OUT,
+              delays=()):
+        cls.calls = 0
+        cls.failures = failures
+        cls.error = error
+        cls.delays = list(delays)
+
+    def get(self, key):
+        UnreliableClient.calls += 1
+        if UnreliableClient.delays:
+            time.sleep(UnreliableClient.delays.pop(0))
+        if UnreliableClient.failures > 0:
+            UnreliableClient.failures -= 1
+            raise TTransport.TTransportException(UnreliableClient.error)
+        return key.upper()
+
+
+class Page:
+
+    def __init__(self, items, cursor):
+        self.items = items
+        self.cursor = cursor
+
+
+class ScanClient:
+    """
+    client paginating over the numbers below *size*, the cursors of the
+    calls are kept in *calls*, shared by every instance. Scanning *fail*
+    raises ValueError.
+    """
+    size = 10
+    fail = None
+    calls = []
+
+    def __init__(self, protocol):
+        pass
+
+    def scan(self, prefix, cursor, limit):
+        start = cursor or 0
+        ScanClient.calls.append(start)
+        if start == ScanClient.fail:
+            raise ValueError("failed")
+        end = min(start + limit, ScanClient.size)
+        return Page(["{prefix}{i}".format(prefix=prefix, i=i)
+                     for i in range(start, end)],
+                    end if end < ScanClient.size else None)
+
+
+def mute_server():
+    """
+    returns a listening socket which never replies
+    """
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(8)
+    return server
+
+
+def closing_server():
+    """
+    returns a listening socket closing every connection it accepts
+    """
+    server = mute_server()
+
+    def serve():
+        while True:
+            try:
+                server.accept()[0].close()
+            except socket.error:
+                return
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def tls_server():
+    """
+    returns a listening socket doing the TLS handshake of the connections it
+    accepts with the certificate of tests/localhost.pem, and the list of
+    these connections, left idle
+    """
+    server = mute_server()
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.load_cert_chain("tests/localhost.pem")
+    handles = []
+
+    def serve():
+        while True:
+            try:
+                handle = server.accept()[0]
+            except socket.error:
+                return
+            try:
+                handles.append(context.wrap_socket(handle, server_side=True))
+            except (ssl.SSLError, socket.error):
+                pass
+            # the connection is closed along with its last socket object
+            handle.close()
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server, handles
+
+
+class EchoClient:
+    """
+    hand written equivalent of a generated client of an echo(value) method
+    """
+
+    def __init__(self, iprot, oprot=None):
+        self._iprot = self._oprot = iprot
+        if oprot is not None:
+            self._oprot = oprot
+        self._seqid = 0
+
+    def echo(self, value):
+        self.send_echo(value)
+        return self.recv_echo()
+
+    def send_echo(self, value):
+        self._oprot.writeMessageBegin("echo", TMessageType.CALL, self._seqid)
+        self._oprot.writeString(value)
+        self._oprot.writeMessageEnd()
+        self._oprot.trans.flush()
+
+    def recv_echo(self):
+        iprot = self._iprot
+        (fname, mtype, rseqid) = iprot.readMessageBegin()
+        if mtype == TMessageType.EXCEPTION:
+            x = TApplicationException()
+            x.read(iprot)
+            iprot.readMessageEnd()
+            raise x
+        value = iprot.readString()
+        iprot.readMessageEnd()
+        return value
+
+
+def echo_server(batch=1, layer=TTransport.TFramedTransport,
+                multiplexed=False, connections=1):
+    """
+    returns a listening socket whose server replies to the calls of
+    EchoClient, through the transport *layer* (framed by default), to each
+    *batch* of calls in reverse order. "fail" is replied with an exception,
+    "slow" after 0.1 second. *multiplexed* servers prefix the values with
+    the name of the service. The server accepts *connections* connections,
+    one after the other.
+    """
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(8)
+
+    def serve():
+        for i in range(connections):
+            handle = server.accept()[0]
+            serve_connection(handle)
+
+    def serve_connection(handle):
+        trans = TSocket.TSocket()
+        trans.setHandle(handle)
+        proto = TBinaryProtocol.TBinaryProtocol(layer(trans))
+        try:
+            while True:
+                calls = []
+                for i in range(batch):
+                    name, mtype, seqid = proto.readMessageBegin()
+                    value = proto.readString()
+                    if multiplexed:
+                        service, name = name.split(":")
+                        value = service + ":" + value
+                    calls.append((name, seqid, value))
+                    proto.readMessageEnd()
+                for name, seqid, value in reversed(calls):
+                    if value == "slow":
+                        time.sleep(0.1)
+                    if value == "fail":
+                        proto.writeMessageBegin(name, TMessageType.EXCEPTION,
+                                                seqid)
+                        TApplicationException(message="failed").write(proto)
+                    else:
+                        proto.writeMessageBegin(name, TMessageType.REPLY,
+                                                seqid)
+                        proto.writeString(value)
+                    proto.writeMessageEnd()
+                    proto.trans.flush()
+        except (TTransport.TTransportException, socket.error):
+            # the client left
+            pass
+        finally:
+            handle.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def http_server(drop=()):
+    """
+    returns the url of a HTTP/1.1 server of the echo service of the
+    benchmark, the list of the headers of its requests and the list of its
+    connections. Responses are gzip encoded when accepted, the connections
+    of the requests numbered in *drop* are closed once they are read.
+    """
+    requests = []
+    connections = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            connections.append(self.client_address)
+
+        def do_POST(self):
+            requests.append(self.headers)
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if len(requests) - 1 in drop:
+                self.close_connection = 1
+                return
+            itrans = TTransport.TMemoryBuffer(body)
+            otrans = TTransport.TMemoryBuffer()
+            benchmark.Processor().process(
+                TBinaryProtocol.TBinaryProtocol(itrans),
+                TBinaryProtocol.TBinaryProtocol(otrans))
+            reply = otrans.getvalue()
+            self.send_response(200)
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                compressor = zlib.compressobj(9, zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+                reply = compressor.compress(reply) + compressor.flush()
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{port}/echo".format(port=server.server_address[1])
+    return url, requests, connections
+
+
+def unused_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class StubConnection:
+
+    def __init__(self):
+        self.opened = False
+        self.created_at = self.last_used = 0
+
+    def isOpen(self):
+        return self.opened
+
+    def isAlive(self):
+        return self.opened
+
+    def open(self):
+        self.opened = True
+
+    def close(self):
+        self.opened = False
+
+
 class TestSequenceFunctions(unittest.TestCase):
 
     def setUp(self):
@@ -135,6 +559,47 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEquals(client.transport.port, 9090)
         self.assertEquals(client.transport.host, "192.168.0.42")
 
+    def test_transport_tcps_shared_context(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = [
+            "tcps://192.168.0.42", "unixs:///tmp/thrift.sock"]
+        self.app.config["THRIFTCLIENT_SSL_CA_CERTS"] = "tests/cacert.pem"
+        client = ThriftClient(StubClient, self.app)
+        tls = set(
+            client._create_connection(client._config, endpoint).socket.tls
+            for endpoint in client.endpoints * 2)
+        self.assertEquals(len(tls), 1)
+        tls = tls.pop()
+        self.assertEquals(tls.context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertFalse(tls.context.check_hostname)
+
+    def test_transport_https_context(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "https://192.168.0.42/"
+        self.app.config["THRIFTCLIENT_SSL_VALIDATE"] = False
+        client = ThriftClient(StubClient, self.app)
+        tls = client._create_connection(client._config,
+                                        client.endpoints[0]).socket.tls
+        self.assertEquals(tls.context.verify_mode, ssl.CERT_NONE)
+
+    def test_transport_https_handshakes(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "https://192.168.0.42/"
+        self.app.config["THRIFTCLIENT_SSL_VALIDATE"] = False
+        client = ThriftClient(StubClient, self.app)
+
+        handle = socket.socket()
+
+        def connect(http):
+            http.sock = handle
+        connect_https = httplib.HTTPSConnection.connect
+        httplib.HTTPSConnection.connect = connect
+        try:
+            with self.app.app_context():
+                # httplib connects once the request is sent
+                client.transport._THttpClient__http._conn.connect()
+                self.assertEquals(client.tls.handshakes, 1)
+        finally:
+            httplib.HTTPSConnection.connect = connect_https
+            handle.close()
+
     def test_transport_tcps_forgot_cert(self):
         self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcps://192.168.0.42"
         self.app.config["THRIFTCLIENT_SSL_VALIDATE"] = True
@@ -231,6 +696,7 @@ class TestSequenceFunctions(unittest.TestCase):
 
         @self.app.route("/testme")
         def testme():
+            client.client
             return "KO"
 
         testclient = self.app.test_client()
@@ -238,6 +704,55 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEquals(ret.status_code, 500)
         self.assertFalse(client.transport.isOpen())
 
+    def test_connection_unused(self):
+        """
+        routes which don't use the client don't connect
+        """
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://localhost:8735"
+        client = ThriftClient(StubClient, self.app)
+
+        @self.app.route("/testme")
+        def testme():
+            return "OK"
+
+        testclient = self.app.test_client()
+        ret = testclient.get("/testme")
+        self.assertEquals(ret.status_code, 200)
+
+    def test_connection_per_context(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(StubClient, self.app)
+        transports = []
+
+        @self.app.route("/testme")
+        def testme():
+            transports.append(client.transport)
+            self.assertTrue(client.transport is transports[-1])
+            return "OK" if client.transport.isOpen() else "KO"
+
+        testclient = self.app.test_client()
+        self.assertEquals(testclient.get("/testme").data, "OK")
+        self.assertEquals(testclient.get("/testme").data, "OK")
+        self.assertTrue(transports[0] is not transports[1])
+        self.assertFalse(transports[0].isOpen())
+        self.assertFalse(transports[1].isOpen())
+
+    def test_connection_per_thread(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(StubClient, self.app)
+        transports = []
+
+        def run():
+            with self.app.app_context():
+                transports.append(client.transport)
+
+        threads = [threading.Thread(target=run) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(transports[0] is not transports[1])
+
     def test_no_alwaysconnect(self):
         self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://localhost:8735"
         self.app.config["THRIFTCLIENT_ALWAYS_CONNECT"] = False
@@ -291,6 +806,2014 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEquals(ret.data, "OK")
         self.assertFalse(client.transport.isOpen())
 
+    def test_pool_connection(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = ThriftClient(StubClient, self.app)
+        seen = []
+
+        @self.app.route("/testme")
+        def testme():
+            seen.append(client.transport)
+            return "OK" if client.transport.isOpen() else "KO"
+
+        testclient = self.app.test_client()
+        ret = testclient.get("/testme")
+        self.assertEquals(ret.data, "OK")
+        ret = testclient.get("/testme")
+        self.assertEquals(ret.data, "OK")
+        # the connection is kept opened and reused by the next request
+        self.assertTrue(seen[0] is seen[1])
+        self.assertTrue(seen[0] is not client.transport)
+        self.assertTrue(seen[0].isOpen())
+        self.assertEquals(client.pool.size, 1)
+        self.assertEquals(client.pool.idle, 1)
+
+    def test_pool_connect_ctx(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_ALWAYS_CONNECT"] = False
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = ThriftClient(StubClient, self.app)
+
+        with client.connect():
+            transport = client.transport
+            with client.connect():
+                self.assertTrue(client.transport is transport)
+            self.assertTrue(client.transport is transport)
+            self.assertEquals(client.pool.idle, 0)
+        self.assertTrue(client.transport is not transport)
+        self.assertEquals(client.pool.idle, 1)
+
+    def test_pool_discard_broken_connection(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_ALWAYS_CONNECT"] = False
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = ThriftClient(StubClient, self.app)
+
+        with self.assertRaises(TTransport.TTransportException):
+            with client.connect():
+                raise TTransport.TTransportException()
+        self.assertEquals(client.pool.size, 0)
+
+    def test_lazy_connect_unused(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://localhost:8735"
+        self.app.config["THRIFTCLIENT_LAZY_CONNECT"] = True
+        client = ThriftClient(StubClient, self.app)
+
+        @self.app.route("/testme")
+        def testme():
+            client.client
+            return "OK" if client.transport.isOpen() else "KO"
+
+        testclient = self.app.test_client()
+        ret = testclient.get("/testme")
+        self.assertEquals(ret.status_code, 200)
+        self.assertEquals(ret.data, "OK")
+
+    def test_lazy_connect_on_call(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            server.getsockname()[1])
+        self.app.config["THRIFTCLIENT_LAZY_CONNECT"] = True
+        client = ThriftClient(StubClient, self.app)
+
+        with self.app.app_context():
+            self.assertFalse(client.transport.connected)
+            client.transport.write("ping")
+            self.assertTrue(client.transport.connected)
+            transport = client.transport
+        self.assertFalse(transport.connected)
+        server.close()
+
+    def test_lazy_connect_no_server(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://localhost:8735"
+        self.app.config["THRIFTCLIENT_LAZY_CONNECT"] = True
+        client = ThriftClient(StubClient, self.app)
+
+        with self.app.app_context():
+            with self.assertRaises(TTransport.TTransportException):
+                client.transport.write("ping")
+            self.assertFalse(client.transport.connected)
+
+    def test_keepalive(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            server.getsockname()[1])
+        self.app.config["THRIFTCLIENT_TCP_KEEPALIVE"] = True
+        self.app.config["THRIFTCLIENT_TCP_KEEPALIVE_IDLE"] = 30
+        client = ThriftClient(StubClient, self.app)
+
+        with self.app.app_context():
+            handle = client.transport.handle
+            self.assertEquals(
+                handle.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE), 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                self.assertEquals(handle.getsockopt(socket.IPPROTO_TCP,
+                                                    socket.TCP_KEEPIDLE), 30)
+        server.close()
+
+    def test_nodelay(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            server.getsockname()[1])
+        client = ThriftClient(StubClient, self.app)
+
+        with self.app.app_context():
+            handle = client.transport.handle
+            self.assertTrue(
+                handle.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+        server.close()
+
+    def test_keepalive_http(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_TCP_KEEPALIVE"] = True
+        with self.assertRaises(RuntimeError):
+            ThriftClient(StubClient, self.app)
+
+    def test_deferred_connection(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:9090"
+        self.app.config["THRIFTCLIENT_ALWAYS_CONNECT"] = False
+        CountingClient.instances = 0
+        client = ThriftClient(CountingClient, self.app)
+        self.assertEquals(CountingClient.instances, 0)
+        with self.app.app_context():
+            client.client
+        self.assertEquals(CountingClient.instances, 1)
+
+    def test_lazy_imports(self):
+        modules = ["thrift.transport.TSSLSocket",
+                   "thrift.transport.THttpClient",
+                   "thrift.transport.TZlibTransport",
+                   "thrift.protocol.TCompactProtocol",
+                   "thrift.protocol.TJSONProtocol",
+                   "flask_thriftclient.compression"]
+        script = "\n".join([
+            "import sys",
+            "from flask import Flask",
+            "from flask_thriftclient import ThriftClient",
+            "app = Flask(__name__)",
+            "app.config['THRIFTCLIENT_TRANSPORT'] = sys.argv[1]",
+            "app.config['THRIFTCLIENT_PROTOCOL'] = sys.argv[2]",
+            "ThriftClient(lambda protocol: None, app)",
+            "print(' '.join(m for m in sys.argv[3:] if m in sys.modules))",
+        ])
+
+        def imported(url, protocol):
+            return subprocess.check_output(
+                [sys.executable, "-c", script, url, protocol] + modules
+            ).split()
+
+        self.assertEquals(imported("tcp://localhost", "BINARY"), [])
+        # the http transport is imported by the first connection
+        self.assertEquals(imported("http://localhost", "JSON"),
+                          ["thrift.protocol.TJSONProtocol"])
+
+    def test_pool_drop_closed_connection(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(2)
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            server.getsockname()[1])
+        self.app.config["THRIFTCLIENT_ALWAYS_CONNECT"] = False
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = ThriftClient(StubClient, self.app)
+
+        with client.connect():
+            transport = client.transport
+        server.accept()[0].close()
+        time.sleep(0.05)
+        with client.connect():
+            self.assertTrue(client.transport is not transport)
+        self.assertEquals(client.pool.size, 1)
+        server.close()
+
+    def test_idempotent_retry(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(FlakyClient, self.app)
+        client.idempotent("ping")
+
+        with self.app.app_context():
+            self.assertEquals(client.client.ping(), "pong")
+            self.assertEquals(client.client.calls, 2)
+            self.assertTrue(client.transport.isOpen())
+
+    def test_not_idempotent(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(FlakyClient, self.app)
+
+        with self.app.app_context():
+            with self.assertRaises(TTransport.TTransportException):
+                client.client.ping()
+            self.assertEquals(client.client.calls, 1)
+
+    def test_transport_list(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = [
+            "http://foo.bar.com:8080/end/point",
+            "http://foo.bar.com:8081/end/point?weight=2",
+        ]
+        client = ThriftClient(StubClient, self.app)
+        self.assertEquals([endpoint.weight for endpoint in client.endpoints],
+                          [1, 2])
+        ports = []
+        for i in range(4):
+            with self.app.app_context():
+                self.assertEquals(client.transport.path, "/end/point")
+                ports.append(client.transport.port)
+        self.assertEquals(ports, [8080, 8081, 8080, 8081])
+
+    def test_transport_empty_list(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = []
+        with self.assertRaises(RuntimeError):
+            ThriftClient(StubClient, self.app)
+
+    def test_transport_list_bad_url(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = ["http://foo.bar.com",
+                                                     "bad://whatever"]
+        with self.assertRaises(RuntimeError):
+            ThriftClient(StubClient, self.app)
+
+    def test_transport_list_pool(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = ["http://foo.bar.com",
+                                                     "http://foo.bar.org"]
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = ThriftClient(StubClient, self.app)
+        self.assertTrue(client.pool is None)
+        for i in range(2):
+            with self.app.app_context():
+                client.client
+        self.assertEquals([endpoint.pool.idle for endpoint in client.endpoints],
+                          [1, 1])
+
+    def test_balancer_weighted(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = [
+            "tcp://foo.bar.com?weight=3", "tcp://foo.bar.org"]
+        self.app.config["THRIFTCLIENT_BALANCER"] = ThriftClient.WEIGHTED
+        self.app.config["THRIFTCLIENT_ALWAYS_CONNECT"] = False
+        client = ThriftClient(StubClient, self.app)
+        hosts = []
+        for i in range(8):
+            with self.app.app_context():
+                hosts.append(client.transport.host)
+        self.assertEquals(hosts.count("foo.bar.com"), 6)
+
+    def test_balancer_custom(self):
+        class LastBalancer(object):
+            def choose(self, endpoints):
+                return endpoints[-1]
+
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = ["http://foo.bar.com",
+                                                     "http://foo.bar.org"]
+        self.app.config["THRIFTCLIENT_BALANCER"] = LastBalancer()
+        client = ThriftClient(StubClient, self.app)
+        with self.app.app_context():
+            self.assertEquals(client.transport.host, "foo.bar.org")
+
+    def test_balancer_bad(self):
+        self.app.config["THRIFTCLIENT_BALANCER"] = "BAD"
+        with self.assertRaises(RuntimeError):
+            ThriftClient(StubClient, self.app)
+
+    def test_outstanding_calls(self):
+        outstanding = []
+
+        class CountingClient:
+            def __init__(self, protocol):
+                pass
+
+            def ping(self):
+                outstanding.append(client.endpoints[0].outstanding)
+
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(CountingClient, self.app)
+        with self.app.app_context():
+            client.client.ping()
+        self.assertEquals(outstanding, [1])
+        self.assertEquals(client.endpoints[0].outstanding, 0)
+
+    def test_breaker_fail_fast(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            unused_port())
+        self.app.config["THRIFTCLIENT_BREAKER_THRESHOLD"] = 2
+        client = ThriftClient(StubClient, self.app)
+
+        for i in range(2):
+            with self.app.app_context():
+                with self.assertRaises(RuntimeError) as raised:
+                    client.client
+                self.assertFalse(isinstance(raised.exception,
+                                            CircuitOpenError))
+        with self.app.app_context():
+            with self.assertRaises(CircuitOpenError):
+                client.client
+        self.assertEquals(client.endpoints[0].breaker.state,
+                          CircuitBreaker.OPEN)
+
+    def test_breaker_failover(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = [
+            "tcp://127.0.0.1:%d" % unused_port(), "http://localhost:8735"]
+        self.app.config["THRIFTCLIENT_BREAKER_THRESHOLD"] = 1
+        client = ThriftClient(StubClient, self.app)
+
+        for i in range(3):
+            with self.app.app_context():
+                self.assertTrue(isinstance(client.transport,
+                                           THttpClient.THttpClient))
+        self.assertTrue(client.endpoints[0].breaker.isOpen())
+
+    def test_breaker_call_failures(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_BREAKER_THRESHOLD"] = 1
+        client = ThriftClient(FlakyClient, self.app)
+
+        with self.app.app_context():
+            with self.assertRaises(TTransport.TTransportException):
+                client.client.ping()
+            with self.assertRaises(CircuitOpenError):
+                client.client.ping()
+
+    def test_breaker_manual_open(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            unused_port())
+        self.app.config["THRIFTCLIENT_BREAKER_THRESHOLD"] = 1
+        self.app.config["THRIFTCLIENT_BREAKER_RESET_TIMEOUT"] = 0.01
+        self.app.config["THRIFTCLIENT_ALWAYS_CONNECT"] = False
+        client = ThriftClient(StubClient, self.app)
+        breaker = client.endpoints[0].breaker
+        breaker.failure()
+        time.sleep(0.02)
+
+        # connections which aren't opened don't take the probe
+        with self.app.app_context():
+            with self.assertRaises(TTransport.TTransportException):
+                client.transport.open()
+        self.assertEquals(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.available())
+
+        # connect() settles its probe
+        with self.app.app_context():
+            with self.assertRaises(RuntimeError):
+                with client.connect():
+                    pass
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+
+    def test_breaker_lazy_connect(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            unused_port())
+        self.app.config["THRIFTCLIENT_BREAKER_THRESHOLD"] = 1
+        self.app.config["THRIFTCLIENT_BREAKER_RESET_TIMEOUT"] = 0.01
+        self.app.config["THRIFTCLIENT_LAZY_CONNECT"] = True
+        client = ThriftClient(ReadingClient, self.app)
+        breaker = client.endpoints[0].breaker
+        breaker.failure()
+        time.sleep(0.02)
+
+        with self.app.app_context():
+            proxy = client.client
+            # nothing was connected yet
+            self.assertEquals(breaker.state, CircuitBreaker.HALF_OPEN)
+            with self.assertRaises(TTransport.TTransportException):
+                proxy.ping()
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+
+    def test_breaker_accept_then_close(self):
+        server = closing_server()
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            server.getsockname()[1])
+        self.app.config["THRIFTCLIENT_BREAKER_THRESHOLD"] = 3
+        self.app.config["THRIFTCLIENT_OUTLIER_ERRORS"] = 3
+        client = ThriftClient(ReadingClient, self.app)
+        endpoint = client.endpoints[0]
+
+        # the connections succeed, their calls don't
+        try:
+            for i in range(3):
+                with self.app.app_context():
+                    with self.assertRaises((TTransport.TTransportException,
+                                            socket.error)):
+                        client.client.ping()
+            self.assertEquals(endpoint.breaker.state, CircuitBreaker.OPEN)
+            self.assertTrue(endpoint.ejected())
+        finally:
+            server.close()
+
+    def test_outlier_ejection(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = ["http://foo.bar.com",
+                                                     "http://foo.bar.org"]
+        self.app.config["THRIFTCLIENT_OUTLIER_ERRORS"] = 1
+        client = ThriftClient(StubClient, self.app)
+        client.endpoints[0].failure()
+
+        for i in range(4):
+            with self.app.app_context():
+                self.assertEquals(client.transport.host, "foo.bar.org")
+        client.endpoints[1].failure()
+        # every endpoint is ejected, they are all used
+        hosts = set()
+        for i in range(4):
+            with self.app.app_context():
+                hosts.add(client.transport.host)
+        self.assertEquals(len(hosts), 2)
+
+    def test_read_timeout(self):
+        server = mute_server()
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            server.getsockname()[1])
+        self.app.config["THRIFTCLIENT_READ_TIMEOUT"] = 0.05
+        client = ThriftClient(ReadingClient, self.app)
+
+        with self.app.app_context():
+            with self.assertRaises(ThriftTimeout) as raised:
+                client.client.ping()
+            self.assertFalse(isinstance(raised.exception, DeadlineExceeded))
+        server.close()
+
+    def test_http_timeouts(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_CONNECT_TIMEOUT"] = 1
+        self.app.config["THRIFTCLIENT_READ_TIMEOUT"] = 2
+        client = ThriftClient(StubClient, self.app)
+        self.assertEquals(client.transport._timeout, 2)
+        with self.app.app_context():
+            http = client.transport._THttpClient__http
+            self.assertEquals(http._conn.timeout, 2)
+
+    def test_http_timeouts_process(self):
+        url, requests, connections = http_server()
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = url
+        self.app.config["THRIFTCLIENT_READ_TIMEOUT"] = 5
+        client = ThriftClient(benchmark.Client, self.app)
+
+        # the timeout is the one of the connection, never the default
+        # timeout of the process shared by every thread
+        defaults = []
+        setdefaulttimeout = socket.setdefaulttimeout
+        socket.setdefaulttimeout = defaults.append
+        try:
+            with self.app.app_context():
+                with client.deadline(2):
+                    self.assertEquals(client.client.echo("a"), "a")
+        finally:
+            socket.setdefaulttimeout = setdefaulttimeout
+        self.assertEquals(defaults, [])
+
+    def test_deadline(self):
+        server = mute_server()
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcp://127.0.0.1:%d" % (
+            server.getsockname()[1])
+        self.app.config["THRIFTCLIENT_READ_TIMEOUT"] = 10
+        client = ThriftClient(ReadingClient, self.app)
+
+        with self.app.app_context():
+            start = time.time()
+            with self.assertRaises(DeadlineExceeded):
+                with client.deadline(0.05):
+                    client.client.ping()
+            self.assertTrue(time.time() - start < 1)
+            # the late reply must not be read by the next call
+            self.assertFalse(client.transport.isOpen())
+            # the bound is removed after the block
+            self.assertEquals(client.transport._limit, None)
+        server.close()
+
+    def test_deadline_exceeded_before_call(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(FlakyClient, self.app)
+
+        with self.app.app_context():
+            with client.deadline(0.01):
+                time.sleep(0.02)
+                with self.assertRaises(DeadlineExceeded):
+                    client.client.ping()
+            self.assertEquals(client.client.calls, 0)
+
+    def test_deadline_pool_checkout(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_ALWAYS_CONNECT"] = False
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        self.app.config["THRIFTCLIENT_POOL_MAX_SIZE"] = 1
+        client = ThriftClient(StubClient, self.app)
+        conn = client.pool.checkout()
+
+        with self.assertRaises(DeadlineExceeded):
+            with client.deadline(0.05):
+                with client.connect():
+                    pass
+        client.pool.checkin(conn)
+
+    def test_gather(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(SleepingClient, self.app)
+
+        start = time.time()
+        results = client.gather([lambda c: c.sleep(0.1),
+                                 lambda c: c.fail(),
+                                 lambda c: c.sleep(0.2)] +
+                                [lambda c: c.sleep(0.1)] * 5)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEquals(results[0], 0.1)
+        self.assertTrue(isinstance(results[1], ValueError))
+        self.assertEquals(results[2:], [0.2] + [0.1] * 5)
+
+    def test_gather_separate_connections(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = ThriftClient(SleepingClient, self.app)
+
+        results = client.gather([lambda c: c.sleep(0.05)] * 3)
+        self.assertEquals(results, [0.05] * 3)
+        self.assertEquals(client.pool.size, 3)
+        self.assertEquals(client.pool.idle, 3)
+
+    def test_gather_timeout(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(SleepingClient, self.app)
+
+        results = client.gather([lambda c: c.sleep(0.01),
+                                 lambda c: c.sleep(0.5)], timeout=0.1)
+        self.assertEquals(results[0], 0.01)
+        self.assertTrue(isinstance(results[1], DeadlineExceeded))
+
+    def test_submit(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(SleepingClient, self.app)
+
+        future = client.submit(lambda c: c.sleep(0.01))
+        self.assertEquals(future.result(1), 0.01)
+
+    def test_async_client(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = AsyncThriftClient(SleepingClient, self.app)
+
+        start = time.time()
+        futures = [client.client.sleep(0.1) for i in range(5)]
+        failed = client.client.fail()
+        self.assertEquals([future.result() for future in futures], [0.1] * 5)
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertTrue(isinstance(failed.exception(), ValueError))
+        self.assertEquals(client.pool.size, 6)
+
+    def test_async_client_not_rpc(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = AsyncThriftClient(SleepingClient, self.app)
+        with self.assertRaises(AttributeError):
+            client.client.send_sleep
+        with self.assertRaises(AttributeError):
+            client.client.missing
+
+    def test_async_client_deadline(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = AsyncThriftClient(SleepingClient, self.app)
+
+        with client.deadline(0.01):
+            time.sleep(0.02)
+            future = client.client.sleep(0)
+        self.assertTrue(isinstance(future.exception(1), DeadlineExceeded))
+
+    def configure_echo(self, server):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = (
+            "tcp://127.0.0.1:{port}".format(port=server.getsockname()[1]))
+        self.app.config["THRIFTCLIENT_FRAMED"] = True
+
+    def test_caught_timeout(self):
+        server = echo_server(connections=3)
+        self.configure_echo(server)
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        self.app.config["THRIFTCLIENT_POOL_MAX_SIZE"] = 1
+        client = ThriftClient(EchoClient, self.app)
+
+        @self.app.route("/slow")
+        def slow():
+            try:
+                with client.deadline(0.05):
+                    return client.client.echo("slow")
+            except DeadlineExceeded:
+                return "timeout"
+
+        @self.app.route("/fast/<value>")
+        def fast(value):
+            return client.client.echo(value)
+
+        app = self.app.test_client()
+        self.assertEquals(app.get("/slow").data, "timeout")
+        # the late reply of the slow call is not read by the next request
+        self.assertEquals(app.get("/fast/hello").data, "hello")
+
+        # nor by the next call of the same context
+        with self.app.app_context():
+            with self.assertRaises(DeadlineExceeded):
+                with client.deadline(0.05):
+                    client.client.echo("slow")
+            self.assertEquals(client.client.echo("again"), "again")
+        server.close()
+
+    def test_pipeline(self):
+        server = echo_server()
+        self.configure_echo(server)
+        client = ThriftClient(EchoClient, self.app)
+
+        with self.app.app_context():
+            pipe = client.pipeline()
+            for value in ("a", "fail", "c"):
+                pipe.echo(value)
+            self.assertEquals(len(pipe), 3)
+            results = pipe.execute()
+            self.assertEquals(len(pipe), 0)
+            self.assertEquals(results[0], "a")
+            self.assertTrue(isinstance(results[1], TApplicationException))
+            self.assertEquals(results[2], "c")
+            # the connection is still usable
+            self.assertEquals(client.client.echo("d"), "d")
+            self.assertEquals(client.client._seqid, 0)
+        server.close()
+
+    def test_pipeline_out_of_order(self):
+        server = echo_server(batch=3)
+        self.configure_echo(server)
+        client = ThriftClient(EchoClient, self.app)
+
+        with self.app.app_context():
+            pipe = client.pipeline(ordered=False)
+            for value in ("a", "b", "c"):
+                pipe.echo(value)
+            self.assertEquals(pipe.execute(), ["a", "b", "c"])
+
+            pipe = client.pipeline()
+            for value in ("a", "b", "c"):
+                pipe.echo(value)
+            with self.assertRaises(TProtocol.TProtocolException):
+                pipe.execute()
+        server.close()
+
+    def test_pipeline_not_rpc(self):
+        client = ThriftClient(EchoClient, self.app)
+        with self.assertRaises(AttributeError):
+            client.pipeline().send_echo
+
+    def test_pipeline_http(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(EchoClient, self.app)
+
+        with self.app.app_context():
+            pipe = client.pipeline()
+            pipe.echo("a")
+            with self.assertRaises(RuntimeError):
+                pipe.execute()
+
+    def test_metrics(self):
+        server = echo_server()
+        self.configure_echo(server)
+        registry = MetricsRegistry()
+        self.app.config["THRIFTCLIENT_METRICS"] = registry
+        client = ThriftClient(EchoClient, self.app)
+
+        with self.app.app_context():
+            self.assertEquals(client.client.echo("abc"), "abc")
+            with self.assertRaises(TApplicationException):
+                client.client.echo("fail")
+
+        snapshot = registry.snapshot()
+        echo = snapshot["methods"]["echo"]
+        self.assertEquals(echo["calls"], 2)
+        self.assertEquals(echo["errors"], 1)
+        self.assertEquals(echo["latency"]["count"], 2)
+        # 4 bytes of frame size, 16 of message header, 4 + 3 of string
+        self.assertEquals(registry.methods["echo"].sent, 27 + 28)
+        self.assertTrue(echo["received"] > 0)
+        self.assertEquals(snapshot["connects"]["count"], 1)
+        self.assertEquals(snapshot["handshakes"]["count"], 0)
+        server.close()
+
+    def test_metrics_pool_wait(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        self.app.config["THRIFTCLIENT_POOL_MAX_SIZE"] = 1
+        self.app.config["THRIFTCLIENT_POOL_TIMEOUT"] = 0.05
+        registry = MetricsRegistry()
+        self.app.config["THRIFTCLIENT_METRICS"] = registry
+        client = ThriftClient(StubClient, self.app)
+
+        conn = client.pool.checkout()
+        with self.assertRaises(ThriftTimeout):
+            client.pool.checkout()
+        client.pool.checkin(conn)
+        self.assertEquals(registry.pool_waits.count, 2)
+        self.assertTrue(registry.pool_waits.sum >= 0.05)
+
+    def test_statsd_sink(self):
+        server = echo_server()
+        self.configure_echo(server)
+        sent = []
+        self.app.config["THRIFTCLIENT_METRICS"] = StatsdSink(
+            lambda name, ms: sent.append(("timing", name)),
+            lambda name, value: sent.append(("increment", name)),
+            prefix="app")
+        client = ThriftClient(EchoClient, self.app)
+
+        with self.app.app_context():
+            client.client.echo("abc")
+        self.assertEquals(sent, [
+            ("timing", "app.connect"),
+            ("timing", "app.call.echo"),
+            ("increment", "app.call.echo.sent"),
+            ("increment", "app.call.echo.received"),
+        ])
+        server.close()
+
+    def test_signal_sink(self):
+        server = echo_server()
+        self.configure_echo(server)
+        self.app.config["THRIFTCLIENT_METRICS"] = SignalSink()
+        client = ThriftClient(EchoClient, self.app)
+
+        # sending works without blinker, nothing receives the signals then
+        with self.app.app_context():
+            self.assertEquals(client.client.echo("abc"), "abc")
+        server.close()
+
+    def test_cached(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(LookupClient, self.app)
+        cache = client.cached("get", ttl=0.2)
+        LookupClient.calls = []
+
+        with self.app.app_context():
+            self.assertEquals(client.client.get("a"), "A")
+        with self.app.app_context():
+            self.assertEquals(client.client.get("a"), "A")
+            self.assertEquals(client.client.get(key="b"), "B")
+        self.assertEquals(LookupClient.calls, ["a", "b"])
+
+        cache.invalidate("a")
+        with self.app.app_context():
+            self.assertEquals(client.client.get("a"), "A")
+            self.assertEquals(client.client.get("b"), "B")
+        self.assertEquals(LookupClient.calls, ["a", "b", "a"])
+
+        time.sleep(0.2)
+        with self.app.app_context():
+            client.client.get("b")
+        self.assertEquals(LookupClient.calls, ["a", "b", "a", "b"])
+
+    def test_cached_errors(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(LookupClient, self.app)
+        client.cached("get")
+        LookupClient.calls = []
+
+        for i in range(2):
+            with self.app.app_context():
+                with self.assertRaises(ValueError):
+                    client.client.get("fail")
+        self.assertEquals(LookupClient.calls, ["fail", "fail"])
+
+    def test_cached_coalescing(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(LookupClient, self.app)
+        client.cached("get")
+        LookupClient.calls = []
+
+        self.assertEquals(self.call_concurrently(client, "a"), ["A"] * 5)
+        self.assertEquals(LookupClient.calls, ["a"])
+
+    def test_cached_not_rpc(self):
+        client = ThriftClient(LookupClient, self.app)
+        with self.assertRaises(RuntimeError):
+            client.cached("missing")
+        # no argument struct
+        with self.assertRaises(RuntimeError):
+            ThriftClient(SleepingClient, self.app).cached("sleep")
+
+    def call_concurrently(self, client, key, count=5):
+        results = []
+
+        def get():
+            with self.app.app_context():
+                try:
+                    results.append(client.client.get(key))
+                except Exception as e:
+                    results.append(e)
+        threads = [threading.Thread(target=get) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_flight(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_SINGLE_FLIGHT"] = True
+        client = ThriftClient(LookupClient, self.app)
+        client.idempotent("get")
+        LookupClient.calls = []
+
+        self.assertEquals(self.call_concurrently(client, "a"), ["A"] * 5)
+        self.assertEquals(LookupClient.calls, ["a"])
+
+        results = self.call_concurrently(client, "fail")
+        self.assertTrue(all(isinstance(result, ValueError)
+                            for result in results))
+        self.assertEquals(LookupClient.calls, ["a", "fail"])
+
+        # results are not kept
+        self.call_concurrently(client, "a", count=1)
+        self.assertEquals(LookupClient.calls, ["a", "fail", "a"])
+
+    def test_single_flight_idempotent_only(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_SINGLE_FLIGHT"] = True
+        client = ThriftClient(LookupClient, self.app)
+        LookupClient.calls = []
+
+        self.call_concurrently(client, "a")
+        self.assertEquals(LookupClient.calls, ["a"] * 5)
+
+    def test_load(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(LookupClient, self.app)
+        client.batched("get", "getMany", max_size=2)
+        LookupClient.calls = []
+
+        with self.app.app_context():
+            futures = [client.load("get", key) for key in "abac"]
+            self.assertEquals(LookupClient.calls, [])
+            self.assertEquals([future.result() for future in futures],
+                              ["A", "B", "A", "C"])
+            # point calls aren't batched without window
+            self.assertEquals(client.client.get("d"), "D")
+        self.assertEquals(LookupClient.calls, [["a", "b"], ["c"], "d"])
+
+    def test_load_per_context(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(LookupClient, self.app)
+        client.batched("get", "getMany")
+        LookupClient.calls = []
+
+        with self.app.app_context():
+            forgotten = client.load("get", "a")
+        # the keys of a context are not given to the batch of the next one
+        with self.app.app_context():
+            self.assertEquals(client.load("get", "b").result(), "B")
+        self.assertEquals(LookupClient.calls, [["b"]])
+        self.assertTrue(isinstance(forgotten.exception(), RuntimeError))
+
+    def test_load_errors(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(LookupClient, self.app)
+        client.batched("get", "getMany")
+        client.batched("getMap", "getMap")
+        LookupClient.calls = []
+
+        with self.app.app_context():
+            first = client.load("get", "a")
+            failed = client.load("get", "fail")
+            with self.assertRaises(ValueError):
+                first.result()
+            self.assertTrue(isinstance(failed.exception(), ValueError))
+
+            # dict results, after the first batch ran
+            found = client.load("getMap", "a")
+            missing = client.load("getMap", "missing")
+            self.assertEquals(found.result(), "A")
+            self.assertEquals(missing.result(), None)
+        self.assertEquals(LookupClient.calls, [["a", "fail"],
+                                               ["a", "missing"]])
+
+    def test_batched_window(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(LookupClient, self.app)
+        client.batched("get", "getMany", max_size=3, window=0.1)
+        LookupClient.calls = []
+
+        results = []
+
+        def get(key):
+            with self.app.app_context():
+                results.append(client.client.get(key))
+        threads = [threading.Thread(target=get, args=(key,))
+                   for key in "abcd"]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(sorted(results), ["A", "B", "C", "D"])
+        # the first batch is dispatched once full, the second one once the
+        # window is over
+        self.assertEquals([len(keys) for keys in LookupClient.calls], [3, 1])
+        self.assertTrue(time.time() - start < 0.3)
+
+    def test_batched_not_rpc(self):
+        client = ThriftClient(LookupClient, self.app)
+        with self.assertRaises(RuntimeError):
+            client.batched("get", "missing")
+        with self.app.app_context():
+            with self.assertRaises(RuntimeError):
+                client.load("get", "a")
+
+    @unittest.skipIf(fastbinary is None, "thrift C extension not installed")
+    def test_accelerated(self):
+        client = ThriftClient(StubClient, self.app)
+        self.assertTrue(client.accelerated)
+        self.assertTrue(isinstance(client.protocol,
+                                   TBinaryProtocol.TBinaryProtocolAccelerated))
+
+    def test_accelerated_off(self):
+        self.app.config["THRIFTCLIENT_ACCELERATED"] = False
+        client = ThriftClient(StubClient, self.app)
+        self.assertFalse(client.accelerated)
+        self.assertEquals(client.protocol.__class__,
+                          TBinaryProtocol.TBinaryProtocol)
+
+    def test_accelerated_unavailable(self):
+        self.app.config["THRIFTCLIENT_PROTOCOL"] = ThriftClient.JSON
+        client = ThriftClient(StubClient, self.app)
+        self.assertFalse(client.accelerated)
+
+        self.app.config["THRIFTCLIENT_ACCELERATED"] = True
+        with self.assertRaises(RuntimeError):
+            ThriftClient(StubClient, self.app)
+
+
+    def test_fast_framed(self):
+        server = echo_server()
+        self.configure_echo(server)
+        self.app.config["THRIFTCLIENT_FRAMED"] = False
+        self.app.config["THRIFTCLIENT_FAST_FRAMED"] = True
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = ThriftClient(EchoClient, self.app)
+
+        large = "x" * (3 * 1024 * 1024)
+        for value in ("a", large, "b"):
+            with self.app.app_context():
+                self.assertEquals(client.client.echo(value), value)
+        with self.app.app_context():
+            self.assertTrue(isinstance(client.transport, TFastFramedTransport))
+            pipe = client.pipeline()
+            pipe.echo("c")
+            pipe.echo("d")
+            self.assertEquals(pipe.execute(), ["c", "d"])
+        server.close()
+
+    def test_fast_framed_with_framed(self):
+        self.app.config["THRIFTCLIENT_FRAMED"] = True
+        self.app.config["THRIFTCLIENT_FAST_FRAMED"] = True
+        with self.assertRaises(RuntimeError):
+            ThriftClient(EchoClient, self.app)
+
+
+    def test_compression(self):
+        server = echo_server(layer=TCompressedTransportFactory(
+            threshold=100).getTransport)
+        self.configure_echo(server)
+        self.app.config["THRIFTCLIENT_FRAMED"] = False
+        self.app.config["THRIFTCLIENT_COMPRESSION"] = "zlib"
+        self.app.config["THRIFTCLIENT_COMPRESSION_THRESHOLD"] = 100
+        client = ThriftClient(EchoClient, self.app)
+
+        with self.app.app_context():
+            self.assertEquals(client.client.echo("a"), "a")
+            self.assertEquals(client.client.echo("x" * 10000), "x" * 10000)
+            stats = client.compression
+            # only the large call and its reply are compressed
+            self.assertEquals(stats.frames_sent, 2)
+            self.assertEquals(stats.frames_compressed, 1)
+            self.assertEquals(stats.frames_received, 2)
+            self.assertEquals(stats.frames_decompressed, 1)
+            self.assertTrue(stats.ratio < 0.1)
+            self.assertTrue(stats.compress_time > 0)
+        server.close()
+
+    def test_compression_with_zlib(self):
+        self.app.config["THRIFTCLIENT_ZLIB"] = True
+        self.app.config["THRIFTCLIENT_COMPRESSION"] = "zlib"
+        with self.assertRaises(RuntimeError):
+            ThriftClient(EchoClient, self.app)
+
+    def test_compression_codecs(self):
+        self.app.config["THRIFTCLIENT_COMPRESSION"] = "rar"
+        with self.assertRaises(RuntimeError):
+            ThriftClient(EchoClient, self.app)
+        self.app.config["THRIFTCLIENT_COMPRESSION"] = "bz2"
+        self.app.config["THRIFTCLIENT_COMPRESSION_LEVEL"] = 1
+        self.app.config["THRIFTCLIENT_LAZY_CONNECT"] = True
+        client = ThriftClient(EchoClient, self.app)
+        with self.app.app_context():
+            self.assertEquals(client.transport.codec.level, 1)
+
+
+    def test_services(self):
+        users, items = echo_server(), echo_server()
+        self.app.config["THRIFTCLIENT_FRAMED"] = True
+        self.app.config["THRIFTCLIENT_SERVICES"] = {
+            "users": {"THRIFTCLIENT_TRANSPORT": "tcp://127.0.0.1:{port}"
+                      .format(port=users.getsockname()[1])},
+        }
+        services = ThriftServices()
+        services.register("users", EchoClient)
+        services.init_app(self.app)
+        services.register("items", EchoClient, {
+            "THRIFTCLIENT_TRANSPORT": "tcp://127.0.0.1:{port}".format(
+                port=items.getsockname()[1]),
+            "THRIFTCLIENT_POOL": True,
+        })
+        self.assertEquals(len(self.app.teardown_appcontext_funcs), 1)
+        self.assertTrue(services["items"].pool is not None)
+        self.assertTrue(services["users"].pool is None)
+
+        with self.app.app_context():
+            self.assertEquals(services.users.echo("a"), "a")
+            self.assertEquals(services.items.echo("b"), "b")
+        with self.app.app_context():
+            self.assertEquals(services.items.echo("c"), "c")
+        # the connection of items went back to its pool
+        self.assertEquals(services["items"].pool.idle, 1)
+        with self.assertRaises(AttributeError):
+            services.orders
+        with self.assertRaises(RuntimeError):
+            services.register("items", EchoClient)
+        users.close()
+        items.close()
+
+    def test_services_shared(self):
+        server = echo_server(multiplexed=True)
+        self.app.config["THRIFTCLIENT_FRAMED"] = True
+        services = ThriftServices(self.app)
+        services.shared("backend", {
+            "THRIFTCLIENT_TRANSPORT": "tcp://127.0.0.1:{port}".format(
+                port=server.getsockname()[1]),
+            "THRIFTCLIENT_POOL": True,
+        })
+        services.register("users", EchoClient, shared="backend")
+        services.register("items", EchoClient, shared="backend",
+                          multiplexed="Items")
+        with self.assertRaises(RuntimeError):
+            services.register("orders", EchoClient, shared="frontend")
+
+        for i in range(2):
+            with self.app.app_context():
+                self.assertEquals(services.users.echo("a"), "users:a")
+                self.assertEquals(services.items.echo("b"), "Items:b")
+                self.assertTrue(services["users"].transport is
+                                services["items"].transport)
+                pipe = services["items"].pipeline()
+                pipe.echo("c")
+                pipe.echo("d")
+                self.assertEquals(pipe.execute(), ["Items:c", "Items:d"])
+        # the echo server accepts a single connection
+        server.close()
+
+
+    def test_warm_up(self):
+        server = echo_server()
+        self.configure_echo(server)
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        self.app.config["THRIFTCLIENT_WARM_UP"] = 1
+        self.app.config["THRIFTCLIENT_WARM_UP_STAGGER"] = 0.05
+        client = ThriftClient(EchoClient, self.app)
+
+        self.assertEquals(client.pool.size, 0)
+        start = time.time()
+        client.warm_up().join()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(client.pool.idle, 1)
+        # the echo server accepts a single connection
+        with self.app.app_context():
+            self.assertEquals(client.client.echo("a"), "a")
+        server.close()
+
+        self.app.config["THRIFTCLIENT_POOL"] = False
+        with self.assertRaises(RuntimeError):
+            ThriftClient(EchoClient, self.app)
+
+    def test_pool_tls_alive(self):
+        server, handles = tls_server()
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "tcps://localhost:%d" % (
+            server.getsockname()[1])
+        self.app.config["THRIFTCLIENT_SSL_CA_CERTS"] = "tests/localhost.pem"
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        self.app.config["THRIFTCLIENT_ALWAYS_CONNECT"] = False
+        client = ThriftClient(StubClient, self.app)
+        pool = client.pool
+        try:
+            pool.fill(3)
+            # TLS 1.3 servers send their session tickets after the handshake
+            time.sleep(0.05)
+            conns = [pool.checkout() for i in range(3)]
+            self.assertEquals(pool.size, 3)
+            self.assertEquals(client._tls_contexts[False].handshakes, 3)
+            for conn in conns:
+                pool.checkin(conn)
+
+            # connections closed by the server are not reused
+            for handle in handles:
+                handle.close()
+            time.sleep(0.05)
+            self.assertFalse(any(conn.isAlive() for conn in conns))
+        finally:
+            pool.clear()
+            server.close()
+
+    def test_fork(self):
+        server = echo_server()
+        self.configure_echo(server)
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = ThriftClient(EchoClient, self.app)
+        with self.app.app_context():
+            conn = client._current_connection()
+            self.assertEquals(client.client.echo("a"), "a")
+        self.assertEquals(client.pool.idle, 1)
+
+        getpid = os.getpid
+        os.getpid = lambda: getpid() + 1
+        try:
+            # as in a child process
+            self.assertTrue(client._check_fork())
+            self.assertFalse(client._check_fork())
+            client.pool.clear()
+            self.assertEquals(client.pool.size, 0)
+            self.assertFalse(conn.isOpen())
+            # connections of the parent are not given back to the pool
+            client.pool.checkin(conn)
+            self.assertEquals(client.pool.idle, 0)
+        finally:
+            os.getpid = getpid
+        server.close()
+
+    def test_fork_coalesced_calls(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(LookupClient, self.app)
+        cache = client.cached("get")
+        batcher = client.batched("getMap", "getMap", window=1)
+        flights = cache._flights
+        batcher._collecting = object()
+
+        getpid = os.getpid
+        os.getpid = lambda: getpid() + 1
+        try:
+            self.assertTrue(client._check_fork())
+        finally:
+            os.getpid = getpid
+        # the calls in flight in the parent are never done in the child
+        self.assertFalse(cache._flights is flights)
+        self.assertEquals(batcher._collecting, None)
+
+    def test_http_headers_workers(self):
+        url, requests, connections = http_server()
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = url
+        self.app.config["THRIFTCLIENT_HTTP_HEADERS"] = lambda: {
+            "X-Request-Id": g.request_id}
+        client = ThriftClient(benchmark.Client, self.app)
+
+        # the workers have no application context, the headers are the
+        # ones of the caller
+        with self.app.app_context():
+            g.request_id = "1"
+            self.assertEquals(client.gather([lambda c: c.echo("a")]), ["a"])
+            g.request_id = "2"
+            self.assertEquals(client.submit(lambda c: c.echo("b")).result(),
+                              "b")
+            g.request_id = "3"
+            self.assertEquals(client.client.echo("c"), "c")
+        self.assertEquals([headers["X-Request-Id"] for headers in requests],
+                          ["1", "2", "3"])
+
+    def test_http_keepalive(self):
+        url, requests, connections = http_server()
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = url
+        self.app.config["THRIFTCLIENT_HTTP_KEEPALIVE"] = True
+        ids = iter(range(3))
+        self.app.config["THRIFTCLIENT_HTTP_HEADERS"] = lambda: {
+            "X-Request-Id": str(next(ids))}
+        client = ThriftClient(benchmark.Client, self.app)
+
+        for value in ("a", "b" * 100000, "c"):
+            with self.app.app_context():
+                self.assertEquals(client.client.echo(value), value)
+        self.assertEquals(len(connections), 1)
+        self.assertEquals([headers["X-Request-Id"] for headers in requests],
+                          ["0", "1", "2"])
+        self.assertTrue("Accept-Encoding" not in requests[0])
+
+        with self.app.app_context():
+            pipe = client.pipeline()
+            pipe.echo("d")
+            with self.assertRaises(RuntimeError):
+                pipe.execute()
+
+    def test_http_keepalive_closed(self):
+        url, requests, connections = http_server(drop=(1,))
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = url
+        self.app.config["THRIFTCLIENT_HTTP_KEEPALIVE"] = True
+        client = ThriftClient(benchmark.Client, self.app)
+
+        # the server may have processed the request, it is not sent again
+        with self.app.app_context():
+            self.assertEquals(client.client.echo("a"), "a")
+            with self.assertRaises(TTransport.TTransportException):
+                client.client.echo("b")
+        self.assertEquals(len(requests), 2)
+
+    def test_http_sessions_closed(self):
+        sessions = HttpSessionPool()
+        http = httplib.HTTPConnection("localhost")
+        http.sock, server = socket.socketpair()
+        sessions.put("key", http)
+        self.assertTrue(sessions.get("key") is http)
+
+        # idle connections closed by the server are not reused
+        sessions.put("key", http)
+        server.close()
+        self.assertTrue(sessions.get("key") is None)
+
+    def test_http_keepalive_gzip(self):
+        url, requests, connections = http_server()
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = url
+        self.app.config["THRIFTCLIENT_HTTP_KEEPALIVE"] = True
+        self.app.config["THRIFTCLIENT_HTTP_GZIP"] = True
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        client = ThriftClient(benchmark.Client, self.app)
+
+        for value in ("a", "b" * 100000, "c"):
+            with self.app.app_context():
+                self.assertEquals(client.client.echo(value), value)
+        self.assertEquals(len(connections), 1)
+        self.assertEquals(requests[0]["Accept-Encoding"], "gzip")
+
+    def test_retry(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        budget = self.app.config["THRIFTCLIENT_RETRY_BUDGET"] = RetryBudget()
+        client = ThriftClient(UnreliableClient, self.app)
+        client.retry("get", attempts=3, idempotent=True, backoff=0.01)
+
+        UnreliableClient.reset(failures=2)
+        with self.app.app_context():
+            self.assertEquals(client.client.get("a"), "A")
+        self.assertEquals(UnreliableClient.calls, 3)
+        self.assertEquals(budget.retries, 2)
+
+        UnreliableClient.reset(failures=3)
+        with self.app.app_context():
+            with self.assertRaises(TTransport.TTransportException):
+                client.client.get("a")
+        self.assertEquals(UnreliableClient.calls, 3)
+
+    def test_retry_not_idempotent(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_RETRY_BUDGET"] = RetryBudget()
+        client = ThriftClient(UnreliableClient, self.app)
+        client.retry("get", backoff=0)
+
+        UnreliableClient.reset(failures=1)
+        with self.app.app_context():
+            with self.assertRaises(TTransport.TTransportException):
+                client.client.get("a")
+        self.assertEquals(UnreliableClient.calls, 1)
+
+        # requests which could not be sent are always retried
+        UnreliableClient.reset(
+            failures=1, error=TTransport.TTransportException.NOT_OPEN)
+        with self.app.app_context():
+            self.assertEquals(client.client.get("a"), "A")
+        self.assertEquals(UnreliableClient.calls, 2)
+
+    def test_retry_budget(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        budget = self.app.config["THRIFTCLIENT_RETRY_BUDGET"] = RetryBudget(
+            ratio=0, capacity=1)
+        client = ThriftClient(UnreliableClient, self.app)
+        client.retry("get", attempts=5, idempotent=True, backoff=0)
+
+        UnreliableClient.reset(failures=5)
+        with self.app.app_context():
+            with self.assertRaises(TTransport.TTransportException):
+                client.client.get("a")
+        self.assertEquals(UnreliableClient.calls, 2)
+        self.assertEquals(budget.retries, 1)
+        self.assertEquals(budget.refused, 1)
+
+    def test_retry_budget_shared(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        a = ThriftClient(UnreliableClient, self.app)
+        b = ThriftClient(UnreliableClient, Flask(__name__))
+        self.assertTrue(a.retry_budget is b.retry_budget)
+
+    def test_retry_deadline(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_RETRY_BUDGET"] = RetryBudget()
+        client = ThriftClient(UnreliableClient, self.app)
+        client.retry("get", idempotent=True, backoff=1, jitter=False)
+
+        # no retry after the deadline
+        UnreliableClient.reset(failures=1)
+        with self.app.app_context():
+            with client.deadline(0.5):
+                with self.assertRaises(TTransport.TTransportException):
+                    client.client.get("a")
+        self.assertEquals(UnreliableClient.calls, 1)
+
+    def test_retry_bad(self):
+        client = ThriftClient(UnreliableClient, self.app)
+        with self.assertRaises(RuntimeError):
+            client.retry("nope")
+        with self.assertRaises(RuntimeError):
+            client.retry("get", hedge=95)
+        with self.assertRaises(RuntimeError):
+            client.retry("get", attempts=0)
+        self.app.config["THRIFTCLIENT_RETRY_BUDGET"] = 10
+        with self.assertRaises(RuntimeError):
+            ThriftClient(UnreliableClient, self.app)
+
+    def test_hedge(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        budget = self.app.config["THRIFTCLIENT_RETRY_BUDGET"] = RetryBudget()
+        client = ThriftClient(UnreliableClient, self.app)
+        client.retry("get", idempotent=True, hedge_after=0.05)
+
+        UnreliableClient.reset(delays=[0.5, 0])
+        start = time.time()
+        with self.app.app_context():
+            self.assertEquals(client.client.get("a"), "A")
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEquals(UnreliableClient.calls, 2)
+        self.assertEquals(budget.retries, 1)
+
+        # fast replies are not hedged
+        UnreliableClient.reset()
+        with self.app.app_context():
+            self.assertEquals(client.client.get("a"), "A")
+        self.assertEquals(UnreliableClient.calls, 1)
+
+    def test_hedge_failed_call(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_POOL"] = True
+        self.app.config["THRIFTCLIENT_RETRY_BUDGET"] = RetryBudget()
+        client = ThriftClient(UnreliableClient, self.app)
+        client.retry("get", attempts=1, idempotent=True, hedge_after=0.05)
+
+        # the slow call wins over the duplicate which failed
+        UnreliableClient.reset(failures=1, delays=[0.2])
+        with self.app.app_context():
+            self.assertEquals(client.client.get("a"), "A")
+        self.assertEquals(UnreliableClient.calls, 2)
+
+    def test_hedge_gather(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_WORKERS"] = 2
+        self.app.config["THRIFTCLIENT_RETRY_BUDGET"] = RetryBudget()
+        client = ThriftClient(UnreliableClient, self.app)
+        client.retry("get", idempotent=True, hedge_after=0.01)
+
+        # the workers of gather don't wait for hedged calls queued behind
+        # them
+        UnreliableClient.reset(delays=[0.1] * 4)
+        with self.app.app_context():
+            self.assertEquals(
+                client.gather([lambda c: c.get("a"), lambda c: c.get("b")],
+                              timeout=2),
+                ["A", "B"])
+        # the duplicates left in the background end
+        time.sleep(0.1)
+
+    def test_hedge_timeout(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        self.app.config["THRIFTCLIENT_HEDGE_TIMEOUT"] = 0.1
+        self.app.config["THRIFTCLIENT_RETRY_BUDGET"] = RetryBudget()
+        client = ThriftClient(UnreliableClient, self.app)
+        client.retry("get", attempts=1, idempotent=True, hedge_after=0.01)
+
+        UnreliableClient.reset(delays=[0.4, 0.4])
+        start = time.time()
+        with self.app.app_context():
+            with self.assertRaises(DeadlineExceeded):
+                client.client.get("a")
+        self.assertTrue(time.time() - start < 0.3)
+        # the calls left in the background end
+        time.sleep(0.4)
+
+    def test_stream(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(ScanClient, self.app)
+        ScanClient.size, ScanClient.fail, ScanClient.calls = 10, None, []
+
+        items = list(client.stream("scan", args=("n",), limit=3))
+        self.assertEquals(items, ["n{i}".format(i=i) for i in range(10)])
+        self.assertEquals(ScanClient.calls, [0, 3, 6, 9])
+
+        ScanClient.calls = []
+        self.assertEquals(list(client.stream("scan", args=("n",), cursor=8)),
+                          ["n8", "n9"])
+        self.assertEquals(ScanClient.calls, [8])
+
+    def test_stream_read_ahead(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(ScanClient, self.app)
+        ScanClient.size, ScanClient.fail, ScanClient.calls = 1000, None, []
+
+        stream = client.stream("scan", args=("n",), limit=1, read_ahead=2)
+        items = iter(stream)
+        self.assertEquals(next(items), "n0")
+        time.sleep(0.1)
+        # the page consumed, the pages read ahead and the one waiting
+        self.assertEquals(len(ScanClient.calls), 4)
+        items.close()
+        stream._thread.join(1)
+        self.assertFalse(stream._thread.is_alive())
+        self.assertTrue(len(ScanClient.calls) <= 5)
+        with self.assertRaises(RuntimeError):
+            iter(stream)
+
+    def test_stream_errors(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(ScanClient, self.app)
+        ScanClient.size, ScanClient.fail, ScanClient.calls = 10, 4, []
+
+        items = []
+        with self.assertRaises(ValueError):
+            for item in client.stream("scan", args=("n",), limit=2):
+                items.append(item)
+        self.assertEquals(items, ["n0", "n1", "n2", "n3"])
+        with self.assertRaises(RuntimeError):
+            client.stream("nope")
+        with self.assertRaises(RuntimeError):
+            client.stream("scan", read_ahead=0)
+
+    def test_stream_response(self):
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "http://localhost:8735"
+        client = ThriftClient(ScanClient, self.app)
+        ScanClient.size, ScanClient.fail, ScanClient.calls = 5, None, []
+
+        @self.app.route("/export")
+        def export():
+            items = client.stream("scan", args=("n",), limit=2)
+            return Response(item + "\n" for item in items)
+
+        response = self.app.test_client().get("/export")
+        self.assertEquals(response.data, "n0\nn1\nn2\nn3\nn4\n")
+
+    def record_echo(self, values):
+        """returns the capture of the echo calls of *values*"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "calls.capture")
+        server = echo_server()
+        self.configure_echo(server)
+        self.app.config["THRIFTCLIENT_RECORD"] = path
+        client = ThriftClient(EchoClient, self.app)
+        with self.app.app_context():
+            for value in values:
+                try:
+                    client.client.echo(value)
+                except TApplicationException:
+                    pass
+        server.close()
+        self.app.config["THRIFTCLIENT_RECORD"] = None
+        return path
+
+    def test_record_replay(self):
+        path = self.record_echo(["a", "b", "fail"])
+        self.assertEquals(len(Capture(path)), 3)
+        # the framed transport of the recording is ignored
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "replay://" + path
+        client = ThriftClient(EchoClient, self.app)
+
+        with self.app.app_context():
+            self.assertEquals(client.client.echo("b"), "b")
+            self.assertEquals(client.client.echo("a"), "a")
+            with self.assertRaises(TApplicationException):
+                client.client.echo("fail")
+            with self.assertRaises(TTransport.TTransportException):
+                client.client.echo("c")
+
+            pipe = client.pipeline()
+            pipe.echo("a")
+            pipe.echo("b")
+            self.assertEquals(pipe.execute(), ["a", "b"])
+
+    def test_record_pipeline(self):
+        server = echo_server()
+        self.configure_echo(server)
+        path = os.path.join(tempfile.mkdtemp(), "calls.capture")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.app.config["THRIFTCLIENT_RECORD"] = path
+        client = ThriftClient(EchoClient, self.app)
+
+        with self.app.app_context():
+            pipe = client.pipeline()
+            pipe.echo("a")
+            pipe.echo("b")
+            pipe.execute()
+            client.client.echo("c")
+        server.close()
+        # replies of pipelined calls can't be told apart
+        self.assertEquals(len(Capture(path)), 1)
+
+    def test_replay_faults(self):
+        path = self.record_echo(["a"])
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = (
+            "replay://" + path + "?errors=1")
+        client = ThriftClient(EchoClient, self.app)
+        with self.app.app_context():
+            with self.assertRaises(TTransport.TTransportException):
+                client.client.echo("a")
+
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = (
+            "replay://" + path + "?latency=0.05&jitter=0.01")
+        client = ThriftClient(EchoClient, self.app)
+        with self.app.app_context():
+            start = time.time()
+            self.assertEquals(client.client.echo("a"), "a")
+            self.assertTrue(0.05 <= time.time() - start < 0.5)
+
+        self.app.config["THRIFTCLIENT_READ_TIMEOUT"] = 0.02
+        client = ThriftClient(EchoClient, self.app)
+        with self.app.app_context():
+            with self.assertRaises(ThriftTimeout):
+                client.client.echo("a")
+
+    def test_replay_configuration(self):
+        path = self.record_echo(["a"])
+        for url in ("replay://" + path + "?delay=1",
+                    "replay://" + path + "?errors=2",
+                    "replay://" + path + "?latency=-1",
+                    "replay://" + path + "?jitter=x",
+                    "replay://host" + path):
+            self.app.config["THRIFTCLIENT_TRANSPORT"] = url
+            with self.assertRaises(RuntimeError):
+                ThriftClient(EchoClient, self.app)
+
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "replay://" + path
+        self.app.config["THRIFTCLIENT_RECORD"] = path
+        with self.assertRaises(RuntimeError):
+            ThriftClient(EchoClient, self.app)
+
+        self.app.config["THRIFTCLIENT_RECORD"] = None
+        self.app.config["THRIFTCLIENT_TRANSPORT"] = "replay:///nonexistent"
+        with self.assertRaises(IOError):
+            ThriftClient(EchoClient, self.app)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = ConnectionPool(StubConnection, max_size=2)
+        conn = pool.checkout()
+        self.assertTrue(conn.isOpen())
+        pool.checkin(conn)
+        self.assertTrue(pool.checkout() is conn)
+        self.assertEquals(pool.size, 1)
+
+    def test_exhausted(self):
+        pool = ConnectionPool(StubConnection, max_size=1)
+        pool.checkout()
+        with self.assertRaises(RuntimeError):
+            pool.checkout(timeout=0.01)
+
+    def test_checkout_waits_for_checkin(self):
+        pool = ConnectionPool(StubConnection, max_size=1)
+        conn = pool.checkout()
+        timer = threading.Timer(0.05, pool.checkin, (conn,))
+        timer.start()
+        self.assertTrue(pool.checkout(timeout=5) is conn)
+        timer.join()
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(StubConnection, min_size=1, max_size=3,
+                              idle_timeout=10)
+        conns = [pool.checkout() for i in range(3)]
+        for conn in conns:
+            pool.checkin(conn)
+        conns[0].last_used = time.time() - 60
+        pool.checkin(pool.checkout())
+        self.assertEquals(pool.size, 2)
+        self.assertFalse(conns[0].isOpen())
+
+        conns[1].last_used = conns[2].last_used = time.time() - 60
+        pool.checkin(pool.checkout())
+        # min_size connections are kept
+        self.assertEquals(pool.size, 1)
+
+    def test_max_lifetime(self):
+        pool = ConnectionPool(StubConnection, max_lifetime=10)
+        conn = pool.checkout()
+        conn.created_at = time.time() - 60
+        pool.checkin(conn)
+        self.assertFalse(conn.isOpen())
+        self.assertTrue(pool.checkout() is not conn)
+        self.assertEquals(pool.size, 1)
+
+    def test_checkin_closed(self):
+        pool = ConnectionPool(StubConnection)
+        conn = pool.checkout()
+        conn.close()
+        pool.checkin(conn)
+        self.assertEquals(pool.size, 0)
+
+    def test_fill(self):
+        pool = ConnectionPool(StubConnection, min_size=3)
+        pool.fill()
+        self.assertEquals(pool.size, 3)
+        self.assertEquals(pool.idle, 3)
+
+    def test_bad_sizes(self):
+        with self.assertRaises(RuntimeError):
+            ConnectionPool(StubConnection, max_size=0)
+        with self.assertRaises(RuntimeError):
+            ConnectionPool(StubConnection, min_size=3, max_size=2)
+
+
+class TestBalancers(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoints = [Endpoint("tcp://a"), Endpoint("tcp://b"),
+                          Endpoint("tcp://c")]
+
+    def test_endpoint_weight(self):
+        endpoint = Endpoint.from_url("http://a/path?x=1&weight=4;y=2")
+        self.assertEquals(endpoint.weight, 4)
+        self.assertEquals(endpoint.url, "http://a/path?x=1;y=2")
+        with self.assertRaises(RuntimeError):
+            Endpoint.from_url("tcp://a?weight=heavy")
+        with self.assertRaises(RuntimeError):
+            Endpoint.from_url("tcp://a?weight=0")
+
+    def test_round_robin(self):
+        balancer = RoundRobinBalancer()
+        chosen = [balancer.choose(self.endpoints) for i in range(6)]
+        self.assertEquals(chosen, self.endpoints * 2)
+
+    def test_least_outstanding(self):
+        balancer = LeastOutstandingBalancer()
+        self.endpoints[0].outstanding = 2
+        self.endpoints[2].outstanding = 1
+        for i in range(10):
+            self.assertTrue(balancer.choose(self.endpoints)
+                            is self.endpoints[1])
+
+    def test_power_of_two(self):
+        balancer = PowerOfTwoBalancer()
+        self.endpoints[0].outstanding = 5
+        self.endpoints[1].outstanding = 5
+        # the least loaded of any two endpoints is never the busiest one
+        for i in range(20):
+            chosen = balancer.choose(self.endpoints[1:])
+            self.assertTrue(chosen is self.endpoints[2])
+        self.assertTrue(balancer.choose(self.endpoints[:1])
+                        is self.endpoints[0])
+
+    def test_weighted(self):
+        balancer = WeightedBalancer()
+        self.endpoints[0].weight = 4
+        self.endpoints[1].weight = 2
+        chosen = [balancer.choose(self.endpoints) for i in range(7)]
+        self.assertEquals(chosen.count(self.endpoints[0]), 4)
+        self.assertEquals(chosen.count(self.endpoints[1]), 2)
+        self.assertEquals(chosen.count(self.endpoints[2]), 1)
+        # picks are interleaved
+        self.assertNotEquals(chosen[:4], [self.endpoints[0]] * 4)
+
+
+class TestEndpointHealth(unittest.TestCase):
+
+    def test_breaker(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+        breaker.failure()
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+        breaker.success()
+        breaker.failure()
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+        breaker.failure()
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.available())
+        self.assertFalse(breaker.acquire())
+
+    def test_breaker_half_open(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+        breaker.failure()
+        time.sleep(0.02)
+        self.assertEquals(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.acquire())
+        # a single probe at a time
+        self.assertFalse(breaker.available())
+        self.assertFalse(breaker.acquire())
+        breaker.failure()
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.02)
+        self.assertTrue(breaker.acquire())
+        breaker.success()
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.acquire())
+
+    def test_breaker_probe_expiry(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+        breaker.failure()
+        time.sleep(0.02)
+        self.assertTrue(breaker.acquire())
+        self.assertFalse(breaker.acquire())
+        # the probe was never settled
+        time.sleep(0.02)
+        self.assertTrue(breaker.acquire())
+
+    def test_outlier_errors(self):
+        outlier = OutlierDetector(consecutive_errors=2, ejection_time=10)
+        outlier.failure()
+        outlier.success()
+        outlier.failure()
+        self.assertFalse(outlier.ejected())
+        outlier.failure()
+        self.assertTrue(outlier.ejected())
+
+    def test_outlier_latency(self):
+        outlier = OutlierDetector(latency=0.1, consecutive_slow=2,
+                                  ejection_time=0.01)
+        outlier.success(0.2)
+        outlier.success(0.01)
+        outlier.success(0.2)
+        self.assertFalse(outlier.ejected())
+        outlier.success(0.2)
+        self.assertTrue(outlier.ejected())
+        time.sleep(0.02)
+        self.assertFalse(outlier.ejected())
+
+
+class TestThreadPool(unittest.TestCase):
+
+    def test_result(self):
+        pool = ThreadPool(2)
+        future = pool.submit(lambda x, y: x + y, 1, y=2)
+        self.assertEquals(future.result(1), 3)
+        self.assertTrue(future.done())
+        self.assertTrue(future.exception() is None)
+
+    def test_exception(self):
+        pool = ThreadPool(2)
+        future = pool.submit(lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            future.result(1)
+        self.assertTrue(isinstance(future.exception(), ZeroDivisionError))
+
+    def test_timeout(self):
+        pool = ThreadPool(1)
+        future = pool.submit(time.sleep, 0.1)
+        with self.assertRaises(ThriftTimeout):
+            future.result(0.01)
+
+    def test_callback(self):
+        pool = ThreadPool(1)
+        done = []
+        future = pool.submit(lambda: 42)
+        future.result(1)
+        future.add_done_callback(lambda f: done.append(f.result()))
+        self.assertEquals(done, [42])
+
+    def test_max_workers(self):
+        pool = ThreadPool(2)
+        futures = [pool.submit(time.sleep, 0.01) for i in range(10)]
+        for future in futures:
+            future.result(1)
+        self.assertEquals(len(pool._threads), 2)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 2, 3))
+        for value in (0.5, 1, 1.5, 2.5, 10):
+            histogram.observe(value)
+        self.assertEquals(histogram.counts, [2, 1, 1, 1])
+        self.assertEquals(histogram.count, 5)
+        self.assertEquals(histogram.sum, 15.5)
+        self.assertEquals(histogram.percentile(40), 1)
+        self.assertEquals(histogram.percentile(60), 2)
+        self.assertEquals(histogram.percentile(99), None)
+        self.assertEquals(Histogram().percentile(50), None)
+
+    def test_registry(self):
+        registry = MetricsRegistry()
+        registry.call("get", "tcp://a", 0.002, None, 10, 20)
+        registry.call("get", "tcp://a", 0.2, ValueError(), 10, None)
+        registry.connect("tcp://a", 0.01, 0.005)
+        methods = registry.snapshot()["methods"]
+        self.assertEquals(methods["get"]["calls"], 2)
+        self.assertEquals(methods["get"]["errors"], 1)
+        self.assertEquals(methods["get"]["sent"], 20)
+        self.assertEquals(methods["get"]["received"], 20)
+        self.assertEquals(registry.handshakes.count, 1)
+
+
+class TestRetry(unittest.TestCase):
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.3, jitter=False)
+        self.assertEquals([policy.delay(retry) for retry in (1, 2, 3)],
+                          [0.1, 0.2, 0.3])
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.3)
+        for retry in range(1, 10):
+            self.assertTrue(0 <= policy.delay(retry) <= 0.3)
+
+    def test_retryable(self):
+        policy = RetryPolicy()
+        timed_out = TTransport.TTransportException(
+            TTransport.TTransportException.TIMED_OUT)
+        not_open = TTransport.TTransportException(
+            TTransport.TTransportException.NOT_OPEN)
+        self.assertFalse(policy.retryable(timed_out))
+        self.assertTrue(policy.retryable(not_open))
+        policy = RetryPolicy(idempotent=True)
+        self.assertTrue(policy.retryable(timed_out))
+        self.assertTrue(policy.retryable(ThriftTimeout()))
+        self.assertFalse(policy.retryable(DeadlineExceeded()))
+        self.assertFalse(policy.retryable(CircuitOpenError()))
+        self.assertFalse(policy.retryable(ValueError()))
+
+    def test_hedge_percentile(self):
+        policy = RetryPolicy(idempotent=True, hedge=90, min_samples=10)
+        for i in range(9):
+            policy.observe(0.01)
+        self.assertEquals(policy.hedge_delay(), None)
+        policy.observe(0.01)
+        self.assertTrue(0.01 <= policy.hedge_delay() < 0.0125)
+
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, capacity=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        for i in range(10):
+            budget.deposit()
+        self.assertEquals(budget.balance, 2)
+        self.assertEquals(budget.snapshot()["refused"], 2)
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "calls.capture")
+
+    def test_replies_in_turn(self):
+        recorder = Recorder(self.path)
+        recorder.record("k" * 20, "request", "first")
+        recorder.record("k" * 20, "request", "second")
+        recorder.record("l" * 20, "other", "")
+        recorder.close()
+
+        capture = Capture(self.path)
+        self.assertEquals(len(capture), 3)
+        self.assertEquals(capture.reply("k" * 20), "first")
+        self.assertEquals(capture.reply("k" * 20), "second")
+        self.assertEquals(capture.reply("k" * 20), "first")
+        # one way calls have no reply
+        self.assertEquals(capture.reply("l" * 20), "")
+        self.assertEquals(capture.reply("m" * 20), None)
+
+    def test_truncated(self):
+        open(self.path, "w").close()
+        self.assertEquals(len(Capture(self.path)), 0)
+
+        recorder = Recorder(self.path)
+        recorder.record("k" * 20, "request", "reply")
+        recorder.record("l" * 20, "request", "reply")
+        recorder.close()
+        with open(self.path, "r+") as fd:
+            fd.truncate(os.path.getsize(self.path) - 1)
+
+        capture = Capture(self.path)
+        self.assertEquals(len(capture), 1)
+        self.assertEquals(capture.reply("l" * 20), None)
+
+
+class TestMemoryBackend(unittest.TestCase):
+
+    def test_lru(self):
+        backend = MemoryBackend(maxsize=2)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        self.assertEquals(backend.get("a"), 1)
+        backend.set("c", 3)
+        self.assertEquals(len(backend), 2)
+        self.assertEquals(backend.get("b"), None)
+        self.assertEquals(backend.get("a"), 1)
+        self.assertEquals(backend.get("c"), 3)
+
+    def test_ttl(self):
+        backend = MemoryBackend()
+        backend.set("a", 1, ttl=0.01)
+        backend.set("b", 2)
+        time.sleep(0.02)
+        self.assertEquals(backend.get("a"), None)
+        self.assertEquals(backend.get("b"), 2)
+        backend.delete("b")
+        self.assertEquals(backend.get("b"), None)
+
+
+class TestFastFramedTransport(unittest.TestCase):
+    def test_wire_compatible(self):
+        framed = TTransport.TMemoryBuffer()
+        fast = TTransport.TMemoryBuffer()
+        for trans in (TTransport.TFramedTransport(framed),
+                      TFastFramedTransport(fast)):
+            for message in ("abc", "d" * 10000, ""):
+                trans.write(message[:2])
+                trans.write(message[2:])
+                trans.flush()
+        self.assertEquals(fast.getvalue(), framed.getvalue())
+
+        trans = TFastFramedTransport(
+            TTransport.TMemoryBuffer(framed.getvalue()))
+        self.assertEquals(trans.read(2), "ab")
+        self.assertEquals(trans.read(10), "c")
+        self.assertEquals(trans.read(20000), "d" * 10000)
+
+    def test_buffers_reuse(self):
+        out = TTransport.TMemoryBuffer()
+        trans = TFastFramedTransport(out, max_retained=8192)
+        trans.write("x" * 5000)
+        trans.flush()
+        wbuf = trans._TFastFramedTransport__wbuf
+        self.assertEquals(len(wbuf), 8192)
+        trans.write("y")
+        trans.flush()
+        self.assertTrue(trans._TFastFramedTransport__wbuf is wbuf)
+        # buffers grown above max_retained are released
+        trans.write("z" * 10000)
+        trans.flush()
+        self.assertEquals(len(trans._TFastFramedTransport__wbuf),
+                          TFastFramedTransport.INITIAL_SIZE)
+
+        trans = TFastFramedTransport(TTransport.TMemoryBuffer(out.getvalue()),
+                                     max_retained=8192)
+        self.assertEquals(trans.read(5000), "x" * 5000)
+        self.assertEquals(trans.read(1), "y")
+        self.assertEquals(trans.read(10000), "z" * 10000)
+        self.assertEquals(len(trans._TFastFramedTransport__frame),
+                          TFastFramedTransport.INITIAL_SIZE)
+
+
+class TestCompressedTransport(unittest.TestCase):
+    def test_round_trip(self):
+        out = TTransport.TMemoryBuffer()
+        trans = TCompressedTransport(out, Bz2Codec(), threshold=10)
+        random = os.urandom(1000)
+        for message in ("small", "y" * 1000, random):
+            trans.write(message)
+            trans.flush()
+        # incompressible messages are sent raw
+        self.assertEquals(trans.stats.frames_compressed, 1)
+
+        trans = TCompressedTransport(TTransport.TMemoryBuffer(out.getvalue()),
+                                     Bz2Codec(), threshold=10)
+        self.assertEquals(trans.read(5), "small")
+        self.assertEquals(trans.read(2000), "y" * 1000)
+        self.assertEquals(trans.read(2000), random)
+        self.assertEquals(trans.stats.frames_decompressed, 1)
+        self.assertEquals(trans.stats.bytes_decompressed, 2005)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        results = benchmark.run(schemes=["tcp", "http"],
+                                protocols=[ThriftClient.COMPACT], requests=3)
+        # every layers combination, reused or not, and http without layers
+        self.assertEquals(len(results), 12 * 2 + 2)
+        for result in results:
+            self.assertEquals(result["requests"], 3)
+            self.assertTrue(result["p50"] <= result["p99"])
+            self.assertTrue(result["throughput"] > 0)
+
+    def test_stop_server(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for scheme in benchmark.SCHEMES:
+            url, stop = benchmark.start_server(scheme, ThriftClient.BINARY,
+                                               benchmark.LayersFactory(),
+                                               directory)
+            stop()
+            uri = urlparse(url)
+            if scheme == "unix":
+                sock = socket.socket(socket.AF_UNIX)
+                address = uri.path
+            else:
+                sock = socket.socket()
+                address = (uri.hostname, uri.port)
+            with self.assertRaises(socket.error):
+                sock.connect(address)
+            sock.close()
+
 
 if __name__ == "__main__":
     unittest.main()